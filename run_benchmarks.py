@@ -0,0 +1,20 @@
+#!/usr/bin/env python2.7
+
+import os
+import sys
+
+source_dir = os.path.join(os.path.dirname(__file__), 'source')
+sys.path.insert(0, source_dir)
+
+from benchmarks import redirect_checker_bench, prepare_url_bench
+
+SUITES = {
+    'redirect_checker': redirect_checker_bench,
+    'prepare_url': prepare_url_bench,
+}
+
+if __name__ == '__main__':
+    # ./run_benchmarks.py [suite] [suite options], redirect_checker by default
+    if len(sys.argv) > 1 and sys.argv[1] in SUITES:
+        sys.exit(SUITES[sys.argv[1]].main(sys.argv[1:]))
+    sys.exit(redirect_checker_bench.main(sys.argv))
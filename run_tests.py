@@ -9,17 +9,43 @@ sys.path.insert(0, source_dir)
 
 from tests.test_notification_pusher import NotificationPusherTestCase
 from tests.test_redirect_checker import RedirectCheckerTestCase
+from tests.test_redirect_checker_batch import RedirectCheckerBatchCase
 from tests.test_lib_utils import LibUtilsCase
 from tests.test_lib_worker import LibWorkerCase
 from tests.test_lib_init import LibInitCase
+from tests.test_lib_curl_pool import LibCurlPoolCase
+from tests.test_lib_buffer_pool import LibBufferPoolCase
+from tests.test_lib_autoscaler import LibAutoScalerCase
+from tests.test_lib_network_prober import LibNetworkProberCase
+from tests.test_lib_counters import LibCountersCase
+from tests.test_lib_hop_cache import LibHopCacheCase
+from tests.test_lib_circuit_breaker import LibCircuitBreakerCase
+from tests.test_lib_singleflight import LibSingleFlightCase
+from tests.test_lib_metrics import LibMetricsCase
+from tests.test_lib_prepare_url import LibPrepareUrlCase
+from tests.test_lib_preflight import LibPreflightCase
+from tests.test_lib_redirect_rules import LibRedirectRulesCase
 
 if __name__ == '__main__':
     suite = unittest.TestSuite((
         unittest.makeSuite(NotificationPusherTestCase),
         unittest.makeSuite(RedirectCheckerTestCase),
+        unittest.makeSuite(RedirectCheckerBatchCase),
         unittest.makeSuite(LibUtilsCase),
         unittest.makeSuite(LibWorkerCase),
         unittest.makeSuite(LibInitCase),
+        unittest.makeSuite(LibCurlPoolCase),
+        unittest.makeSuite(LibBufferPoolCase),
+        unittest.makeSuite(LibAutoScalerCase),
+        unittest.makeSuite(LibNetworkProberCase),
+        unittest.makeSuite(LibCountersCase),
+        unittest.makeSuite(LibHopCacheCase),
+        unittest.makeSuite(LibCircuitBreakerCase),
+        unittest.makeSuite(LibSingleFlightCase),
+        unittest.makeSuite(LibMetricsCase),
+        unittest.makeSuite(LibPrepareUrlCase),
+        unittest.makeSuite(LibPreflightCase),
+        unittest.makeSuite(LibRedirectRulesCase),
     ))
     result = unittest.TextTestRunner().run(suite)
     sys.exit(not result.wasSuccessful())
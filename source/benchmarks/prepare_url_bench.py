@@ -0,0 +1,111 @@
+# coding: utf-8
+"""
+Микробенчмарк prepare_url на корпусе урлов трекеров.
+
+Сравнивается нормализация без кеша и быстрого пути (normalize_url, как prepare_url
+работал раньше) с prepare_url на холодном и прогретом кеше. Каждый урл корпуса
+нормализуется несколько раз подряд, как при проверке цепочки (входной урл,
+запрос, урл редиректа). Результаты всех вариантов сверяются побайтно.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+import lib
+from lib import prepare_url, normalize_url
+
+HOSTS = (
+    'ad.example.com', 'click.tracker.net', 'www.shop.ru', 't.mail.ru', 'my.mail.ru',
+    u'пример.рф', 'promo.example.org:8080', 'APPS.Example.com',
+)
+PATHS = (
+    '/', '/click', '/r/{id}', '/landing/{id}/index.html', '/go/{id}', '/apps/{id}',
+    u'/каталог/{id}', '/path with spaces/{id}', '/~user/{id}', '/img;jsessionid={id}',
+)
+QUERIES = (
+    '', 'utm_source=vk&utm_medium=cpc&utm_campaign={id}', 'id={id}&ref=http://ref.example.com/',
+    'q=%D0%BF%D0%BE%D0%B8%D1%81%D0%BA&p={id}', 'gclid=EAIaIQ{id}', 'a={id}&b=c d',
+)
+
+
+def make_corpus(size, seed=0):
+    """Урлы трекеров: нормализованные ascii-урлы вперемешку с кириллицей, пробелами и экранированием"""
+    rnd = random.Random(seed)
+    corpus = []
+    for index in xrange(size):
+        scheme = 'https' if rnd.random() < 0.3 else 'http'
+        url = u'{}://{}{}'.format(scheme, rnd.choice(HOSTS), rnd.choice(PATHS).format(id=index))
+        query = rnd.choice(QUERIES).format(id=index)
+        if query:
+            url += u'?' + query
+        corpus.append(url.encode('utf8') if rnd.random() < 0.5 else url)
+    return corpus
+
+
+def make_calls(corpus, repeats, seed=0):
+    """Последовательность вызовов: каждый урл нормализуется repeats раз подряд"""
+    rnd = random.Random(seed)
+    calls = []
+    for url in rnd.sample(corpus, len(corpus)):
+        calls.extend([url] * repeats)
+    return calls
+
+
+def measure(name, func, calls):
+    started_at = time.time()
+    results = [func(url) for url in calls]
+    seconds = time.time() - started_at
+    return {
+        'name': name,
+        'calls': len(calls),
+        'seconds': round(seconds, 6),
+        'calls_per_sec': round(len(calls) / seconds, 1) if seconds else None,
+    }, results
+
+
+def run(size, repeats):
+    corpus = make_corpus(size)
+    calls = make_calls(corpus, repeats)
+
+    lib.prepared_urls.clear()
+    baseline, expected = measure('normalize_url', normalize_url, calls)
+    lib.prepared_urls.clear()
+    cold, cold_results = measure('prepare_url_cold', prepare_url, calls)
+    warm, warm_results = measure('prepare_url_warm', prepare_url, calls)
+
+    for result in (cold_results, warm_results):
+        if any(a != b or type(a) != type(b) for a, b in zip(result, expected)):
+            raise AssertionError('prepare_url output differs from normalize_url')
+
+    fast_path = sum(1 for url in corpus if lib.NORMALIZED_URL.match(url))
+    results = [baseline, cold, warm]
+    for result in results:
+        result['speedup'] = round(baseline['seconds'] / result['seconds'], 2) if result['seconds'] else None
+        print >> sys.stderr, u'{name:18} {calls_per_sec:>12} calls/s x{speedup}'.format(**result)
+    return {
+        'corpus_size': size,
+        'repeats': repeats,
+        'fast_path_share': round(float(fast_path) / len(corpus), 3),
+        'results': results,
+    }
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='prepare_url microbenchmark.')
+    parser.add_argument('-o', '--output', default='-', help='Path to JSON results file, "-" for stdout.')
+    parser.add_argument('-n', '--size', type=int, default=5000, help='Unique URLs in the corpus.')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Calls per URL.')
+    return parser.parse_args(args)
+
+
+def main(argv):
+    args = parse_args(argv[1:])
+    report = run(args.size, args.repeats)
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
@@ -0,0 +1,239 @@
+# coding: utf-8
+"""
+Бенчмарк проверки редиректов на локальном сервере (см. server.py).
+
+Для каждого сценария урлы проверяются через get_redirect_history и через
+worker_loop_function (с очередями в памяти), считаются урлы в секунду,
+p50/p99 времени проверки одного урла и потребление памяти процессом.
+Результаты пишутся в json, чтобы сравнивать их между коммитами.
+"""
+import argparse
+from collections import deque
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import pycurl
+
+from lib import get_redirect_history
+from lib.utils import load_config_from_pyfile
+from lib.worker import get_check_options, init_worker_resources, worker_loop_function, \
+    worker_batch_loop_function, TaskPipeline
+from benchmarks.server import BenchmarkServer
+
+SCENARIOS = (
+    # имя, путь на сервере, доля от числа запросов, параметры проверки
+    ('chain_301_5', '/chain/301/5', 1, {}),
+    ('chain_302_10', '/chain/302/10', 1, {}),
+    ('meta_refresh_3', '/meta/3', 1, {}),
+    ('slow_200ms', '/slow/200', 0.2, {}),
+    ('big_body_2mb', '/big/2048', 0.2, {}),
+    ('loop_3', '/loop/3', 1, {}),
+    # market:// переписывается в урл google play, дальше не идем, чтобы не выходить в сеть
+    ('market', '/market/com.example.app', 1, {'max_redirects': 1}),
+)
+
+BENCHMARKS = ('history', 'worker', 'worker_batch')
+
+WORKER_BATCH_SIZE = 20
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'config', 'checker_config.py')
+
+
+class MemoryTask(object):
+    task_counter = 0
+
+    def __init__(self, data):
+        MemoryTask.task_counter += 1
+        self.task_id = MemoryTask.task_counter
+        self.data = data
+
+    def meta(self):
+        return {'pri': 0}
+
+    def ack(self):
+        pass
+
+
+class MemoryTube(object):
+    """Очередь в памяти с интерфейсом tarantool_queue.Tube, которым пользуется воркер"""
+
+    def __init__(self):
+        self.tasks = deque()
+
+    def put(self, data, **kwargs):
+        self.tasks.append(MemoryTask(data))
+
+    def take(self, timeout=None):
+        return self.tasks.popleft() if self.tasks else None
+
+
+def percentile(values, q):
+    """q-й процентиль (nearest rank) отсортированного списка"""
+    if not values:
+        return None
+    index = max(0, int(round(q / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def get_rss_kb():
+    """Текущее потребление памяти процессом"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(name, scenario, func, count, urls_per_call=1):
+    """
+    Вызывает func count раз и собирает статистику по времени вызовов
+    :param urls_per_call: сколько урлов проверяет один вызов
+    """
+    latencies = []
+    started_at = time.time()
+    for _ in xrange(count):
+        call_started_at = time.time()
+        func()
+        latencies.append(time.time() - call_started_at)
+    seconds = time.time() - started_at
+    latencies.sort()
+    return {
+        'benchmark': name,
+        'scenario': scenario,
+        'urls': count * urls_per_call,
+        'seconds': round(seconds, 6),
+        'urls_per_sec': round(count * urls_per_call / seconds, 3) if seconds else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'rss_kb': get_rss_kb(),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def bench_history(config, url, count, options):
+    check_options = get_check_options(config)
+    max_redirects = options.get('max_redirects', config.MAX_REDIRECTS)
+
+    def check():
+        get_redirect_history(url, config.HTTP_TIMEOUT, max_redirects, config.USER_AGENT, **check_options)
+    return check, count
+
+
+def bench_worker(config, url, count, options):
+    config = clone_config(config, MAX_REDIRECTS=options.get('max_redirects', config.MAX_REDIRECTS))
+    input_tube, output_tube = MemoryTube(), MemoryTube()
+    for url_id in xrange(count):
+        input_tube.put({'url': url, 'url_id': url_id})
+
+    def check():
+        worker_loop_function(config, input_tube, output_tube)
+    return check, count
+
+
+def bench_worker_batch(config, url, count, options):
+    """Пакетный режим воркера: один вызов - WORKER_BATCH_SIZE задач, результаты отправляются каждый вызов"""
+    config = clone_config(config, MAX_REDIRECTS=options.get('max_redirects', config.MAX_REDIRECTS),
+                          WORKER_BATCH_SIZE=WORKER_BATCH_SIZE, QUEUE_TAKE_TIMEOUT=0)
+    input_tube, output_tube = MemoryTube(), MemoryTube()
+    calls = max(1, count // WORKER_BATCH_SIZE)
+    for url_id in xrange(calls * WORKER_BATCH_SIZE):
+        # одинаковые урлы в пачке проверялись бы один раз
+        input_tube.put({'url': '{}?task={}'.format(url, url_id), 'url_id': url_id})
+    pipeline = TaskPipeline(flush_size=WORKER_BATCH_SIZE)
+
+    def check():
+        worker_batch_loop_function(config, input_tube, output_tube, pipeline)
+    return check, calls
+
+
+def clone_config(config, **overrides):
+    clone = type(config)()
+    clone.__dict__.update(config.__dict__)
+    clone.__dict__.update(overrides)
+    return clone
+
+
+BENCHMARK_FUNCTIONS = {
+    'history': bench_history,
+    'worker': bench_worker,
+    'worker_batch': bench_worker_batch,
+}
+
+
+def run(config, server, scenarios, benchmarks, requests):
+    results = []
+    for name, path, share, options in SCENARIOS:
+        if name not in scenarios:
+            continue
+        count = max(1, int(requests * share))
+        for benchmark in benchmarks:
+            make_check = BENCHMARK_FUNCTIONS[benchmark]
+            check, calls = make_check(config, server.url(path), count, options)
+            result = measure(benchmark, name, check, calls, WORKER_BATCH_SIZE if benchmark == 'worker_batch' else 1)
+            print >> sys.stderr, u'{benchmark:8} {scenario:16} {urls_per_sec:>10} urls/s ' \
+                                 u'p50={p50_ms}ms p99={p99_ms}ms rss={rss_kb}kb'.format(**result)
+            results.append(result)
+    return results
+
+
+def parse_args(args):
+    scenario_names = [name for name, _, _, _ in SCENARIOS]
+    parser = argparse.ArgumentParser(description='Redirect checker benchmark on a local HTTP server.')
+    parser.add_argument('-c', '--config', default=DEFAULT_CONFIG, help='Path to checker configuration file.')
+    parser.add_argument('-o', '--output', default='-', help='Path to JSON results file, "-" for stdout.')
+    parser.add_argument('-n', '--requests', type=int, default=50, help='URLs per scenario.')
+    parser.add_argument('-s', '--scenario', dest='scenarios', action='append', choices=scenario_names,
+                        help='Scenario to run (all by default), can be repeated.')
+    parser.add_argument('-b', '--benchmark', dest='benchmarks', action='append', choices=BENCHMARKS,
+                        help='Benchmark to run (all by default), can be repeated.')
+    return parser.parse_args(args)
+
+
+def main(argv):
+    args = parse_args(argv[1:])
+    config = load_config_from_pyfile(args.config)
+    # повторные проверки одних и тех же урлов не должны отвечаться из общих кешей
+    config.HOP_CACHE_PATH = None
+    config.SINGLEFLIGHT = False
+    # тестовый сервер слушает на 127.0.0.1
+    config.PREFLIGHT_BLOCK_PRIVATE = False
+    init_worker_resources(config)
+
+    server = BenchmarkServer().start()
+    try:
+        results = run(
+            config, server,
+            args.scenarios or [name for name, _, _, _ in SCENARIOS],
+            args.benchmarks or BENCHMARKS,
+            args.requests
+        )
+    finally:
+        server.stop()
+
+    report = {
+        'commit': get_commit(),
+        'started_at': time.time(),
+        'python': platform.python_version(),
+        'pycurl': pycurl.version,
+        'requests': args.requests,
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
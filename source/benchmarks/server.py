@@ -0,0 +1,140 @@
+# coding: utf-8
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import errno
+import socket
+import threading
+import time
+
+COUNTER_SCRIPT = '<script src="//mc.yandex.ru/metrika/watch.js"></script>'
+
+
+class ScenarioHandler(BaseHTTPRequestHandler):
+    """
+    Ответы тестового сервера, сценарий задается путем:
+
+    /chain/<код>/<n> - цепочка из n http-редиректов с кодом 301/302, в конце страница со счетчиком
+    /meta/<n> - цепочка из n мета-редиректов
+    /slow/<мс> - страница, которая отвечает через заданное время
+    /big/<кб> - страница заданного размера со счетчиком в конце
+    /loop/<n> - цикл из n http-редиректов
+    /market/<id> - редирект на market://details?id=<id>
+    """
+
+    protocol_version = 'HTTP/1.1'
+    chunk_size = 64 * 1024
+    # заголовки и тело уходят одним пакетом, иначе keep-alive упирается в delayed ack
+    wbufsize = chunk_size
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        # checker обрывает загрузку, как только ответ известен (BodyScanner, MAX_BODY_SIZE), - это не ошибка
+        try:
+            BaseHTTPRequestHandler.handle(self)
+        except socket.error as e:
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+
+    def do_GET(self):
+        # параметры запроса не влияют на ответ, ими урлы задач делаются разными
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+        try:
+            handler = getattr(self, 'scenario_' + parts[0])
+            handler(*parts[1:])
+        except (AttributeError, TypeError, ValueError):
+            self.respond(404, '')
+
+    def respond(self, code, body, location=None):
+        self.send_response(code)
+        if location:
+            self.send_header('Location', location)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        for start in xrange(0, len(body), self.chunk_size):
+            self.wfile.write(body[start:start + self.chunk_size])
+
+    def page(self, head='', body=''):
+        return '<html><head>{}</head><body>{}{}</body></html>'.format(head, body, COUNTER_SCRIPT)
+
+    def scenario_chain(self, code, n):
+        n = int(n)
+        if n > 0:
+            self.respond(int(code), '', '/chain/{}/{}'.format(code, n - 1))
+        else:
+            self.respond(200, self.page())
+
+    def scenario_meta(self, n):
+        n = int(n)
+        if n > 0:
+            refresh = '<meta http-equiv="refresh" content="0;url=/meta/{}">'.format(n - 1)
+            self.respond(200, self.page(head=refresh))
+        else:
+            self.respond(200, self.page())
+
+    def scenario_slow(self, ms):
+        time.sleep(int(ms) / 1000.0)
+        self.respond(200, self.page())
+
+    def scenario_big(self, kb):
+        self.respond(200, self.page(body='x' * (int(kb) * 1024)))
+
+    def scenario_loop(self, n, step='0'):
+        self.respond(302, '', '/loop/{}/{}'.format(n, (int(step) + 1) % int(n)))
+
+    def scenario_market(self, app_id):
+        self.respond(302, '', 'market://details?id={}'.format(app_id))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # одновременные соединения пакетного режима не должны упираться в очередь listen
+    request_queue_size = 128
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.connections = set()
+
+    def process_request_thread(self, request, client_address):
+        self.connections.add(request)
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.connections.discard(request)
+
+    def close_connections(self):
+        """Закрывает keep-alive соединения checker'а, чтобы потоки обработчиков завершились до выхода"""
+        for request in list(self.connections):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class BenchmarkServer(object):
+    """Локальный http-сервер со сценариями ScenarioHandler, работает в отдельном потоке"""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), ScenarioHandler)
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}'.format(*self.server.server_address)
+
+    def url(self, path):
+        return self.base_url + path
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.close_connections()
+        self.server.server_close()
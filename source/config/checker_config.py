@@ -1,3 +1,4 @@
+# coding: utf-8
 import sys
 from codecs import getwriter
 
@@ -14,16 +15,143 @@ OUTPUT_QUEUE_TUBE = 'url_redirect.queue'
 
 WORKER_POOL_SIZE = 10
 QUEUE_TAKE_TIMEOUT = 0.1
+# сколько задач каждый процесс-воркер проверяет одновременно (greenlet'ы gevent с общими очередями,
+# запросы curl не блокируют процесс); всего WORKER_POOL_SIZE * FETCHERS_PER_WORKER проверок.
+# 1 - задачи по одной; при FETCHERS_PER_WORKER > 1 WORKER_BATCH_SIZE не используется
+FETCHERS_PER_WORKER = 1
+
+# размер пула воркеров по входной очереди (False - всегда WORKER_POOL_SIZE), проверяется раз в SLEEP секунд:
+# пул растет, когда готовых задач больше AUTOSCALE_UP_BACKLOG на воркер, - так, чтобы очередь разобралась
+# за AUTOSCALE_DRAIN_TIME секунд (не больше чем на AUTOSCALE_MAX_STEP воркеров за раз), и уменьшается
+# на один воркер, когда задач не больше AUTOSCALE_DOWN_BACKLOG на воркер AUTOSCALE_IDLE_CHECKS проверок подряд;
+# между изменениями - не меньше AUTOSCALE_UP_COOLDOWN / AUTOSCALE_DOWN_COOLDOWN секунд;
+# пул не растет при load average на ядро больше AUTOSCALE_MAX_LOAD или свободной памяти
+# меньше AUTOSCALE_MIN_FREE_MEMORY байт (None - не проверять)
+AUTOSCALE = False
+AUTOSCALE_MIN_WORKERS = 2
+AUTOSCALE_MAX_WORKERS = 50
+AUTOSCALE_UP_BACKLOG = 10
+AUTOSCALE_DOWN_BACKLOG = 1
+AUTOSCALE_DRAIN_TIME = 60
+AUTOSCALE_MAX_STEP = 4
+AUTOSCALE_IDLE_CHECKS = 3
+AUTOSCALE_UP_COOLDOWN = 30
+AUTOSCALE_DOWN_COOLDOWN = 120
+AUTOSCALE_MAX_LOAD = 2.0
+AUTOSCALE_MIN_FREE_MEMORY = 256 * 1024 * 1024
+
+# сколько задач воркер берет и проверяет одновременно за цикл (1 - по одной);
+# при WORKER_BATCH_SIZE > 1 результаты и ack отправляются пачками:
+# по OUTPUT_FLUSH_SIZE задач или через OUTPUT_FLUSH_INTERVAL секунд после первой
+WORKER_BATCH_SIZE = 1
+OUTPUT_FLUSH_SIZE = 50
+OUTPUT_FLUSH_INTERVAL = 1.0
+# отправлять результаты и ack в отдельном потоке, пока воркер берет и проверяет следующие задачи;
+# если отправки ждут RESULT_WRITER_QUEUE_SIZE результатов, воркер ждет, пока очередь освободится
+ASYNC_RESULT_WRITER = False
+RESULT_WRITER_QUEUE_SIZE = 100
 
 SLEEP = 10
 
 HTTP_TIMEOUT = 3
+# таймаут на установку соединения
+HTTP_CONNECT_TIMEOUT = 1
+# таймаут на проверку всей цепочки редиректов
+CHAIN_TIMEOUT = 15
 MAX_REDIRECTS = 30
+# урл, проверка которого закончилась ошибкой, перепроверяется не больше RECHECK_MAX_ATTEMPTS раз:
+# ошибки, которые повторятся (битый урл, хоста нет в DNS по PREFLIGHT), - не перепроверяются,
+# временные (таймауты, сбои DNS) - через RECHECK_SHORT_DELAY секунд, отказ в соединении - через RECHECK_DELAY,
+# удваивая задержку с каждой перепроверкой (не больше RECHECK_MAX_DELAY)
 RECHECK_DELAY = 300
+RECHECK_SHORT_DELAY = 60
+RECHECK_MAX_DELAY = 3600
+RECHECK_MAX_ATTEMPTS = 1
+
+# пул переиспользуемых curl-хендлов на процесс, 0 - отключить
+CURL_POOL_SIZE = 10
+CURL_POOL_IDLE_TIMEOUT = 60
+
+# разбирать тело ответа по мере загрузки и прерывать ее, как только результат известен
+STREAM_BODY_SCAN = True
+
+# парсер мета-редиректов: 'bs4' - первый мета-тег страницы (BeautifulSoup),
+# 'head' - все мета-теги до </head> (HTMLParser, BeautifulSoup только для битых страниц)
+META_PARSER = 'bs4'
+
+# сколько байт тела ответа с http-редиректом (Location) загружать на каждом шаге цепочки, 0 - без ограничения
+# (ответы без Location загружаются целиком: счетчики на конечной странице ищутся во всем теле)
+MAX_BODY_SIZE = 2 * 1024 * 1024
+# сначала делать HEAD-запрос, тело загружать, только если он не вернул http-редирект
+HEAD_FIRST = False
+
+# какие сжатия ответа запрашивать (Accept-Encoding), ответы распаковываются curl;
+# '' - все, что поддерживает libcurl, None - не запрашивать
+HTTP_ENCODING = 'gzip, deflate'
+
+# пул буферов для тел ответов процесса (0 - отключить): буферы по RECEIVE_BUFFER_SIZE байт
+# используются повторно, выросшие больше RECEIVE_BUFFER_MAX_SIZE освобождаются
+RECEIVE_BUFFER_POOL_SIZE = 8
+RECEIVE_BUFFER_SIZE = 64 * 1024
+RECEIVE_BUFFER_MAX_SIZE = 1024 * 1024
+
+# общий для воркеров кеш редиректов (sqlite-файл), None - отключить;
+# файл должен лежать в каталоге, куда может писать только пользователь сервиса (не в /tmp):
+# записи кеша подменяют результаты проверок
+HOP_CACHE_PATH = None
+HOP_CACHE_TTL = 3600
+HOP_CACHE_SIZE = 100000
+
+# после стольких ошибок подряд запросы к хосту не делаются (0 - отключить),
+# через CIRCUIT_BREAKER_RESET_TIMEOUT секунд пробуется один запрос
+CIRCUIT_BREAKER_FAILURES = 0
+CIRCUIT_BREAKER_RESET_TIMEOUT = 60
+
+# урлы, запрос которых заведомо не даст результата, сразу завершаются ошибкой (False - отключить):
+# PREFLIGHT_DENY - регулярки отбрасываемых урлов, PREFLIGHT_ALLOW - урлов, которые не проверяются,
+# PREFLIGHT_BLOCK_PRIVATE - отбрасывать локальные и внутренние ip-адреса,
+# PREFLIGHT_DNS_TTL - на сколько секунд кешировать проверку существования хоста в DNS (0 - не проверять)
+PREFLIGHT = False
+PREFLIGHT_ALLOW = []
+PREFLIGHT_DENY = []
+PREFLIGHT_SCHEMES = ('http', 'https')
+PREFLIGHT_BLOCK_PRIVATE = True
+PREFLIGHT_DNS_TTL = 300
+
+# переходы, которые определяются по урлу без запроса: (имя, регулярка урла, шаблон следующего урла,
+# тип редиректа - 'http_status'/'meta_tag'); группы подставляются в шаблон раскодированными, например
+# ('example_click', r'https?://click\.example\.com/r\?(?:.*&)?url=([^&]+)', r'\1', 'http_status')
+REDIRECT_RULES = []
+
+# одновременные проверки одного урла ждут одну общую цепочку запросов;
+# SINGLEFLIGHT_PATH - sqlite-файл для объединения проверок между воркерами (None - только внутри процесса),
+# как и HOP_CACHE_PATH, должен лежать в каталоге, куда может писать только пользователь сервиса
+SINGLEFLIGHT = True
+SINGLEFLIGHT_PATH = None
+SINGLEFLIGHT_WAIT_TIMEOUT = 30
+
+# добавлять в результат проверки времена этапов запросов (dns, connect, tls, ...) каждого хопа
+HOP_TIMINGS_IN_RESULT = False
+# формат поля result в выходной очереди: 'plain' - [типы, урлы, счетчики],
+# 'compact' - {"t", "u", "c"} с кодами типов и общими началами урлов (см. lib.decode_history_result)
+RESULT_ENCODING = 'plain'
+# раз в сколько секунд писать в лог гистограммы времен запросов процесса, 0 - не писать
+METRICS_LOG_INTERVAL = 60
 USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/31.0.1650.63 Safari/537.36"
 
 CHECK_URL = "http://t.mail.ru"
 
+# фоновая проверка сети: раз в NETWORK_PROBE_INTERVAL секунд запрашиваются NETWORK_PROBE_URLS (проверка успешна,
+# если ответил хотя бы один); сеть считается недоступной, когда удачных проверок среди последних
+# NETWORK_PROBE_WINDOW меньше доли NETWORK_DOWN_RATIO, и снова доступной, когда их не меньше NETWORK_UP_RATIO;
+# пока сети нет, воркеры не берут новые задачи ([] - проверять CHECK_URL в основном цикле
+# и останавливать воркеры при первой неудаче)
+NETWORK_PROBE_URLS = [CHECK_URL]
+NETWORK_PROBE_INTERVAL = 5
+NETWORK_PROBE_WINDOW = 6
+NETWORK_DOWN_RATIO = 0.5
+NETWORK_UP_RATIO = 0.8
+
 LOGGING = {
     'version': 1,
     'formatters': {
@@ -1,23 +1,102 @@
 # coding: utf-8
-from StringIO import StringIO
+from collections import deque
+from HTMLParser import HTMLParser, HTMLParseError
 from logging import getLogger, NullHandler
+from os.path import commonprefix
 import re
 from urllib import quote, quote_plus
 from urlparse import urljoin, urlsplit, urlparse, urlunparse
+import time
 
 from bs4 import BeautifulSoup
 import pycurl
 
+from .buffer_pool import BufferPool, ReceiveBuffer
+from .circuit_breaker import CircuitBreaker
+from .curl_pool import CurlPool
+from .hop_cache import HopCache
+from .metrics import get_hop_info, hop_metrics
+from .preflight import Preflight
+from .redirect_rules import RedirectRules
+from .singleflight import SingleFlight
+
 logger = getLogger('redirect_checker')
 logger.addHandler(NullHandler())
 
 REDIRECT_META = 'meta_tag'
 REDIRECT_HTTP = 'http_status'
 
+META_PARSER_BS4 = 'bs4'
+META_PARSER_HEAD = 'head'
+META_HEAD_MAX_BYTES = 64 * 1024
+"""Сколько байт от начала страницы читает парсер META_PARSER_HEAD, если </head> не встретился"""
+
+HEAD_END = re.compile(r'</head\s*>|<body[\s>]', re.I)
+
+NORMALIZED_URL = re.compile(
+    r"[a-z][a-z0-9+.-]*://[A-Za-z0-9.:-]+"
+    r"(?:/[A-Za-z0-9_.\-/%+$!*'(),]*)?"
+    r"(?:\?[A-Za-z0-9_.\-:&%=+$!*'(),]+)?\Z"
+)
+"""
+Урлы, которые prepare_url не меняет: схема в нижнем регистре, ascii-хост,
+в пути и параметрах только символы, которые не экранируются quote/quote_plus
+"""
+
+PREPARED_URLS_CACHE_SIZE = 10000
+
+RESULT_ENCODING_PLAIN = 'plain'
+RESULT_ENCODING_COMPACT = 'compact'
+REDIRECT_TYPE_CODES = {REDIRECT_HTTP: 'h', REDIRECT_META: 'm', 'ERROR': 'e'}
+REDIRECT_TYPES_BY_CODE = dict((code, redirect_type) for redirect_type, code in REDIRECT_TYPE_CODES.items())
+COMPACT_URL_MIN_PREFIX = 8
+"""Короче этого общее начало с предыдущим урлом не выделяется: пара [n, остаток] выйдет длиннее"""
+
+ERROR_PERMANENT = 'permanent'
+ERROR_CONNECT = 'connect'
+ERROR_TRANSIENT = 'transient'
+PERMANENT_CURL_ERRORS = frozenset((pycurl.E_UNSUPPORTED_PROTOCOL, pycurl.E_URL_MALFORMAT, pycurl.E_SSL_CACERT))
+"""
+Ошибки, которые повторятся при повторном запросе: схема, битый урл, сертификат.
+E_COULDNT_RESOLVE_HOST сюда не входит: curl возвращает ее при любом сбое резолвера (SERVFAIL, таймаут),
+несуществующие хосты отбрасывает Preflight
+"""
+CONNECT_CURL_ERRORS = frozenset((pycurl.E_COULDNT_CONNECT,))
+
 OK_REDIRECT = re.compile(r'http://(www\.)?odnoklassniki\.ru/.*st\.redirect', re.I)
 OK_URL = re.compile(r'http(?:s)?://(www\.)?odnoklassniki\.ru/', re.I)
 MM_URL = re.compile(r'http(?:s)?://my\.mail\.ru/apps/', re.I)
 
+curl_pool = None
+"""Пул curl-хендлов процесса, если None - на каждый запрос создается новый хендл"""
+
+buffer_pool = None
+"""Пул буферов для тел ответов (BufferPool), если None - на каждый запрос создается новый буфер"""
+
+curl_select = None
+"""select для кооперативных запросов (см. init_cooperative_curl), если None - запросы блокирующие"""
+
+curl_multi = None
+"""CurlMulti процесса (см. get_curl_multi), в нем же кеш соединений - keep-alive живет между запросами"""
+
+curl_results = {}
+"""Завершенные в curl_multi кооперативные запросы: хендл -> None или (код ошибки, сообщение)"""
+
+hop_cache = None
+"""Общий для процессов кеш редиректов (HopCache), если None - не используется"""
+
+circuit_breaker = None
+"""Учет недоступных хостов процесса (CircuitBreaker), если None - не используется"""
+
+singleflight = None
+"""Объединение одновременных проверок одного урла (SingleFlight), если None - не используется"""
+
+preflight = None
+"""Отбрасывание заведомо бесполезных запросов (Preflight), если None - не используется"""
+
+prepared_urls = {}
+"""Кеш prepare_url, очищается целиком при достижении PREPARED_URLS_CACHE_SIZE"""
+
 COUNTER_TYPES = (
     ('GOOGLE_ANALYTICS', re.compile(r'.*google-analytics\.com/ga\.js.*', re.I+re.S)),
     ('YA_METRICA', re.compile(r'.*mc\.yandex\.ru/metrika/watch\.js.*', re.I+re.S)),
@@ -30,6 +109,27 @@ COUNTER_TYPES = (
 )
 
 
+def compile_counter_signatures(counter_types):
+    """
+    Выделяет строки-сигнатуры счетчиков из регулярок вида .*signature.*
+
+    Поиск подстроки в приведенной к нижнему регистру странице дает тот же результат,
+    что и re.match с re.I (сигнатуры ascii, re.I без re.U тоже учитывает только ascii),
+    но намного быстрее: нет перебора с возвратами по всему документу.
+    """
+    signatures = []
+    for counter_name, regexp in counter_types:
+        pattern = regexp.pattern
+        if not (pattern.startswith('.*') and pattern.endswith('.*')) or \
+                re.search(r'(?<!\\)[.^$*+?{}\[\]|()]', pattern[2:-2]):
+            raise ValueError(u'bad counter pattern {}'.format(counter_name))
+        signatures.append(re.sub(r'\\(.)', r'\1', pattern[2:-2]).lower())
+    return tuple(signatures)
+
+
+COUNTER_SIGNATURES = compile_counter_signatures(COUNTER_TYPES)
+
+
 def to_unicode(val, errors='strict'):
     return val if isinstance(val, unicode) else val.decode('utf8', errors=errors)
 
@@ -38,15 +138,33 @@ def to_str(val, errors='strict'):
     return val.encode('utf8', errors=errors) if isinstance(val, unicode) else val
 
 
+def find_counters(content, found=None):
+    """
+    Ищет счетчики на странице
+    :param found: индексы уже найденных счетчиков, дополняется найденными
+    :return: множество индексов найденных счетчиков в COUNTER_TYPES
+    """
+    found = set() if found is None else found
+    text = to_str(content, 'ignore').lower()
+    for index, signature in enumerate(COUNTER_SIGNATURES):
+        if index not in found and signature in text:
+            found.add(index)
+    return found
+
+
+def get_counter_names(found):
+    """Типы счетчиков по индексам в порядке COUNTER_TYPES"""
+    return [
+        counter_name for index, (counter_name, regexp) in enumerate(COUNTER_TYPES)
+        if index in found
+    ]
+
+
 def get_counters(content):
     """
     Ищет в хтмл-странице счетичик и возвращает массив типов найденных
     """
-    counters = []
-    for counter_name, regexp in COUNTER_TYPES:
-        if re.match(regexp, content):
-            counters.append(counter_name)
-    return counters
+    return get_counter_names(find_counters(content))
 
 
 def check_for_meta(content, url):
@@ -58,15 +176,225 @@ def check_for_meta(content, url):
     if result and 'content' in result.attrs:
         for attr, value in result.attrs.items():
             if attr == 'http-equiv' and value.lower() == 'refresh':
-                splitted = result['content'].split(";")
-                if len(splitted) != 2:
-                    return
-                wait, text = splitted
-                text = text.strip().lower()
-                m = re.search(r"url\s*=\s*['\"]?([^'\"]+)", text, re.I)
-                if m:
-                    meta_url = m.groups()[0]
-                    return urljoin(url, to_unicode(meta_url, 'ignore'))
+                return get_meta_refresh_url(result['content'], url)
+
+
+def get_meta_refresh_url(content, url):
+    """
+    Возвращает урл редиректа из атрибута content мета-тега refresh
+    """
+    splitted = content.split(";")
+    if len(splitted) != 2:
+        return
+    wait, text = splitted
+    text = text.strip().lower()
+    m = re.search(r"url\s*=\s*['\"]?([^'\"]+)", text, re.I)
+    if m:
+        meta_url = m.groups()[0]
+        return urljoin(url, to_unicode(meta_url, 'ignore'))
+
+
+class HeadMetaParser(HTMLParser):
+    """
+    Собирает атрибуты всех мета-тегов страницы
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.metas = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            self.metas.append(dict(attrs))
+
+
+def get_meta_attrs_refresh_url(attrs, url):
+    """
+    Возвращает урл редиректа по атрибутам мета-тега (см. HeadMetaParser), если это refresh
+    """
+    if (attrs.get('http-equiv') or '').lower() == 'refresh' and attrs.get('content') is not None:
+        return get_meta_refresh_url(attrs['content'], url)
+
+
+def check_for_meta_in_head(content, url, max_bytes=META_HEAD_MAX_BYTES):
+    """
+    Ищет мета-редирект среди всех мета-тегов в <head> и возвращает урл редиректа.
+    Страница читается только до </head> (но не больше max_bytes),
+    если ее не удалось разобрать - используется check_for_meta
+    """
+    head = content[:max_bytes]
+    head_end = HEAD_END.search(head)
+    if head_end:
+        head = head[:head_end.start()]
+
+    parser = HeadMetaParser()
+    try:
+        parser.feed(head)
+    except (HTMLParseError, UnicodeError):
+        return check_for_meta(content, url)
+
+    for attrs in parser.metas:
+        meta_url = get_meta_attrs_refresh_url(attrs, url)
+        if meta_url:
+            return meta_url
+
+
+def find_meta_redirect(content, url, meta_parser=META_PARSER_BS4):
+    """Ищет мета-редирект выбранным парсером (META_PARSER_BS4 или META_PARSER_HEAD)"""
+    if meta_parser == META_PARSER_HEAD:
+        return check_for_meta_in_head(content, url)
+    return check_for_meta(content, url)
+
+
+class BodyBuffer(object):
+    """
+    Буфер тела ответа, передается в curl (WRITEDATA).
+    Тело пишется в буфер из пула (см. acquire_buffer), после запроса буфер возвращается в пул (close).
+
+    Если задан max_body, загрузка ответа с http-редиректом (Location) прерывается, как только тело
+    становится больше max_body байт, в буфере остается начало тела. Ответы без Location
+    (конечная страница или мета-редирект) загружаются целиком: на них ищутся счетчики.
+    При прерванной загрузке curl не заполняет REDIRECT_URL,
+    поэтому урл http-редиректа берется из заголовка Location (см. redirect_url).
+    """
+
+    def __init__(self, url, max_body=None):
+        self.url = url
+        self.max_body = max_body
+        self.buffer = acquire_buffer()
+        self.size = 0
+        self.http_redirect = False
+        self.location = None
+        self.aborted = False
+        self.truncated = False
+
+    @property
+    def content(self):
+        return self.buffer.getvalue() if self.buffer else ''
+
+    def close(self):
+        """Возвращает буфер в пул, содержимое после этого недоступно"""
+        if self.buffer:
+            release_buffer(self.buffer)
+            self.buffer = None
+
+    def getvalue(self):
+        return self.content
+
+    def exceeds_budget(self):
+        """Больше ли загруженное тело ответа с http-редиректом max_body"""
+        self.truncated = bool(self.max_body) and self.location is not None and self.size > self.max_body
+        return self.truncated
+
+    def write(self, data):
+        """WRITEFUNCTION: 0 прерывает загрузку"""
+        kept = self.size
+        self.size += len(data)
+        if self.exceeds_budget():
+            self.buffer.write(data[:self.max_body - kept])
+            self.aborted = True
+            return 0
+        self.buffer.write(data)
+
+    def redirect_url(self, curl):
+        """Урл http-редиректа ответа"""
+        if self.aborted and self.location:
+            return urljoin(self.url, to_unicode(self.location, 'ignore'))
+        return get_redirect_url(curl)
+
+    def header(self, line):
+        """HEADERFUNCTION: запоминает Location ответа с http-редиректом"""
+        if line.startswith('HTTP/'):
+            status = line.split(None, 2)[1:2]
+            self.http_redirect = bool(status) and status[0].startswith('3')
+            self.location = None
+        elif self.http_redirect and line.lower().startswith('location:'):
+            self.location = line.split(':', 1)[1].strip()
+
+
+class BodyScanner(BodyBuffer):
+    """
+    Потоковый разбор тела ответа, передается в curl вместо буфера (WRITEDATA).
+
+    По мере получения данных ищет мета-редирект (первый мета-тег страницы,
+    как check_for_meta, или все мета-теги в <head> для META_PARSER_HEAD)
+    и счетчики (как get_counters) и прерывает загрузку, как только ответ известен:
+    найден мета-редирект, пройден </head> у ответа с http-редиректом
+    или загружено больше max_body байт ответа с http-редиректом (см. BodyBuffer).
+    Пока мета-редирект не определен или если страницу не удалось разобрать, сохраняет тело целиком
+    (в нем ищет find_meta_redirect, см. handle_response), после - только первые keep_bytes байт.
+    """
+    OVERLAP = 256
+    """Сколько байт предыдущего куска учитывать при поиске на стыке кусков"""
+
+    def __init__(self, url, keep_bytes=64 * 1024, meta_parser=META_PARSER_BS4, max_body=None):
+        super(BodyScanner, self).__init__(url, max_body)
+        self.meta_parser = meta_parser
+        self.keep_bytes = keep_bytes
+        self.tail = ''
+        self.html_parser = HeadMetaParser()
+        self.meta_checked = False
+        self.meta_failed = False
+        self.meta_url = None
+        self.head_passed = False
+        self.found_counters = set()
+
+    @property
+    def counters(self):
+        return get_counter_names(self.found_counters)
+
+    def write(self, data):
+        """WRITEFUNCTION: 0 прерывает загрузку"""
+        kept = self.size
+        self.size += len(data)
+
+        window = self.tail + data
+        head_data = data
+        if not self.head_passed:
+            head_end = HEAD_END.search(window)
+            if head_end:
+                self.head_passed = True
+                head_data = data[:max(0, head_end.start() - len(self.tail))]
+        if not self.meta_checked:
+            if self.meta_parser == META_PARSER_HEAD:
+                self.scan_meta(head_data[:max(0, META_HEAD_MAX_BYTES - kept)])
+                if self.head_passed or self.size >= META_HEAD_MAX_BYTES:
+                    self.meta_checked = True
+            else:
+                self.scan_meta(data)
+        find_counters(window, self.found_counters)
+        self.tail = window[-self.OVERLAP:]
+        if self.meta_failed or not self.meta_checked:
+            self.buffer.write(data)
+        elif kept < self.keep_bytes:
+            self.buffer.write(data[:self.keep_bytes - kept])
+
+        if self.meta_url or (self.location and self.head_passed) or self.exceeds_budget():
+            self.aborted = True
+            return 0
+
+    def scan_meta(self, data):
+        """
+        Передает кусок тела в HTMLParser (он сам дожидается конца тега, комментария или скрипта,
+        поэтому мета-теги в комментариях, скриптах и стилях не учитываются, как и в find_meta_redirect).
+        Если страницу не удалось разобрать, мета-редирект ищется в сохраненном теле (см. handle_response)
+        """
+        try:
+            self.html_parser.feed(data)
+        except (HTMLParseError, UnicodeError):
+            self.meta_failed = True
+            self.meta_checked = True
+            return
+        metas = self.html_parser.metas
+        self.html_parser.metas = []
+        # check_for_meta смотрит только на первый мета-тег
+        if metas and self.meta_parser != META_PARSER_HEAD:
+            self.meta_checked = True
+            metas = metas[:1]
+        for attrs in metas:
+            self.meta_url = get_meta_attrs_refresh_url(attrs, self.url)
+            if self.meta_url:
+                self.meta_checked = True
+                return
 
 
 def fix_market_url(url):
@@ -77,42 +405,364 @@ def fix_market_url(url):
     return 'http://play.google.com/store/apps/' + url
 
 
-def make_pycurl_request(url, timeout, useragent=None):
-    """Делает http запрос (без перехода по редиректам)
-    Возвращает контент ответа и возможный редирект
-    :return: содержимое ответа, урл редиректа
+def market_rule_target(match):
+    return fix_market_url(match.string)
 
+
+BUILTIN_REDIRECT_RULES = (
+    # как раньше, по схеме урла: market://details и market:details
+    ('market', r'market:', market_rule_target, None),
+)
+"""Встроенные правила RedirectRules, правила из конфига добавляются после них"""
+
+redirect_rules = RedirectRules(BUILTIN_REDIRECT_RULES)
+"""Переходы, которые определяются по урлу без запроса (см. RedirectRules)"""
+
+
+def init_redirect_rules(rules=()):
+    """Задает правила переходов без запроса для текущего процесса (в дополнение к встроенным)"""
+    global redirect_rules
+    redirect_rules = RedirectRules(BUILTIN_REDIRECT_RULES + tuple(rules))
+    return redirect_rules
+
+
+def get_rule_hop(url):
+    """
+    :return: урл, тип редиректа и содержимое (None) по правилам redirect_rules или None
+    """
+    resolved = redirect_rules.resolve(url)
+    if resolved:
+        redirect_url, redirect_type = resolved
+        return prepare_url(urljoin(url, redirect_url)), redirect_type, None
+
+
+def get_rules_report():
+    """Срабатывания правил переходов для лога"""
+    return redirect_rules.report()
+
+
+def init_curl_pool(max_size, idle_timeout):
+    """Включает пул curl-хендлов для запросов текущего процесса"""
+    global curl_pool
+    if curl_pool is not None:
+        curl_pool.close()
+    curl_pool = CurlPool(max_size, idle_timeout)
+    return curl_pool
+
+
+def init_buffer_pool(max_buffers, buffer_size, max_buffer_size):
+    """Включает пул буферов для тел ответов текущего процесса"""
+    global buffer_pool
+    buffer_pool = BufferPool(max_buffers, buffer_size, max_buffer_size)
+    return buffer_pool
+
+
+def acquire_buffer():
+    return buffer_pool.acquire() if buffer_pool else ReceiveBuffer()
+
+
+def release_buffer(buff):
+    if buffer_pool:
+        buffer_pool.release(buff)
+
+
+def release_body(buff):
+    """Возвращает в пул буфер запроса (ReceiveBuffer или BodyBuffer)"""
+    if isinstance(buff, BodyBuffer):
+        buff.close()
+    else:
+        release_buffer(buff)
+
+
+def init_hop_cache(path, ttl, max_size):
+    """Включает кеш редиректов для запросов текущего процесса"""
+    global hop_cache
+    hop_cache = HopCache(path, ttl, max_size)
+    return hop_cache
+
+
+def get_hop_cache_report():
+    """Попадания и промахи кеша редиректов (всех процессов) для лога или None, если он не используется"""
+    if hop_cache is None:
+        return None
+    stats = hop_cache.stats()
+    return u'hits={} misses={}'.format(stats.get('hits', 0), stats.get('misses', 0))
+
+
+def get_cached_hop(url):
+    """
+    :return: урл, тип редиректа и содержимое (None) из кеша или None
+    """
+    if hop_cache:
+        cached = hop_cache.get(url)
+        if cached:
+            return cached[0], cached[1], None
+
+
+def cache_hop(url, result):
+    """Кеширует результат get_url, если это редирект"""
+    redirect_url, redirect_type, content = result
+    if hop_cache and redirect_url and redirect_type in (REDIRECT_HTTP, REDIRECT_META):
+        hop_cache.set(url, redirect_url, redirect_type)
+    return result
+
+
+def init_circuit_breaker(failure_threshold, reset_timeout):
+    """Включает пропуск запросов к недоступным хостам для текущего процесса"""
+    global circuit_breaker
+    circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout)
+    return circuit_breaker
+
+
+def init_singleflight(path=None, wait_timeout=30):
+    """
+    Включает объединение одновременных проверок одного урла для текущего процесса
+    (и между процессами, если задан path)
+    """
+    global singleflight
+    singleflight = SingleFlight(path, wait_timeout)
+    return singleflight
+
+
+def init_preflight(allow=(), deny=(), schemes=('http', 'https'), block_private=True, dns_ttl=300):
+    """Включает проверку урлов перед запросом для текущего процесса"""
+    global preflight
+    preflight = Preflight(allow, deny, schemes, block_private, dns_ttl)
+    return preflight
+
+
+def is_url_fetchable(url):
+    """
+    :return: False, если запрос урла заведомо не даст результата (см. Preflight)
+    """
+    reason = preflight.check(url) if preflight else None
+    if reason:
+        logger.error(u'url {} rejected before request: {}'.format(url, reason))
+        return False
+    return True
+
+
+def get_preflight_report():
+    """Счетчики Preflight для лога или None, если он не используется"""
+    return preflight.report() if preflight else None
+
+
+def get_host(url):
+    try:
+        return urlsplit(url).hostname
+    except ValueError:
+        return None
+
+
+def is_host_available(url):
+    """
+    :return: False, если запросы к хосту урла сейчас не делаются (см. CircuitBreaker)
+    """
+    host = get_host(url)
+    if circuit_breaker and host and not circuit_breaker.allow(host):
+        logger.error(u'host {} is unavailable, skip url {}'.format(host, url))
+        return False
+    return True
+
+
+def record_host_result(url, error=None):
+    """Учитывает результат запроса к хосту урла (error - ошибка pycurl)"""
+    host = get_host(url)
+    if circuit_breaker and host:
+        if error is None:
+            circuit_breaker.success(host)
+        else:
+            circuit_breaker.failure(host)
+
+
+def classify_error(error):
+    """
+    Класс ошибки запроса (от него зависит, когда перепроверять урл):
+    ERROR_PERMANENT - повторный запрос даст ту же ошибку, ERROR_CONNECT - сервер не принял соединение,
+    ERROR_TRANSIENT - остальные (таймауты, обрывы соединения и т.п.)
+    :param error: pycurl.error, ValueError или код ошибки curl
+    """
+    if isinstance(error, ValueError):
+        return ERROR_PERMANENT
+    code = error.args[0] if isinstance(error, pycurl.error) else error
+    if code in PERMANENT_CURL_ERRORS:
+        return ERROR_PERMANENT
+    if code in CONNECT_CURL_ERRORS:
+        return ERROR_CONNECT
+    return ERROR_TRANSIENT
+
+
+def head_error_needs_get(error):
+    """
+    Нужен ли обычный запрос после ошибки HEAD-запроса: сервер мог не поддержать HEAD.
+    Если хост недоступен, урл битый или время вышло, GET закончится той же ошибкой
+    :param error: pycurl.error или код ошибки curl
+    """
+    if isinstance(error, pycurl.error):
+        error = error.args[0] if error.args else None
+    return classify_error(error) == ERROR_TRANSIENT and error != pycurl.E_OPERATION_TIMEDOUT
+
+
+def error_hop(url, error_class, hop_info=None, content=None):
+    """Результат get_url для ошибки, класс ошибки записывается в hop_info['error']"""
+    if hop_info is not None:
+        hop_info['error'] = error_class
+    return url, 'ERROR', content
+
+
+def init_cooperative_curl(select):
+    """
+    make_pycurl_request будет ждать сокеты запроса функцией select (например, gevent.select.select),
+    а не блокироваться в curl.perform, - так запросы разных greenlet'ов процесса идут одновременно
+    """
+    global curl_select
+    curl_select = select
+
+
+def get_curl_multi():
+    """
+    CurlMulti процесса, создается при первом обращении и не закрывается:
+    соединения к хостам остаются открытыми для следующих запросов и пакетов
+    """
+    global curl_multi
+    if curl_multi is None:
+        curl_multi = pycurl.CurlMulti()
+    return curl_multi
+
+
+def perform_curl(curl):
+    """
+    curl.perform(); после init_cooperative_curl - через общий CurlMulti с ожиданием сокетов в curl_select.
+    Ошибки те же: pycurl.error(код, сообщение)
+    """
+    if curl_select is None:
+        curl.perform()
+        return
+    multi = get_curl_multi()
+    multi.add_handle(curl)
+    try:
+        while True:
+            while multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+                pass
+            # завершиться могли и запросы других greenlet'ов - они заберут результат после своего select
+            while True:
+                queued, ok_list, err_list = multi.info_read()
+                for done in ok_list:
+                    curl_results[done] = None
+                for done, errno, errmsg in err_list:
+                    curl_results[done] = (errno, errmsg)
+                if not queued:
+                    break
+            if curl in curl_results:
+                break
+            # пока нет сокетов (например, идет резолв), curl советует ждать 100 мс
+            select_timeout = multi.timeout()
+            read, write, _ = multi.fdset()
+            curl_select(read, write, [], min(select_timeout / 1000.0 if select_timeout >= 0 else 0.1, 1.0))
+    finally:
+        error = curl_results.pop(curl, None)
+        multi.remove_handle(curl)
+    if error:
+        raise pycurl.error(*error)
+
+
+def acquire_curl():
+    return curl_pool.acquire() if curl_pool else pycurl.Curl()
+
+
+def release_curl(curl):
+    if curl_pool:
+        curl_pool.release(curl)
+    else:
+        curl.close()
+
+
+def to_curl_timeout(timeout):
+    """Таймаут в миллисекундах для curl (0 у curl - без таймаута)"""
+    return max(1, int(timeout * 1000))
+
+
+def setup_curl(curl, url, timeout, useragent, buff, connect_timeout=None, encoding=None):
+    """
+    Настраивает curl-хендл на запрос урла (без перехода по редиректам)
+    :param encoding: какие сжатия ответа запрашивать (Accept-Encoding), ответ распаковывается curl,
+    '' - все поддерживаемые, None - не запрашивать
     """
     prepared_url = to_str(prepare_url(url), 'ignore')
-    buff = StringIO()
-    curl = pycurl.Curl()
     curl.setopt(curl.URL, prepared_url)
     if useragent:
         curl.setopt(curl.USERAGENT, useragent)
     curl.setopt(curl.WRITEDATA, buff)
     curl.setopt(curl.FOLLOWLOCATION, False)
-    # curl.setopt(curl.CONNECTTIMEOUT, timeout)
-    curl.setopt(curl.TIMEOUT, timeout)
-    curl.perform()
-    content = buff.getvalue()
+    if connect_timeout:
+        curl.setopt(curl.CONNECTTIMEOUT_MS, to_curl_timeout(min(connect_timeout, timeout)))
+    curl.setopt(curl.TIMEOUT_MS, to_curl_timeout(timeout))
+    if encoding is not None:
+        curl.setopt(curl.ENCODING, encoding)
+
+
+def get_redirect_url(curl):
+    """Возвращает урл редиректа из выполненного curl-запроса"""
     redirect_url = curl.getinfo(curl.REDIRECT_URL)
-    curl.close()
     if redirect_url is not None:
         redirect_url = to_unicode(redirect_url, 'ignore')
-    return content, redirect_url
+    return redirect_url
 
 
-def get_url(url, timeout, user_agent=None):
+def read_hop_info(curl, hop_info=None, body_size=None):
     """
-    :return: урл, тип редиректа, содержимое страницы (если есть)
+    Учитывает времена запроса в метриках процесса и добавляет их в hop_info (если передан)
+    :param body_size: размер полученного тела после распаковки
     """
-    content = None
+    info = get_hop_info(curl)
+    info['body_size'] = body_size
+    hop_metrics.observe(info)
+    if hop_info is not None:
+        hop_info.update(info)
+
+
+def make_pycurl_request(url, timeout, useragent=None, scanner=None, connect_timeout=None, hop_info=None,
+                        max_body=None, head=False, encoding=None):
+    """Делает http запрос (без перехода по редиректам)
+    Возвращает контент ответа и возможный редирект
+    Если передан scanner (BodyScanner), тело разбирается потоково
+    :param connect_timeout: таймаут на установку соединения
+    :param hop_info: словарь, в который добавляются времена этапов запроса (см. metrics.HOP_INFO)
+    :param max_body: сколько байт тела ответа с http-редиректом загружать (без scanner, см. BodyBuffer)
+    :param head: сделать HEAD-запрос (контент будет пустым)
+    :param encoding: запрашиваемые сжатия ответа (см. setup_curl)
+    :return: содержимое ответа, урл редиректа
+
+    """
+    body = scanner or (BodyBuffer(url, max_body) if max_body and not head else None)
+    buff = body or acquire_buffer()
+    curl = acquire_curl()
     try:
-        content, new_redirect_url = make_pycurl_request(url, timeout, user_agent)
-    except (pycurl.error, ValueError) as e:
-        logger.error(u'error in url {} {}'.format(url, e))
-        return url, 'ERROR', content  # TODO add exception in ERROR
+        setup_curl(curl, url, timeout, useragent, buff, connect_timeout, encoding)
+        if body:
+            curl.setopt(curl.HEADERFUNCTION, body.header)
+        if head:
+            curl.setopt(curl.NOBODY, True)
+        try:
+            perform_curl(curl)
+        except pycurl.error:
+            if not (body and body.aborted):
+                raise
+        finally:
+            read_hop_info(curl, hop_info, body.size if body else buff.tell())
+        content = body.content if body else buff.getvalue()
+        redirect_url = body.redirect_url(curl) if body else get_redirect_url(curl)
+    finally:
+        release_curl(curl)
+        release_body(buff)
+    return content, redirect_url
 
+
+def handle_response(url, content, new_redirect_url, scanner=None, meta_parser=META_PARSER_BS4):
+    """
+    Определяет следующий урл цепочки по ответу на запрос url
+    :return: урл, тип редиректа, содержимое страницы (если есть)
+    """
     redirect_type = None
 
     # ignoring ok login redirects
@@ -122,17 +772,181 @@ def get_url(url, timeout, user_agent=None):
     if new_redirect_url:
         redirect_type = REDIRECT_HTTP
     else:
-        new_redirect_url = check_for_meta(content, url)
+        if scanner and not scanner.meta_failed:
+            new_redirect_url = scanner.meta_url
+        else:
+            new_redirect_url = find_meta_redirect(content, url, meta_parser)
         if new_redirect_url:
             redirect_type = REDIRECT_META
 
-    if new_redirect_url and urlsplit(new_redirect_url).scheme == 'market':
-        new_redirect_url = fix_market_url(new_redirect_url)
+    if new_redirect_url:
+        new_redirect_url = redirect_rules.rewrite(new_redirect_url)
 
     return prepare_url(new_redirect_url), redirect_type, content
 
 
-def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
+def probe_head(url, timeout, user_agent=None, connect_timeout=None, hop_info=None):
+    """
+    HEAD-запрос урла
+    :return: урл http-редиректа или None, если нужен обычный запрос
+    (нет редиректа, сервер не поддерживает HEAD, редирект на логин в ok)
+    :raise pycurl.error: ошибка, после которой обычный запрос не нужен (см. head_error_needs_get)
+    """
+    try:
+        content, redirect_url = make_pycurl_request(
+            url, timeout, user_agent, connect_timeout=connect_timeout, hop_info=hop_info, head=True
+        )
+    except (pycurl.error, ValueError) as e:
+        if isinstance(e, pycurl.error) and not head_error_needs_get(e):
+            raise
+        logger.debug(u'HEAD failed on url {} {}'.format(url, e))
+        return None
+    if redirect_url and OK_REDIRECT.match(redirect_url):
+        return None
+    return redirect_url
+
+
+def get_url(url, timeout, user_agent=None, scanner=None, meta_parser=META_PARSER_BS4, connect_timeout=None,
+            hop_info=None, max_body=None, head_first=False, encoding=None):
+    """
+    :param scanner: BodyScanner для потокового разбора ответа
+    :param meta_parser: парсер мета-редиректов (см. find_meta_redirect)
+    :param connect_timeout: таймаут на установку соединения
+    :param hop_info: словарь для времен этапов запроса (см. make_pycurl_request)
+    :param max_body: ограничение размера загружаемого тела (см. make_pycurl_request)
+    :param head_first: сначала сделать HEAD-запрос, тело загружается, только если он не вернул http-редирект;
+    оба запроса укладываются в timeout
+    :param encoding: запрашиваемые сжатия ответа (см. setup_curl)
+    :return: урл, тип редиректа, содержимое страницы (если есть);
+    при ошибке в hop_info['error'] записывается ее класс (см. classify_error)
+    """
+    ruled = get_rule_hop(url)
+    if ruled:
+        return ruled
+
+    cached = get_cached_hop(url)
+    if cached:
+        return cached
+
+    if not is_url_fetchable(url):
+        return error_hop(url, ERROR_PERMANENT, hop_info)
+    if not is_host_available(url):
+        return error_hop(url, ERROR_TRANSIENT, hop_info)
+
+    content = None
+    try:
+        if head_first:
+            head_started = time.time()
+            new_redirect_url = probe_head(url, timeout, user_agent, connect_timeout, hop_info)
+            if new_redirect_url:
+                record_host_result(url)
+                return cache_hop(url, handle_response(url, None, new_redirect_url, meta_parser=meta_parser))
+            # обычному запросу остается время, не потраченное на HEAD
+            timeout -= time.time() - head_started
+            if timeout <= 0:
+                logger.error(u'no time left after HEAD on url {}'.format(url))
+                return error_hop(url, ERROR_TRANSIENT, hop_info)
+        content, new_redirect_url = make_pycurl_request(
+            url, timeout, user_agent, scanner=scanner, connect_timeout=connect_timeout, hop_info=hop_info,
+            max_body=max_body, encoding=encoding
+        )
+    except (pycurl.error, ValueError) as e:
+        logger.error(u'error in url {} {}'.format(url, e))
+        if isinstance(e, pycurl.error):
+            record_host_result(url, e)
+        return error_hop(url, classify_error(e), hop_info, content)
+    record_host_result(url)
+
+    return cache_hop(url, handle_response(url, content, new_redirect_url, scanner, meta_parser))
+
+
+class RedirectHistory(object):
+    """
+    История редиректов одного урла
+    """
+    __slots__ = ('max_redirects', 'deadline', 'started_at', 'types', 'urls', 'seen', 'content', 'counters',
+                 'finished', 'error')
+
+    def __init__(self, url, max_redirects=30, deadline=None):
+        """
+        :param deadline: сколько секунд отводится на всю цепочку (None - без ограничения)
+        """
+        self.max_redirects = max_redirects
+        self.deadline = deadline
+        self.started_at = None
+        self.types = []
+        self.urls = [url]
+        # урлы цепочки для поиска циклов
+        self.seen = {url}
+        self.content = None
+        self.counters = None
+        self.finished = False
+        # класс ошибки, которой закончилась проверка (см. classify_error)
+        self.error = None
+
+    @property
+    def current_url(self):
+        """Урл, который нужно запросить следующим"""
+        return self.urls[-1]
+
+    def hop_timeout(self, timeout):
+        """
+        Таймаут запроса текущего урла: не больше timeout и оставшегося на цепочку времени
+        (отсчет начинается с первого запроса)
+        """
+        if self.deadline is None:
+            return timeout
+        if self.started_at is None:
+            self.started_at = time.time()
+        return min(timeout, self.started_at + self.deadline - time.time())
+
+    def add_deadline_error(self):
+        """Завершает проверку ошибкой: время на цепочку вышло"""
+        logger.error(u'chain deadline exceeded on url {}'.format(self.current_url))
+        return self.add(self.current_url, 'ERROR', None, error=ERROR_TRANSIENT)
+
+    def add(self, redirect_url, redirect_type, content, counters=None, error=None):
+        """
+        Добавляет в историю результат запроса текущего урла (см. get_url)
+        :param counters: счетчики, уже найденные на странице (см. BodyScanner)
+        :param error: класс ошибки запроса (для redirect_type ERROR)
+        :return: нужно ли продолжать проверку
+        """
+        self.content = content
+        self.error = error
+        self.counters = counters if content is not None else None
+        if redirect_url:
+            self.types.append(redirect_type)
+            self.urls.append(redirect_url)
+            self.finished = (
+                redirect_type == 'ERROR' or
+                len(self.urls) > self.max_redirects or
+                redirect_url in self.seen
+            )
+            self.seen.add(redirect_url)
+        else:
+            self.finished = True
+        return not self.finished
+
+    def result(self):
+        """
+        :return: типы редиректов, урлы редиректов, счетчики на конечном урле
+        """
+        if self.counters is not None:
+            counters = self.counters
+        else:
+            counters = get_counters(self.content) if self.content else []
+        return self.types, self.urls, counters
+
+
+def is_ignored_url(url):
+    """Урлы mm / ok не проверяются"""
+    return bool(re.match(MM_URL, url) or re.match(OK_URL, url))
+
+
+def get_redirect_history(url, timeout, max_redirects=30, user_agent=None, stream=False,
+                         meta_parser=META_PARSER_BS4, deadline=None, connect_timeout=None, timings=None,
+                         max_body=None, head_first=False, encoding=None, errors=None):
     """
     Входные параметры:
 
@@ -140,7 +954,19 @@ def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
     + timeout - таймаут на проверку *одного* урла
     + max_redirects - максимальное количество редиректов, после превышения проверка останавливается
     + user_agent - юзер-агент, если не передает, то будет дефолтный из pycurl
-
+    + stream - разбирать ответы потоково (см. BodyScanner), не дожидаясь загрузки всего тела
+    + meta_parser - парсер мета-редиректов: META_PARSER_BS4 (первый мета-тег страницы)
+      или META_PARSER_HEAD (все мета-теги в <head>)
+    + deadline - таймаут на проверку всей цепочки, каждый запрос получает оставшееся время
+    + connect_timeout - таймаут на установку соединения
+    + timings - список, в который добавляются времена этапов каждого сделанного запроса
+      (словари из make_pycurl_request с урлом запроса в поле url)
+    + max_body - сколько байт тела ответа с http-редиректом загружать, загрузка больших тел прерывается
+      (ответы без Location загружаются целиком, счетчики на конечном урле ищутся во всем теле)
+    + head_first - сначала делать HEAD-запрос, тело загружается, только если http-редиректа нет
+    + encoding - запрашиваемые сжатия ответа (Accept-Encoding), ответы распаковываются curl
+    + errors - список, в который добавляется класс ошибки, которой закончилась проверка
+      (см. classify_error, None - без ошибки)
 
     Выходные параметры:
     Массив из трех элементов
@@ -151,42 +977,294 @@ def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
 
     """
     url = prepare_url(url)
-    history_types = []
-    history_urls = [url]
-    redirect_url = url
+    history = RedirectHistory(url, max_redirects, deadline)
 
     # ignore mm / ok domains
-    if re.match(MM_URL, url) or re.match(OK_URL, url):
-        return history_types, history_urls, []
+    if is_ignored_url(url):
+        return history.result()
 
-    content = None
     while True:
-        redirect_url, redirect_type, content = get_url(
-            url=redirect_url,
-            timeout=timeout,
-            user_agent=user_agent
-        )
-        if not redirect_url:
+        hop_timeout = history.hop_timeout(timeout)
+        if hop_timeout <= 0:
+            history.add_deadline_error()
+            break
+        scanner = BodyScanner(history.current_url, meta_parser=meta_parser, max_body=max_body) if stream else None
+        hop_info = {'url': history.current_url}
+        try:
+            redirect_url, redirect_type, content = get_url(
+                url=history.current_url,
+                timeout=hop_timeout,
+                user_agent=user_agent,
+                scanner=scanner,
+                meta_parser=meta_parser,
+                connect_timeout=connect_timeout,
+                hop_info=hop_info,
+                max_body=max_body,
+                head_first=head_first,
+                encoding=encoding
+            )
+        finally:
+            # get_url мог обойтись без запроса (правило, кеш, HEAD) и не вернуть буфер сканера в пул
+            if scanner:
+                scanner.close()
+        error = hop_info.pop('error', None)
+        # запрос мог не понадобиться (кеш, недоступный хост)
+        if timings is not None and len(hop_info) > 1:
+            timings.append(hop_info)
+        if not history.add(redirect_url, redirect_type, content, scanner and scanner.counters, error):
             break
 
-        history_types.append(redirect_type)
-        history_urls.append(redirect_url)
+    if errors is not None:
+        errors.append(history.error)
+    return history.result()
 
-        if redirect_type == 'ERROR':
-            break
 
-        if len(history_urls) > max_redirects or (redirect_url in history_urls[:-1]):
-            break
+def get_redirect_histories(urls, timeout, max_redirects=30, user_agent=None, concurrency=50, stream=False,
+                           meta_parser=META_PARSER_BS4, deadline=None, connect_timeout=None, timings=None,
+                           max_body=None, head_first=False, encoding=None, errors=None):
+    """
+    Получает историю редиректов сразу для нескольких урлов.
 
-    counters = get_counters(content) if content else []
+    Цепочки проверяются параллельно в одном процессе через общий CurlMulti (см. get_curl_multi),
+    одновременно выполняется не больше concurrency запросов.
+    Параметры те же, что и у get_redirect_history, в timings добавляется
+    по списку времен запросов на каждый входной урл, в errors - по классу ошибки.
+
+    :return: список результатов get_redirect_history в порядке входных урлов
+    """
+    histories = []
+    unique = {}
+    pending = deque()
+    for url in urls:
+        url = prepare_url(url)
+        # одинаковые урлы проверяются один раз
+        history = unique.get(url)
+        if history is None:
+            history = unique[url] = RedirectHistory(url, max_redirects, deadline)
+            if not is_ignored_url(url):
+                pending.append(history)
+        histories.append(history)
+
+    hop_timings = {}
+    needs_body = set()
+    # когда начался HEAD-запрос цепочки: обычному запросу после него остается только оставшееся время
+    head_started = {}
+    multi = get_curl_multi()
+    free_handles = [acquire_curl() for _ in xrange(min(concurrency, len(pending)))]
+    handles = list(free_handles)
+    active = {}
+
+    def finish(curl, error, errno=None):
+        multi.remove_handle(curl)
+        history, buff, head = active.pop(curl)
+        free_handles.append(curl)
+        url = history.current_url
+        hop_info = {'url': url}
+        read_hop_info(curl, hop_info, buff.size if isinstance(buff, BodyBuffer) else buff.tell())
+        hop_timings.setdefault(history, []).append(hop_info)
+        if head:
+            release_body(buff)
+            redirect_url = get_redirect_url(curl) if error is None else None
+            if error is not None and not head_error_needs_get(errno):
+                head_started.pop(history, None)
+                logger.error(u'error in url {} {}'.format(url, error))
+                record_host_result(url, error)
+                error_class = classify_error(errno)
+                history.add(*error_hop(url, error_class), error=error_class)
+            elif redirect_url and not OK_REDIRECT.match(redirect_url):
+                head_started.pop(history, None)
+                record_host_result(url)
+                if history.add(*cache_hop(url, handle_response(url, None, redirect_url, meta_parser=meta_parser))):
+                    pending.append(history)
+            else:
+                # без http-редиректа нужен обычный запрос
+                needs_body.add(history)
+                pending.appendleft(history)
+            return
+
+        needs_body.discard(history)
+        scanner = buff if stream else None
+        body = buff if isinstance(buff, BodyBuffer) else None
+        if error is None or (body and body.aborted):
+            record_host_result(url)
+            if body:
+                content, redirect_url = body.content, body.redirect_url(curl)
+            else:
+                content, redirect_url = buff.getvalue(), get_redirect_url(curl)
+            result = cache_hop(url, handle_response(url, content, redirect_url, scanner, meta_parser))
+        else:
+            logger.error(u'error in url {} {}'.format(url, error))
+            record_host_result(url, error)
+            result = error_hop(url, classify_error(errno), hop_info)
+        release_body(buff)
+        if history.add(*result, counters=scanner and scanner.counters, error=hop_info.pop('error', None)):
+            pending.append(history)
+
+    try:
+        while pending or active:
+            while pending and free_handles:
+                history = pending.popleft()
+                cached = get_rule_hop(history.current_url) or get_cached_hop(history.current_url)
+                if cached:
+                    if history.add(*cached):
+                        pending.append(history)
+                    continue  # pragma: no cover (оптимизатор байткода python 2 убирает эту строку из трассировки)
+                if not is_url_fetchable(history.current_url):
+                    history.add(history.current_url, 'ERROR', None, error=ERROR_PERMANENT)
+                    continue
+                if not is_host_available(history.current_url):
+                    history.add(history.current_url, 'ERROR', None, error=ERROR_TRANSIENT)
+                    continue
+                hop_timeout = history.hop_timeout(timeout)
+                if hop_timeout <= 0:
+                    history.add_deadline_error()
+                    continue
+                if history in head_started:
+                    hop_timeout = min(hop_timeout, timeout - (time.time() - head_started.pop(history)))
+                    if hop_timeout <= 0:
+                        logger.error(u'no time left after HEAD on url {}'.format(history.current_url))
+                        history.add(history.current_url, 'ERROR', None, error=ERROR_TRANSIENT)
+                        continue
+                head = head_first and history not in needs_body
+                if head:
+                    head_started[history] = time.time()
+                curl = free_handles.pop()
+                curl.reset()
+                if head:
+                    buff = acquire_buffer()
+                elif stream:
+                    buff = BodyScanner(history.current_url, meta_parser=meta_parser, max_body=max_body)
+                elif max_body:
+                    buff = BodyBuffer(history.current_url, max_body)
+                else:
+                    buff = acquire_buffer()
+                try:
+                    setup_curl(curl, history.current_url, hop_timeout, user_agent, buff, connect_timeout, encoding)
+                    if isinstance(buff, BodyBuffer):
+                        curl.setopt(curl.HEADERFUNCTION, buff.header)
+                    if head:
+                        curl.setopt(curl.NOBODY, True)
+                except (pycurl.error, ValueError) as e:
+                    free_handles.append(curl)
+                    release_body(buff)
+                    logger.error(u'error in url {} {}'.format(history.current_url, e))
+                    history.add(history.current_url, 'ERROR', None, error=classify_error(e))
+                    continue
+                active[curl] = (history, buff, head)
+                multi.add_handle(curl)
+
+            while multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+                pass
+
+            while True:
+                queued, ok_list, err_list = multi.info_read()
+                for curl in ok_list:
+                    finish(curl, None)
+                for curl, errno, errmsg in err_list:
+                    finish(curl, errmsg, errno)
+                if not queued:
+                    break
+
+            if active:
+                select_timeout = multi.timeout()
+                multi.select(select_timeout / 1000.0 if 0 <= select_timeout < 1000 else 1.0)
+    finally:
+        for curl, (history, buff, head) in active.items():
+            multi.remove_handle(curl)
+            release_body(buff)
+        for curl in handles:
+            release_curl(curl)
+
+    if timings is not None:
+        timings.extend(list(hop_timings.get(history, [])) for history in histories)
+    if errors is not None:
+        errors.extend(history.error for history in histories)
+    return [copy_history_result(history.result()) for history in histories]
+
+
+def copy_history_result(result):
+    """Копия результата get_redirect_history, чтобы у каждой задачи был свой"""
+    return tuple(list(part) for part in result)
+
+
+def encode_history_result(result, encoding=RESULT_ENCODING_PLAIN):
+    """
+    Результат get_redirect_history для выходной очереди.
+
+    RESULT_ENCODING_PLAIN - список [типы редиректов, урлы, счетчики].
+    RESULT_ENCODING_COMPACT - словарь {"t": коды типов одной строкой, "u": урлы, "c": счетчики},
+    урл, который начинается так же, как предыдущий, записывается парой [длина общего начала, остаток]
+    (см. decode_history_result).
+    """
+    types, urls, counters = result
+    if encoding == RESULT_ENCODING_PLAIN:
+        return [types, urls, counters]
+    if encoding != RESULT_ENCODING_COMPACT:
+        raise ValueError(u'unknown result encoding {}'.format(encoding))
+
+    encoded_urls = []
+    previous = u''
+    for url in urls:
+        common = len(commonprefix((previous, url)))
+        encoded_urls.append([common, url[common:]] if common >= COMPACT_URL_MIN_PREFIX else url)
+        previous = url
+    return {
+        't': ''.join(REDIRECT_TYPE_CODES[redirect_type] for redirect_type in types),
+        'u': encoded_urls,
+        'c': counters,
+    }
+
+
+def decode_history_result(data):
+    """
+    :return: [типы редиректов, урлы, счетчики] из результата encode_history_result в любом формате
+    """
+    if not isinstance(data, dict):
+        return list(data)
+
+    types = [REDIRECT_TYPES_BY_CODE[code] for code in data['t']]
+    urls = []
+    for url in data['u']:
+        if isinstance(url, list):
+            common, rest = url
+            url = urls[-1][:common] + rest
+        urls.append(url)
+    return [types, urls, data['c']]
 
-    return history_types, history_urls, counters
+
+def get_coalesced_redirect_history(url, timeout, max_redirects=30, user_agent=None, **options):
+    """
+    get_redirect_history, в котором одновременные проверки одного урла
+    (после нормализации) ждут одну общую цепочку запросов.
+    Параметры те же, что и у get_redirect_history.
+    """
+    if singleflight is None:
+        return get_redirect_history(url, timeout, max_redirects, user_agent, **options)
+    key = u'{} {} {}'.format(prepare_url(url), max_redirects, to_unicode(user_agent or u'', 'ignore'))
+    result = singleflight.do(key, get_redirect_history, url, timeout, max_redirects, user_agent, **options)
+    return copy_history_result(result)
 
 
 def prepare_url(url):
     """Нормализация урла"""
     if url is None:
         return url
+    prepared = prepared_urls.get(url)
+    if prepared is not None:
+        return prepared
+
+    if isinstance(url, basestring) and NORMALIZED_URL.match(url):
+        prepared = to_unicode(url)
+    else:
+        prepared = normalize_url(url)
+
+    if len(prepared_urls) >= PREPARED_URLS_CACHE_SIZE:
+        prepared_urls.clear()
+    prepared_urls[url] = prepared
+    return prepared
+
+
+def normalize_url(url):
     scheme, netloc, path, qs, anchor, fragments = urlparse(
         to_unicode(url),
         allow_fragments=False
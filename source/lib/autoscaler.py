@@ -0,0 +1,118 @@
+# coding: utf-8
+import math
+from multiprocessing import cpu_count
+import os
+import time
+
+
+def get_load_per_cpu():
+    """:return: load average за минуту на ядро или None"""
+    try:
+        return os.getloadavg()[0] / cpu_count()
+    except (OSError, NotImplementedError):
+        return None
+
+
+def get_free_memory(path='/proc/meminfo'):
+    """:return: доступная память хоста в байтах (MemAvailable) или None"""
+    try:
+        with open(path) as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+class AutoScaler(object):
+    """
+    Размер пула воркеров по очереди задач.
+
+    Пул растет, когда готовых задач больше scale_up_backlog на воркер: на столько воркеров,
+    чтобы при текущей пропускной способности воркера очередь разобралась за drain_time секунд,
+    но не больше чем на max_step за раз. Пропускная способность считается по приросту
+    задач, подтвержденных (ack) воркерами этого хоста, между проверками: счетчик ack очереди
+    общий для всех хостов, по нему каждый хост считал бы своим весь поток задач.
+    Пул уменьшается на один воркер, когда готовых задач не больше scale_down_backlog на воркер
+    idle_checks проверок подряд. После изменения размера следующее увеличение делается
+    не раньше чем через up_cooldown секунд, уменьшение - через down_cooldown.
+    Пул не растет, пока load average на ядро больше max_load или свободной памяти
+    меньше min_free_memory байт (None - не проверять).
+    """
+
+    def __init__(self, min_workers, max_workers, scale_up_backlog=10, scale_down_backlog=1, drain_time=60,
+                 max_step=4, idle_checks=3, up_cooldown=30, down_cooldown=120, max_load=None,
+                 min_free_memory=None):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.scale_up_backlog = scale_up_backlog
+        self.scale_down_backlog = scale_down_backlog
+        self.drain_time = drain_time
+        self.max_step = max_step
+        self.idle_checks = idle_checks
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.max_load = max_load
+        self.min_free_memory = min_free_memory
+        self.idle = 0
+        self.changed_at = None
+        self.last_sample = None
+        self.worker_rate = None
+
+    def update_rate(self, workers, acked, now):
+        """Пропускная способность одного воркера (задач в секунду) по приросту acked"""
+        if self.last_sample and workers:
+            last_acked, last_time = self.last_sample
+            if now > last_time and acked >= last_acked:
+                self.worker_rate = float(acked - last_acked) / (now - last_time) / workers
+        self.last_sample = (acked, now)
+
+    def has_headroom(self):
+        if self.max_load is not None:
+            load = get_load_per_cpu()
+            if load is not None and load > self.max_load:
+                return False
+        if self.min_free_memory is not None:
+            free = get_free_memory()
+            if free is not None and free < self.min_free_memory:
+                return False
+        return True
+
+    def cooled_down(self, cooldown, now):
+        return self.changed_at is None or now - self.changed_at >= cooldown
+
+    def get_pool_size(self, workers, ready, acked, now=None):
+        """
+        :param workers: сколько воркеров работает
+        :param ready: готовых задач в очереди
+        :param acked: подтвержденных воркерами этого хоста задач всего
+        :return: сколько воркеров должно работать
+        """
+        now = time.time() if now is None else now
+        self.update_rate(workers, acked, now)
+        # упавшие воркеры восстанавливаются сразу
+        if workers < self.min_workers or workers > self.max_workers:
+            return min(max(workers, self.min_workers), self.max_workers)
+
+        size = workers
+        if ready > self.scale_up_backlog * workers:
+            self.idle = 0
+            if workers < self.max_workers and self.cooled_down(self.up_cooldown, now) and self.has_headroom():
+                if self.worker_rate:
+                    needed = int(math.ceil(ready / (self.worker_rate * self.drain_time)))
+                else:
+                    needed = workers + 1
+                size = min(max(needed, workers + 1), workers + self.max_step, self.max_workers)
+        elif ready <= self.scale_down_backlog * workers:
+            self.idle += 1
+            if self.idle >= self.idle_checks and workers > self.min_workers and \
+                    self.cooled_down(self.down_cooldown, now):
+                size = workers - 1
+                self.idle = 0
+        else:
+            self.idle = 0
+
+        if size != workers:
+            self.changed_at = now
+        return size
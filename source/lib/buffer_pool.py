@@ -0,0 +1,72 @@
+# coding: utf-8
+
+
+class ReceiveBuffer(object):
+    """
+    Буфер тела ответа на bytearray с заранее выделенной памятью.
+
+    Пишется как StringIO (write/tell/getvalue), reset не освобождает память,
+    поэтому буфер можно использовать для следующего запроса без новых выделений.
+    """
+
+    def __init__(self, capacity=0):
+        self.data = bytearray(capacity)
+        self.size = 0
+
+    @property
+    def capacity(self):
+        return len(self.data)
+
+    def write(self, chunk):
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf8')
+        end = self.size + len(chunk)
+        # в пределах выделенного - копирование на место, дальше bytearray растет сам
+        self.data[self.size:end] = chunk
+        self.size = end
+
+    def tell(self):
+        return self.size
+
+    def view(self):
+        """Записанные данные без копирования (действует до следующей записи и reset)"""
+        return memoryview(self.data)[:self.size]
+
+    def getvalue(self):
+        return self.view().tobytes()
+
+    def reset(self):
+        self.size = 0
+
+
+class BufferPool(object):
+    """
+    Пул буферов ReceiveBuffer процесса.
+
+    Хранится не больше max_buffers свободных буферов по buffer_size байт.
+    Буферы, выросшие больше max_buffer_size, в пул не возвращаются:
+    их память освобождается (большие блоки malloc отдает системе сразу).
+    """
+
+    def __init__(self, max_buffers=8, buffer_size=64 * 1024, max_buffer_size=1024 * 1024):
+        self.max_buffers = max_buffers
+        self.buffer_size = buffer_size
+        self.max_buffer_size = max_buffer_size
+        self.free = []
+        self.allocated = 0
+        self.reused = 0
+        self.dropped = 0
+
+    def acquire(self):
+        if self.free:
+            self.reused += 1
+            return self.free.pop()
+        self.allocated += 1
+        return ReceiveBuffer(self.buffer_size)
+
+    def release(self, buff):
+        if buff.capacity > self.max_buffer_size or len(self.free) >= self.max_buffers:
+            self.dropped += 1
+            return
+        buff.reset()
+        self.free.append(buff)
@@ -0,0 +1,62 @@
+# coding: utf-8
+from collections import OrderedDict
+import time
+
+
+class HostState(object):
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+
+
+class CircuitBreaker(object):
+    """
+    Отслеживает ошибки запросов по хостам.
+
+    После failure_threshold ошибок подряд хост считается недоступным ("цепь разомкнута"):
+    запросы к нему сразу завершаются ошибкой. Через reset_timeout секунд пропускается
+    пробный запрос: успех возвращает хост в работу, ошибка снова размыкает цепь.
+    Хранится не больше max_hosts хостов, давно не обновлявшиеся забываются первыми.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60, max_hosts=10000):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_hosts = max_hosts
+        self.hosts = OrderedDict()
+        self.short_circuited = 0
+
+    def is_open(self, state):
+        return state is not None and state.failures >= self.failure_threshold
+
+    def allow(self, host):
+        """
+        :return: можно ли делать запрос к хосту
+        """
+        state = self.hosts.get(host)
+        if not self.is_open(state):
+            return True
+
+        now = time.time()
+        probe_due = now - state.opened_at >= self.reset_timeout
+        probe_stuck = state.probe_started_at is not None and now - state.probe_started_at >= self.reset_timeout
+        if probe_due and (state.probe_started_at is None or probe_stuck):
+            state.probe_started_at = now
+            return True
+
+        self.short_circuited += 1
+        return False
+
+    def success(self, host):
+        self.hosts.pop(host, None)
+
+    def failure(self, host):
+        state = self.hosts.pop(host, None) or HostState()
+        self.hosts[host] = state
+        state.failures += 1
+        if self.is_open(state):
+            state.opened_at = time.time()
+            state.probe_started_at = None
+        while len(self.hosts) > self.max_hosts:
+            self.hosts.popitem(last=False)
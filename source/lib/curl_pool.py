@@ -0,0 +1,71 @@
+# coding: utf-8
+from threading import Lock
+import time
+
+import pycurl
+
+SHARED_DATA = tuple(
+    lock_data for lock_data in (
+        pycurl.LOCK_DATA_DNS,
+        pycurl.LOCK_DATA_SSL_SESSION,
+        # появился в более новых версиях pycurl
+        getattr(pycurl, 'LOCK_DATA_CONNECT', None),
+    ) if lock_data is not None
+)
+
+
+class CurlPool(object):
+    """
+    Пул переиспользуемых curl-хендлов процесса.
+
+    Хендлы подключены к общему pycurl.CurlShare (кеш DNS, TLS-сессии,
+    соединения - если поддерживается), а каждый хендл при возврате в пул
+    сохраняет свои keep-alive соединения. Хендлы выдаются начиная с последнего
+    возвращенного, поэтому "теплые" соединения используются в первую очередь.
+    """
+
+    def __init__(self, max_size=10, idle_timeout=60):
+        """
+        :param max_size: сколько свободных хендлов держать в пуле
+        :param idle_timeout: через сколько секунд простоя хендл закрывается
+        """
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.share = pycurl.CurlShare()
+        for lock_data in SHARED_DATA:
+            self.share.setopt(pycurl.SH_SHARE, lock_data)
+        self.idle = []
+        self.lock = Lock()
+
+    def acquire(self):
+        """Возвращает готовый к настройке хендл"""
+        with self.lock:
+            self.evict_idle()
+            curl = self.idle.pop()[0] if self.idle else None
+        if curl is None:
+            curl = pycurl.Curl()
+            curl.setopt(pycurl.SHARE, self.share)
+        else:
+            # reset сохраняет соединения хендла и подключенный CurlShare
+            curl.reset()
+        return curl
+
+    def release(self, curl):
+        """Возвращает хендл в пул (или закрывает, если пул заполнен)"""
+        with self.lock:
+            if len(self.idle) < self.max_size:
+                self.idle.append((curl, time.time()))
+                return
+        curl.close()
+
+    def evict_idle(self):
+        """Закрывает хендлы, простаивающие дольше idle_timeout"""
+        deadline = time.time() - self.idle_timeout
+        while self.idle and self.idle[0][1] < deadline:
+            self.idle.pop(0)[0].close()
+
+    def close(self):
+        with self.lock:
+            while self.idle:
+                self.idle.pop()[0].close()
+        self.share.close()
@@ -0,0 +1,119 @@
+# coding: utf-8
+from logging import getLogger
+import os
+import sqlite3
+import time
+
+logger = getLogger('redirect_checker')
+
+
+class HopCache(object):
+    """
+    Кеш результатов запросов урлов: урл -> (следующий урл, тип редиректа).
+
+    Хранится в sqlite-файле и общий для всех процессов-воркеров.
+    У записей есть время жизни (ttl), при превышении max_size
+    удаляются записи, которые дольше всего не использовались.
+    Счетчики попаданий/промахов копятся в процессе и каждые
+    flush_every обращений добавляются в общую таблицу stats.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS hops ('
+        ' url TEXT PRIMARY KEY, next_url TEXT, redirect_type TEXT, expires REAL, used REAL)',
+        'CREATE INDEX IF NOT EXISTS hops_used ON hops (used)',
+        'CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)',
+    )
+
+    def __init__(self, path, ttl=3600, max_size=100000, flush_every=100):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self.unflushed = {'hits': 0, 'misses': 0}
+        self.sets = 0
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        # sqlite-соединение нельзя использовать после fork
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def get(self, url):
+        """
+        :return: (следующий урл, тип редиректа) или None
+        """
+        now = time.time()
+        try:
+            row = self.connection.execute(
+                'SELECT next_url, redirect_type FROM hops WHERE url = ? AND expires > ?', (url, now)
+            ).fetchone()
+            if row:
+                self.connection.execute('UPDATE hops SET used = ? WHERE url = ?', (now, url))
+        except sqlite3.Error as e:
+            logger.error(u'hop cache error {}'.format(e))
+            row = None
+
+        self.count('hits' if row else 'misses')
+        return (row[0], str(row[1])) if row else None
+
+    def set(self, url, next_url, redirect_type):
+        now = time.time()
+        try:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO hops VALUES (?, ?, ?, ?, ?)',
+                (url, next_url, redirect_type, now + self.ttl, now)
+            )
+            self.sets += 1
+            if self.sets % self.flush_every == 0:
+                self.evict(now)
+        except sqlite3.Error as e:
+            logger.error(u'hop cache error {}'.format(e))
+
+    def evict(self, now=None):
+        """Удаляет просроченные записи и лишние записи сверх max_size"""
+        now = time.time() if now is None else now
+        self.connection.execute('DELETE FROM hops WHERE expires <= ?', (now,))
+        size = self.connection.execute('SELECT COUNT(*) FROM hops').fetchone()[0]
+        if size > self.max_size:
+            self.connection.execute(
+                'DELETE FROM hops WHERE url IN (SELECT url FROM hops ORDER BY used LIMIT ?)',
+                (size - self.max_size,)
+            )
+
+    def count(self, name):
+        setattr(self, name, getattr(self, name) + 1)
+        self.unflushed[name] += 1
+        if (self.hits + self.misses) % self.flush_every == 0:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """Добавляет счетчики процесса в общую таблицу stats"""
+        try:
+            for name, value in self.unflushed.items():
+                self.connection.execute('INSERT OR IGNORE INTO stats VALUES (?, 0)', (name,))
+                self.connection.execute('UPDATE stats SET value = value + ? WHERE name = ?', (value, name))
+                self.unflushed[name] = 0
+        except sqlite3.Error as e:
+            logger.error(u'hop cache error {}'.format(e))
+
+    def stats(self):
+        """
+        :return: попадания и промахи всех процессов
+        """
+        totals = dict(self.unflushed)
+        try:
+            for name, value in self.connection.execute('SELECT name, value FROM stats'):
+                totals[name] = totals.get(name, 0) + value
+        except sqlite3.Error as e:
+            logger.error(u'hop cache error {}'.format(e))
+        return totals
@@ -0,0 +1,113 @@
+# coding: utf-8
+from bisect import bisect_left
+from numbers import Number
+
+import pycurl
+
+HOP_INFO = (
+    ('namelookup_time', pycurl.NAMELOOKUP_TIME),
+    ('connect_time', pycurl.CONNECT_TIME),
+    ('appconnect_time', pycurl.APPCONNECT_TIME),
+    ('starttransfer_time', pycurl.STARTTRANSFER_TIME),
+    ('total_time', pycurl.TOTAL_TIME),
+    ('size_download', pycurl.SIZE_DOWNLOAD),
+    ('header_size', pycurl.HEADER_SIZE),
+    ('http_code', pycurl.RESPONSE_CODE),
+)
+"""Что читается из curl-хендла после запроса: имя поля, опция getinfo"""
+
+HOP_TIMINGS = ('namelookup_time', 'connect_time', 'appconnect_time', 'starttransfer_time', 'total_time')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+"""Верхние границы корзин гистограммы в секундах (последняя корзина - все, что больше)"""
+
+
+def get_hop_info(curl):
+    """
+    :return: времена этапов запроса (секунды от начала), размеры тела (как передано, до распаковки)
+    и заголовков, код ответа
+    """
+    return dict((name, curl.getinfo(option)) for name, option in HOP_INFO)
+
+
+class Histogram(object):
+    """Гистограмма значений с фиксированными корзинами"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """
+        :return: верхняя граница корзины, в которую попадает q-й процентиль (None - за последней границей)
+        """
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[index] if index < len(self.buckets) else None
+        return None
+
+
+class HopMetrics(object):
+    """
+    Гистограммы времен этапов запросов процесса и объем скачанного:
+    wire_bytes - тела и заголовки как переданы по сети, body_bytes - тела после распаковки
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.histograms = dict((name, Histogram(buckets)) for name in HOP_TIMINGS)
+        self.size_download = 0
+        self.wire_bytes = 0
+        self.body_bytes = 0
+        self.requests = 0
+
+    def observe(self, info):
+        self.requests += 1
+        for name, histogram in self.histograms.items():
+            value = info.get(name)
+            if isinstance(value, Number):
+                histogram.observe(value)
+        for name in ('size_download', 'header_size'):
+            size = info.get(name)
+            if isinstance(size, Number):
+                self.wire_bytes += int(size)
+                if name == 'size_download':
+                    self.size_download += int(size)
+        size = info.get('body_size')
+        if isinstance(size, Number):
+            self.body_bytes += int(size)
+
+    def summary(self):
+        """
+        :return: {этап: (число запросов, среднее, p50, p90, p99)}
+        """
+        result = {}
+        for name, histogram in self.histograms.items():
+            mean = histogram.sum / histogram.count if histogram.count else None
+            result[name] = (histogram.count, mean) + tuple(histogram.percentile(q) for q in (50, 90, 99))
+        return result
+
+    def report(self):
+        """Строка для лога"""
+        summary = self.summary()
+        parts = [u'requests={} wire_bytes={} body_bytes={}'.format(self.requests, self.wire_bytes, self.body_bytes)]
+        for name in HOP_TIMINGS:
+            count, mean, p50, p90, p99 = summary[name]
+            if count:
+                parts.append(u'{}: mean={:.3f} p50<={} p90<={} p99<={}'.format(name, mean, p50, p90, p99))
+        return u'; '.join(parts)
+
+
+hop_metrics = HopMetrics()
+"""Метрики запросов текущего процесса"""
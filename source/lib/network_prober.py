@@ -0,0 +1,72 @@
+# coding: utf-8
+from collections import deque
+from logging import getLogger
+from multiprocessing import Event
+import threading
+import time
+
+from .utils import check_network_status
+
+logger = getLogger('redirect_checker')
+
+
+class NetworkProber(object):
+    """
+    Фоновая проверка сети.
+
+    Раз в interval секунд запрашиваются urls, проверка успешна, если ответил хотя бы один.
+    Сеть считается недоступной, когда среди последних window проверок неудачных больше
+    (1 - down_ratio) * window, и снова доступной, когда удачных не меньше up_ratio * window,
+    поэтому единичные сбои состояние не меняют.
+    Состояние доступно воркерам через network_up (multiprocessing.Event,
+    создается до запуска воркеров): пока сети нет, флаг сброшен.
+    """
+
+    def __init__(self, urls, timeout, interval=5, window=6, down_ratio=0.5, up_ratio=0.8):
+        self.urls = list(urls)
+        self.timeout = timeout
+        self.interval = interval
+        self.down_ratio = down_ratio
+        self.up_ratio = up_ratio
+        self.results = deque(maxlen=window)
+        self.network_up = Event()
+        self.network_up.set()
+        self.thread = None
+
+    @property
+    def is_up(self):
+        return self.network_up.is_set()
+
+    def probe(self):
+        return any(check_network_status(url, self.timeout) for url in self.urls)
+
+    def record(self, success):
+        """
+        Учитывает результат проверки
+        :return: доступна ли сеть
+        """
+        self.results.append(bool(success))
+        window = self.results.maxlen
+        successes = sum(self.results)
+        failures = len(self.results) - successes
+        if self.is_up and failures > (1 - self.down_ratio) * window:
+            logger.critical(u'Network is down ({} of {} probes failed). pausing workers'.format(
+                failures, len(self.results)
+            ))
+            self.network_up.clear()
+        elif not self.is_up and successes >= self.up_ratio * window:
+            logger.info(u'Network is up ({} of {} probes succeeded). resuming workers'.format(
+                successes, len(self.results)
+            ))
+            self.network_up.set()
+        return self.is_up
+
+    def run(self):
+        while True:
+            self.record(self.probe())
+            time.sleep(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='NetworkProber')
+        self.thread.daemon = True
+        self.thread.start()
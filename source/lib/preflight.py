@@ -0,0 +1,197 @@
+# coding: utf-8
+from collections import OrderedDict
+import re
+import socket
+import struct
+import time
+from urlparse import urlsplit
+
+REJECT_DENIED = 'denied'
+REJECT_SCHEME = 'scheme'
+REJECT_MALFORMED = 'malformed'
+REJECT_PRIVATE = 'private'
+REJECT_UNRESOLVED = 'unresolved'
+
+HOST_LABEL = re.compile(r'(?!-)[A-Za-z0-9_-]{1,63}(?<!-)\Z')
+IPV4_LIKE = re.compile(r'[0-9a-fA-FxX.]+\Z')
+"""Хосты, которые curl может разобрать как ipv4-адрес (в т.ч. 2130706433, 0x7f.1)"""
+
+PRIVATE_IPV4 = (
+    ('0.0.0.0', 8), ('10.0.0.0', 8), ('100.64.0.0', 10), ('127.0.0.0', 8), ('169.254.0.0', 16),
+    ('172.16.0.0', 12), ('192.168.0.0', 16), ('224.0.0.0', 4), ('240.0.0.0', 4),
+)
+PRIVATE_IPV6 = (('::', 128), ('::1', 128), ('fc00::', 7), ('fe80::', 10), ('ff00::', 8))
+IPV4_MAPPED = ('::ffff:0:0', 96)
+"""Локальные, внутренние, link-local, multicast и зарезервированные сети"""
+
+NOT_RESOLVED_ERRORS = tuple(
+    getattr(socket, name) for name in ('EAI_NONAME', 'EAI_NODATA') if hasattr(socket, name)
+)
+"""Ошибки getaddrinfo, означающие, что имени нет (остальные - временные, запрос делается)"""
+
+
+def ip_to_int(address, family):
+    packed = socket.inet_aton(address) if family == socket.AF_INET else socket.inet_pton(family, address)
+    high, low = struct.unpack('!QQ', packed) if len(packed) == 16 else (0, struct.unpack('!I', packed)[0])
+    return high << 64 | low
+
+
+def compile_networks(networks, family):
+    bits = 32 if family == socket.AF_INET else 128
+    return tuple(
+        (ip_to_int(address, family) >> (bits - prefix), bits - prefix) for address, prefix in networks
+    )
+
+
+PRIVATE_IPV4_NETWORKS = compile_networks(PRIVATE_IPV4, socket.AF_INET)
+PRIVATE_IPV6_NETWORKS = compile_networks(PRIVATE_IPV6, socket.AF_INET6)
+IPV4_MAPPED_NETWORK = compile_networks((IPV4_MAPPED,), socket.AF_INET6)[0]
+
+
+def in_networks(value, networks):
+    return any(value >> shift == network for network, shift in networks)
+
+
+def parse_ip(host):
+    """
+    :return: (семейство адреса, адрес числом) или None, если хост - не ip-адрес
+    """
+    if ':' in host:
+        try:
+            return socket.AF_INET6, ip_to_int(host, socket.AF_INET6)
+        except (socket.error, ValueError):
+            return None
+    if IPV4_LIKE.match(host):
+        try:
+            return socket.AF_INET, ip_to_int(host, socket.AF_INET)
+        except (socket.error, ValueError):
+            return None
+    return None
+
+
+def is_private_ip(family, value):
+    if family == socket.AF_INET:
+        return in_networks(value, PRIVATE_IPV4_NETWORKS)
+    network, shift = IPV4_MAPPED_NETWORK
+    if value >> shift == network:
+        return in_networks(value & 0xffffffff, PRIVATE_IPV4_NETWORKS)
+    return in_networks(value, PRIVATE_IPV6_NETWORKS)
+
+
+def is_valid_port(netloc):
+    """urlsplit не проверяет порт: для портов вне диапазона .port просто None"""
+    hostport = netloc.rpartition('@')[2].rpartition(']')[2]
+    port = hostport.partition(':')[2]
+    return not port or port.isdigit() and 0 < int(port) < 65536
+
+
+def is_valid_hostname(host):
+    try:
+        host = host.encode('idna') if isinstance(host, unicode) else host
+    except UnicodeError:
+        return False
+    labels = host.rstrip('.').split('.')
+    return len(host) <= 253 and all(HOST_LABEL.match(label) for label in labels)
+
+
+class Preflight(object):
+    """
+    Проверка урла перед запросом: урлы, запрос которых заведомо не даст результата,
+    отбрасываются без обращения к сети.
+
+    Урл, подходящий под одно из правил allow, пропускается без проверок.
+    Отбрасываются урлы, подходящие под правила deny, с неподдерживаемой схемой,
+    с некорректным хостом или портом, с локальным/внутренним ip-адресом
+    (если block_private) и с несуществующим в DNS хостом (если dns_ttl).
+    Результаты DNS-проверок кешируются на dns_ttl секунд, хранится не больше max_hosts хостов.
+    Число отброшенных урлов (несделанных запросов) считается по причинам в rejected.
+    """
+
+    def __init__(self, allow=(), deny=(), schemes=('http', 'https'), block_private=True, dns_ttl=300,
+                 max_hosts=10000):
+        self.allow = tuple(re.compile(rule, re.I) for rule in allow)
+        self.deny = tuple(re.compile(rule, re.I) for rule in deny)
+        self.schemes = frozenset(scheme.lower() for scheme in schemes)
+        self.block_private = block_private
+        self.dns_ttl = dns_ttl
+        self.max_hosts = max_hosts
+        self.hosts = OrderedDict()
+        self.rejected = {}
+
+    @property
+    def saved(self):
+        """Сколько запросов не было сделано"""
+        return sum(self.rejected.values())
+
+    def check(self, url):
+        """
+        :return: причина, по которой урл не нужно запрашивать (REJECT_*), или None
+        """
+        reason = self.classify(url)
+        if reason:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        return reason
+
+    def classify(self, url):
+        if any(rule.match(url) for rule in self.allow):
+            return None
+        if any(rule.match(url) for rule in self.deny):
+            return REJECT_DENIED
+        try:
+            parts = urlsplit(url)
+            host = parts.hostname
+        except ValueError:
+            return REJECT_MALFORMED
+        if parts.scheme.lower() not in self.schemes:
+            return REJECT_SCHEME
+        if not host or not is_valid_port(parts.netloc):
+            return REJECT_MALFORMED
+
+        ip = parse_ip(host)
+        if ip:
+            return REJECT_PRIVATE if self.block_private and is_private_ip(*ip) else None
+        if not is_valid_hostname(host):
+            return REJECT_MALFORMED
+        if self.dns_ttl:
+            addresses = self.resolve(host)
+            if addresses is None:
+                return REJECT_UNRESOLVED
+            if self.block_private and addresses and all(is_private_ip(*address) for address in addresses):
+                return REJECT_PRIVATE
+        return None
+
+    def resolve(self, host):
+        """
+        :return: адреса хоста ((семейство, адрес числом), ...), None - хоста нет,
+        пустой кортеж - проверить не удалось
+        """
+        host = host.lower()
+        now = time.time()
+        cached = self.hosts.get(host)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        try:
+            infos = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+            addresses = tuple(set(
+                (family, ip_to_int(sockaddr[0].split('%')[0], family))
+                for family, _, _, _, sockaddr in infos if family in (socket.AF_INET, socket.AF_INET6)
+            ))
+        except socket.gaierror as e:
+            if e.args[0] not in NOT_RESOLVED_ERRORS:
+                return ()
+            addresses = None
+        except (socket.error, UnicodeError, ValueError):
+            return ()
+
+        self.hosts.pop(host, None)
+        self.hosts[host] = (now + self.dns_ttl, addresses)
+        while len(self.hosts) > self.max_hosts:
+            self.hosts.popitem(last=False)
+        return addresses
+
+    def report(self):
+        """Строка для лога"""
+        parts = [u'saved={}'.format(self.saved)]
+        parts.extend(u'{}={}'.format(reason, count) for reason, count in sorted(self.rejected.items()))
+        return u' '.join(parts)
@@ -0,0 +1,93 @@
+# coding: utf-8
+import re
+from urllib import unquote
+
+TEMPLATE_GROUP = re.compile(r'\\(?:(\d+)|g<(\w+)>)')
+"""Ссылки на группы в шаблоне target: \\1, \\g<1>, \\g<name>"""
+
+
+def unquote_group(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return unquote(value).decode('utf8', 'ignore')
+
+
+class RedirectRule(object):
+    """
+    Правило: урл, подходящий под pattern (re.match), без запроса переходит в target.
+
+    target - шаблон со ссылками на группы (\\1, \\g<name>), группы подставляются
+    раскодированными (unquote), или функция, которая по совпадению возвращает урл.
+    redirect_type - тип редиректа для истории; None - правило переписывает урл редиректа
+    на месте (как market:// -> http://play.google.com/...), а не добавляет переход.
+    """
+
+    def __init__(self, name, pattern, target, redirect_type=None):
+        self.name = name
+        self.pattern = re.compile(pattern, re.I)
+        self.target = target
+        self.redirect_type = redirect_type
+        if not callable(target):
+            for ref in TEMPLATE_GROUP.finditer(target):
+                self.get_group_index(ref)
+
+    def get_group_index(self, ref):
+        number, name = ref.groups()
+        index = int(number or name) if (number or name).isdigit() else self.pattern.groupindex.get(name)
+        if not index or index > self.pattern.groups:
+            raise ValueError(u'bad group reference {} in rule {}'.format(ref.group(0), self.name))
+        return index
+
+    def apply(self, url):
+        """
+        :return: урл, в который переходит url, или None, если правило не подходит
+        """
+        match = self.pattern.match(url)
+        if not match:
+            return None
+        if callable(self.target):
+            return self.target(match) or None
+        return TEMPLATE_GROUP.sub(
+            lambda ref: unquote_group(match.group(self.get_group_index(ref)) or ''), self.target
+        ) or None
+
+
+class RedirectRules(object):
+    """
+    Таблица правил RedirectRule, проверяются по порядку, срабатывает первое подошедшее.
+    Число срабатываний каждого правила считается в hits.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = [rule if isinstance(rule, RedirectRule) else RedirectRule(*rule) for rule in rules]
+        self.hops = [rule for rule in self.rules if rule.redirect_type is not None]
+        self.rewrites = [rule for rule in self.rules if rule.redirect_type is None]
+        self.hits = dict((rule.name, 0) for rule in self.rules)
+
+    def find(self, rules, url):
+        for rule in rules:
+            target = rule.apply(url)
+            if target:
+                self.hits[rule.name] += 1
+                return rule, target
+        return None, None
+
+    def resolve(self, url):
+        """
+        :return: (следующий урл, тип редиректа) по правилам переходов или None
+        """
+        rule, target = self.find(self.hops, url)
+        if rule:
+            return target, rule.redirect_type
+        return None
+
+    def rewrite(self, url):
+        """
+        :return: урл редиректа, переписанный первым подошедшим правилом без типа, или url
+        """
+        rule, target = self.find(self.rewrites, url)
+        return target if rule else url
+
+    def report(self):
+        """Строка для лога"""
+        return u' '.join(u'{}={}'.format(rule.name, self.hits[rule.name]) for rule in self.rules)
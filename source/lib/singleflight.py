@@ -0,0 +1,159 @@
+# coding: utf-8
+import json
+from logging import getLogger
+import os
+import sqlite3
+from threading import Event, Lock
+import time
+
+logger = getLogger('redirect_checker')
+
+
+class Call(object):
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Объединяет одновременные вычисления с одинаковым ключом.
+
+    Пока выполняется вызов по ключу, остальные вызовы с тем же ключом
+    в этом процессе ждут его и получают тот же результат.
+
+    Если задан path (sqlite-файл), вызовы объединяются и между процессами:
+    первый процесс отмечает ключ в таблице flights, остальные опрашивают
+    таблицу, пока не появится результат (он должен сериализоваться в json).
+    Если результата нет дольше wait_timeout секунд или первый процесс
+    завершился с ошибкой, вычисление выполняется самостоятельно.
+    Готовый результат хранится result_ttl секунд, чтобы его успели забрать.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS flights ('
+        ' key TEXT PRIMARY KEY, pid INTEGER, started REAL, result TEXT, finished REAL)',
+    )
+
+    def __init__(self, path=None, wait_timeout=30, result_ttl=5, poll_interval=0.05):
+        self.path = path
+        self.wait_timeout = wait_timeout
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.lock = Lock()
+        self.calls = {}
+        self.coalesced = 0
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        # sqlite-соединение нельзя использовать после fork
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Вызывает func(*args, **kwargs) или дожидается такого же вызова по ключу key
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            if self.path:
+                call.result = self.do_shared(key, func, args, kwargs)
+            else:
+                call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+    def do_shared(self, key, func, args, kwargs):
+        try:
+            leader = self.begin(key)
+        except sqlite3.Error as e:
+            logger.error(u'singleflight error {}'.format(e))
+            return func(*args, **kwargs)
+
+        if not leader:
+            found, result = self.wait(key)
+            if found:
+                self.coalesced += 1
+                return result
+            return func(*args, **kwargs)
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.abandon(key)
+            raise
+        self.finish(key, result)
+        return result
+
+    def begin(self, key):
+        """
+        :return: True, если ключ отмечен текущим процессом
+        """
+        now = time.time()
+        self.connection.execute(
+            'DELETE FROM flights WHERE finished < ? OR (finished IS NULL AND started < ?)',
+            (now - self.result_ttl, now - self.wait_timeout)
+        )
+        cursor = self.connection.execute(
+            'INSERT OR IGNORE INTO flights (key, pid, started) VALUES (?, ?, ?)', (key, os.getpid(), now)
+        )
+        return cursor.rowcount == 1
+
+    def wait(self, key):
+        """
+        :return: (найден ли результат, результат)
+        """
+        deadline = time.time() + self.wait_timeout
+        try:
+            while time.time() < deadline:
+                row = self.connection.execute('SELECT result FROM flights WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    break
+                if row[0] is not None:
+                    return True, json.loads(row[0])
+                time.sleep(self.poll_interval)
+        except sqlite3.Error as e:
+            logger.error(u'singleflight error {}'.format(e))
+        return False, None
+
+    def finish(self, key, result):
+        try:
+            self.connection.execute(
+                'UPDATE flights SET result = ?, finished = ? WHERE key = ?', (json.dumps(result), time.time(), key)
+            )
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logger.error(u'singleflight error {}'.format(e))
+            self.abandon(key)
+
+    def abandon(self, key):
+        try:
+            self.connection.execute('DELETE FROM flights WHERE key = ? AND pid = ?', (key, os.getpid()))
+        except sqlite3.Error as e:
+            logger.error(u'singleflight error {}'.format(e))
@@ -3,8 +3,10 @@ import argparse
 from multiprocessing import Process
 import os
 import socket
+import threading
 import urllib2
 
+import tarantool
 from tarantool_queue import tarantool_queue
 
 
@@ -104,10 +106,30 @@ def parse_cmd_args(args, app_description=''):
     return parser.parse_args(args=args)
 
 
-def get_tube(host, port, space, name):
+class LockedConnection(tarantool.Connection):
+    """
+    Соединение с tarantool, которое можно использовать из нескольких потоков:
+    вызовы call выполняются по одному (запрос и ответ не перемешиваются).
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.call_lock = threading.RLock()
+        super(LockedConnection, self).__init__(*args, **kwargs)
+
+    def call(self, func_name, *args, **kwargs):
+        with self.call_lock:
+            return super(LockedConnection, self).call(func_name, *args, **kwargs)
+
+
+def get_tube(host, port, space, name, thread_safe=False):
+    """
+    :param thread_safe: очередь используется из нескольких потоков (см. LockedConnection)
+    """
     queue = tarantool_queue.Queue(
         host=host, port=port, space=space
     )
+    if thread_safe:
+        queue.tarantool_connection = LockedConnection
     return queue.tube(name)
 
 
@@ -118,9 +140,10 @@ class Config(object):
     pass
 
 
-def spawn_workers(num, target, args, parent_pid):
+def spawn_workers(num, target, args, parent_pid, kwargs=None):
+    kwargs = dict(kwargs or {}, parent_pid=parent_pid)
     for _ in xrange(num):
-        p = Process(target=target, args=args, kwargs={'parent_pid': parent_pid})
+        p = Process(target=target, args=args, kwargs=kwargs)
         p.daemon = True
         p.start()
 
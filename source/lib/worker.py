@@ -1,44 +1,315 @@
 # coding: utf-8
 from logging import getLogger
 import os.path
+import Queue
+import signal
+import threading
+import time
 
+from gevent import select as gevent_select, sleep as gevent_sleep
+from gevent.monkey import patch_all
+from gevent.pool import Pool
 from tarantool.error import DatabaseError
-from . import to_unicode, get_redirect_history
+from . import to_unicode, get_coalesced_redirect_history, init_curl_pool, init_buffer_pool, init_hop_cache, \
+    init_circuit_breaker, init_singleflight, init_preflight, get_preflight_report, init_redirect_rules, \
+    get_rules_report, encode_history_result, RESULT_ENCODING_PLAIN, get_redirect_histories, ERROR_PERMANENT, \
+    ERROR_CONNECT, ERROR_TRANSIENT, init_cooperative_curl, get_hop_cache_report
 
+from .metrics import hop_metrics
 from utils import get_tube
 
 logger = getLogger('redirect_checker')
 
+# воркеру отправлен SIGTERM: текущая задача доделывается, после нее воркер завершается
+stopping = False
+
+# подтвержденные задачи всех воркеров хоста (multiprocessing.Value) для AutoScaler, None - не считать
+acked_tasks = None
+
+
+def get_check_options(config):
+    """
+    Дополнительные параметры проверки для get_redirect_history из конфига
+    """
+    return {
+        'stream': config.STREAM_BODY_SCAN,
+        'meta_parser': config.META_PARSER,
+        'deadline': config.CHAIN_TIMEOUT,
+        'connect_timeout': config.HTTP_CONNECT_TIMEOUT,
+        'max_body': config.MAX_BODY_SIZE,
+        'head_first': config.HEAD_FIRST,
+        'encoding': config.HTTP_ENCODING,
+    }
+
+
+class RecheckPolicy(object):
+    """
+    Когда перепроверять урл, проверка которого закончилась ошибкой, в зависимости от класса ошибки
+    (см. lib.classify_error): ERROR_PERMANENT - не перепроверять, ERROR_TRANSIENT - через short_delay,
+    ERROR_CONNECT - через delay, удваивая задержку с каждой перепроверкой (не больше max_delay),
+    класс неизвестен - через delay. Урл перепроверяется не больше max_attempts раз.
+    """
+
+    def __init__(self, delay=300, short_delay=60, max_delay=3600, max_attempts=1):
+        self.delay = delay
+        self.short_delay = short_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+    def get_delay(self, error_class, attempt):
+        """
+        :param attempt: номер перепроверки (с 1)
+        :return: через сколько секунд перепроверить урл или None, если перепроверять не нужно
+        """
+        if attempt > self.max_attempts or error_class == ERROR_PERMANENT:
+            return None
+        if error_class == ERROR_TRANSIENT:
+            return self.short_delay
+        if error_class == ERROR_CONNECT:
+            return min(self.delay * 2 ** (attempt - 1), self.max_delay)
+        return self.delay
+
+
+def get_recheck_policy(config):
+    return RecheckPolicy(config.RECHECK_DELAY, config.RECHECK_SHORT_DELAY, config.RECHECK_MAX_DELAY,
+                         config.RECHECK_MAX_ATTEMPTS)
+
+
+def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=None, with_timings=False,
+                                   result_encoding=RESULT_ENCODING_PLAIN, recheck_policy=None, **options):
+    """
+    :param with_timings: добавить в результат времена этапов запросов (поле timings)
+    :param result_encoding: формат поля result (см. encode_history_result)
+    :param recheck_policy: RecheckPolicy для урлов с ошибкой (по умолчанию - одна перепроверка)
+    """
+    url = get_task_url(task)
+    timings = [] if with_timings else None
+    errors = []
+    history = get_coalesced_redirect_history(
+        url, timeout, max_redirects, user_agent, timings=timings, errors=errors, **options
+    )
+    # если проверку сделал другой воркер (singleflight), класс ошибки неизвестен
+    error_class = errors[0] if errors else None
+    return make_task_result(task, history, timings, with_timings, result_encoding, error_class, recheck_policy)
 
-def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=None):
-    url = to_unicode(task.data['url'], 'ignore')
-    is_recheck = bool(task.data.get('recheck'))
 
+def get_task_url(task):
+    url = to_unicode(task.data['url'], 'ignore')
     logger.info(u'Task id={} url={} url_id={} is_recheck={}'.format(
-        task.task_id, url, task.data["url_id"], is_recheck
+        task.task_id, url, task.data["url_id"], bool(task.data.get('recheck'))
     ))
+    return url
 
-    history_types, history_urls, counters = get_redirect_history(
-        url, timeout, max_redirects, user_agent
-    )
-    if 'ERROR' in history_types and not is_recheck:
-        task.data['recheck'] = True
+
+def make_task_result(task, history, timings=None, with_timings=False, result_encoding=RESULT_ENCODING_PLAIN,
+                     error_class=None, recheck_policy=None):
+    """
+    :param history: результат проверки урла задачи (см. get_redirect_history)
+    :param error_class: класс ошибки, которой закончилась проверка (см. lib.classify_error)
+    :return: нужна ли перепроверка (данные - для входной очереди), данные задачи;
+    в данных для перепроверки - номер перепроверки (recheck), класс ошибки и задержка (recheck_delay)
+    """
+    history_types, history_urls, counters = history
+    recheck_delay = None
+    if 'ERROR' in history_types:
+        attempt = int(task.data.get('recheck') or 0) + 1
+        recheck_delay = (recheck_policy or RecheckPolicy()).get_delay(error_class, attempt)
+    if recheck_delay is not None:
+        logger.info(u'Task id={} recheck #{} in {}s, error class={}'.format(
+            task.task_id, attempt, recheck_delay, error_class
+        ))
+        task.data['recheck'] = attempt
+        task.data['error_class'] = error_class
+        task.data['recheck_delay'] = recheck_delay
         data = task.data
         is_input = True
     else:
         data = {
             "url_id": task.data["url_id"],
-            "result": [history_types, history_urls, counters],
+            "result": encode_history_result((history_types, history_urls, counters), result_encoding),
             "check_type": "normal"
         }
         if 'suspicious' in task.data:
             data['suspicious'] = task.data['suspicious']
+        if with_timings:
+            data['timings'] = timings
 
         is_input = False
     return is_input, data
 
 
-def worker_loop_function(config, input_tube, output_tube):
+def get_redirect_histories_from_tasks(tasks, timeout, max_redirects=30, user_agent=None, with_timings=False,
+                                      result_encoding=RESULT_ENCODING_PLAIN, recheck_policy=None, **options):
+    """
+    Проверяет урлы нескольких задач одновременно (см. get_redirect_histories)
+    :return: результаты get_redirect_history_from_task в порядке задач
+    """
+    urls = [get_task_url(task) for task in tasks]
+    timings = [] if with_timings else None
+    errors = []
+    histories = get_redirect_histories(
+        urls, timeout, max_redirects, user_agent, concurrency=len(tasks), timings=timings, errors=errors, **options
+    )
+    return [
+        make_task_result(
+            task, history, timings[index] if with_timings else None, with_timings, result_encoding, errors[index],
+            recheck_policy
+        )
+        for index, (task, history) in enumerate(zip(tasks, histories))
+    ]
+
+
+class TaskPipeline(object):
+    """
+    Отложенная отправка результатов задач и ack.
+
+    Результаты копятся и отправляются пачкой (put, затем ack каждой задачи),
+    когда накопилось flush_size задач или с первой отложенной прошло flush_interval секунд.
+    Задача подтверждается только после того, как ее результат положен в очередь.
+    """
+
+    def __init__(self, flush_size=50, flush_interval=1.0):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.first_added_at = None
+
+    def add(self, task, tube, data, **put_options):
+        if not self.pending:
+            self.first_added_at = time.time()
+        self.pending.append((task, tube, data, put_options))
+
+    def is_due(self):
+        return bool(self.pending) and (
+            len(self.pending) >= self.flush_size or time.time() - self.first_added_at >= self.flush_interval
+        )
+
+    def flush(self):
+        """
+        :return: сколько задач отправлено; при ошибке put неотправленные остаются в pipeline
+        """
+        pending, self.pending = self.pending, []
+        for index, (task, tube, data, put_options) in enumerate(pending):
+            try:
+                send_task_result(task, tube, data, put_options)
+            except Exception:
+                self.pending = pending[index:] + self.pending
+                raise
+        return len(pending)
+
+
+class ResultWriter(object):
+    """
+    Отправка результатов задач и ack в фоновом потоке (тот же интерфейс, что у TaskPipeline).
+
+    add кладет результат в очередь на отправку и ждет, если в ней уже max_pending результатов.
+    Поток отправляет результаты по порядку: put, затем ack. Если put не удался, поток больше
+    ничего не отправляет и не подтверждает (такие задачи tarantool вернет в очередь после
+    закрытия соединения), а ошибка выбрасывается из следующего add или flush.
+    Очереди, которые используются и потоком, и воркером, нужно открывать с get_tube(thread_safe=True).
+    """
+
+    def __init__(self, max_pending=100):
+        self.queue = Queue.Queue(max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='ResultWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    task, tube, data, put_options = item
+                    send_task_result(task, tube, data, put_options)
+            except Exception as e:
+                logger.exception(e)
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def add(self, task, tube, data, **put_options):
+        self.raise_error()
+        self.queue.put((task, tube, data, put_options))
+
+    def is_due(self):
+        # отправка идет постоянно, ждать нечего
+        return False
+
+    def flush(self):
+        """
+        Ждет, пока отправятся все добавленные результаты
+        """
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        """
+        Отправляет оставшиеся результаты и останавливает поток
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+def get_recheck_put_options(data):
+    """
+    Параметры put перепроверки: задержка и приоритет задачи (pri в данных задачи).
+    pri=None - приоритет еще не известен, его запросит send_task_result
+    """
+    return {'delay': data['recheck_delay'], 'pri': data.get('pri')}
+
+
+def send_task_result(task, tube, data, put_options):
+    if 'pri' in put_options and put_options['pri'] is None:
+        # task.meta() - лишний запрос к очереди: он делается при отправке (в ResultWriter и TaskPipeline -
+        # не между проверками урлов), и то только для первой перепроверки, дальше pri хранится в данных задачи
+        data['pri'] = task.meta()['pri']
+        put_options = dict(put_options, pri=data['pri'])
+    tube.put(data, **put_options)
+    logger.debug(u'Task id={} data:{}'.format(task.task_id, data))
+    ack_task(task)
+
+
+def ack_task(task):
+    try:
+        task.ack()
+    except DatabaseError as e:
+        logger.info('Task ack fail')
+        logger.exception(e)
+        return
+    logger.info(u'Task id={} done'.format(task.task_id))
+    if acked_tasks is not None:
+        with acked_tasks.get_lock():
+            acked_tasks.value += 1
+
+
+READY_TAKE_TIMEOUT = 0.001
+"""Таймаут take для уже готовых задач: очередь считает timeout 0 бесконечным ожиданием"""
+
+
+def take_tasks(tube, count, timeout):
+    """
+    Ждет первую задачу не дольше timeout, остальные (до count) берет только готовые
+    """
+    tasks = []
+    task = tube.take(timeout)
+    while task:
+        tasks.append(task)
+        task = tube.take(READY_TAKE_TIMEOUT) if len(tasks) < count else None
+    return tasks
+
+
+def worker_loop_function(config, input_tube, output_tube, writer=None):
+    """
+    :param writer: ResultWriter, через который отправляются результат и ack; None - отправлять сразу
+    """
     task = input_tube.take(config.QUEUE_TAKE_TIMEOUT)
     if task:
         logger.info(u'Starting task id={}.'.format(task.task_id))
@@ -46,34 +317,192 @@ def worker_loop_function(config, input_tube, output_tube):
             task,
             config.HTTP_TIMEOUT,
             config.MAX_REDIRECTS,
-            config.USER_AGENT
+            config.USER_AGENT,
+            config.HOP_TIMINGS_IN_RESULT,
+            config.RESULT_ENCODING,
+            get_recheck_policy(config),
+            **get_check_options(config)
         )
         if result:
             is_input, data = result
             if is_input:
-                task_meta = task.meta()
-                input_tube.put(
-                    data,
-                    delay=config.RECHECK_DELAY,
-                    pri=task_meta['pri']
-                )
+                tube, put_options = input_tube, get_recheck_put_options(data)
+            else:
+                tube, put_options = output_tube, {}
+            if writer:
+                writer.add(task, tube, data, **put_options)
+            else:
+                send_task_result(task, tube, data, put_options)
+            return
+        ack_task(task)
+
+
+def worker_batch_loop_function(config, input_tube, output_tube, pipeline):
+    """
+    Цикл воркера в пакетном режиме: берет до WORKER_BATCH_SIZE задач, проверяет их одновременно,
+    результаты и ack отправляются через pipeline (TaskPipeline или ResultWriter)
+    """
+    tasks = take_tasks(input_tube, config.WORKER_BATCH_SIZE, config.QUEUE_TAKE_TIMEOUT)
+    if tasks:
+        logger.info(u'Starting tasks ids={}.'.format(u','.join(unicode(task.task_id) for task in tasks)))
+        results = get_redirect_histories_from_tasks(
+            tasks,
+            config.HTTP_TIMEOUT,
+            config.MAX_REDIRECTS,
+            config.USER_AGENT,
+            config.HOP_TIMINGS_IN_RESULT,
+            config.RESULT_ENCODING,
+            get_recheck_policy(config),
+            **get_check_options(config)
+        )
+        for task, (is_input, data) in zip(tasks, results):
+            if is_input:
+                pipeline.add(task, input_tube, data, **get_recheck_put_options(data))
             else:
-                output_tube.put(data)
-            logger.debug(u'Task id={} data:{}'.format(task.task_id, data))
-        try:
-            task.ack()
-            logger.info(u'Task id={} done'.format(task.task_id))
-        except DatabaseError as e:
-            logger.info('Task ack fail')
-            logger.exception(e)
+                pipeline.add(task, output_tube, data)
+    if pipeline.is_due():
+        pipeline.flush()
+
+
+def init_worker_resources(config):
+    """
+    Создает общие для запросов процесса ресурсы (пул curl-хендлов, кеш редиректов и т.п.)
+    """
+    if config.CURL_POOL_SIZE:
+        init_curl_pool(config.CURL_POOL_SIZE, config.CURL_POOL_IDLE_TIMEOUT)
+        logger.info(u'Curl pool size={}'.format(config.CURL_POOL_SIZE))
+
+    if config.RECEIVE_BUFFER_POOL_SIZE:
+        init_buffer_pool(config.RECEIVE_BUFFER_POOL_SIZE, config.RECEIVE_BUFFER_SIZE, config.RECEIVE_BUFFER_MAX_SIZE)
+        logger.info(u'Receive buffer pool size={} buffer={}'.format(
+            config.RECEIVE_BUFFER_POOL_SIZE, config.RECEIVE_BUFFER_SIZE
+        ))
+
+    if config.HOP_CACHE_PATH:
+        init_hop_cache(config.HOP_CACHE_PATH, config.HOP_CACHE_TTL, config.HOP_CACHE_SIZE)
+        logger.info(u'Hop cache {} ttl={} size={}'.format(
+            config.HOP_CACHE_PATH, config.HOP_CACHE_TTL, config.HOP_CACHE_SIZE
+        ))
+
+    if config.CIRCUIT_BREAKER_FAILURES:
+        init_circuit_breaker(config.CIRCUIT_BREAKER_FAILURES, config.CIRCUIT_BREAKER_RESET_TIMEOUT)
+        logger.info(u'Circuit breaker failures={} reset timeout={}'.format(
+            config.CIRCUIT_BREAKER_FAILURES, config.CIRCUIT_BREAKER_RESET_TIMEOUT
+        ))
+
+    if config.REDIRECT_RULES:
+        init_redirect_rules(config.REDIRECT_RULES)
+        logger.info(u'Redirect rules: {}'.format(u', '.join(rule[0] for rule in config.REDIRECT_RULES)))
+
+    if config.PREFLIGHT:
+        init_preflight(
+            config.PREFLIGHT_ALLOW, config.PREFLIGHT_DENY, config.PREFLIGHT_SCHEMES,
+            config.PREFLIGHT_BLOCK_PRIVATE, config.PREFLIGHT_DNS_TTL
+        )
+        logger.info(u'Preflight deny rules={} allow rules={} dns ttl={}'.format(
+            len(config.PREFLIGHT_DENY), len(config.PREFLIGHT_ALLOW), config.PREFLIGHT_DNS_TTL
+        ))
+
+    if config.SINGLEFLIGHT:
+        init_singleflight(config.SINGLEFLIGHT_PATH, config.SINGLEFLIGHT_WAIT_TIMEOUT)
+        logger.info(u'Singleflight shared file={}'.format(config.SINGLEFLIGHT_PATH))
+
 
+def stop_handler(signum, frame):
+    global stopping
+    stopping = True
+
+
+def install_stop_handler():
+    signal.signal(signal.SIGTERM, stop_handler)
+    # прерванные сигналом запросы к tarantool и curl продолжаются, а не падают с EINTR
+    signal.siginterrupt(signal.SIGTERM, False)
+
+
+def wait_for_network(network_up, timeout=1, sleep=None, on_pause=None):
+    """
+    :param network_up: флаг доступности сети (см. NetworkProber) или None
+    :param sleep: функция ожидания вместо network_up.wait (multiprocessing.Event.wait
+    блокирует весь процесс, fetcher'ы передают gevent.sleep)
+    :param on_pause: вызывается перед ожиданием (например, отправить уже готовые результаты)
+    :return: True, если сеть доступна; иначе ждет ее не дольше timeout и возвращает False
+    """
+    if network_up is None or network_up.is_set():
+        return True
+    if on_pause:
+        on_pause()
+    if sleep:
+        sleep(timeout)
+    else:
+        network_up.wait(timeout)
+    return False
+
+
+def is_running(parent_proc):
+    """Воркер работает, пока жив родительский процесс и не получен SIGTERM"""
+    return os.path.exists(parent_proc) and not stopping
+
+
+def log_metrics():
+    logger.info(u'Hop metrics: {}'.format(hop_metrics.report()))
+    logger.info(u'Redirect rule hits: {}'.format(get_rules_report()))
+    preflight_report = get_preflight_report()
+    if preflight_report:
+        logger.info(u'Preflight: {}'.format(preflight_report))
+    hop_cache_report = get_hop_cache_report()
+    if hop_cache_report:
+        logger.info(u'Hop cache: {}'.format(hop_cache_report))
+
+
+def init_fetchers():
+    """
+    Готовит процесс к работе нескольких fetcher'ов (greenlet'ов): стандартная библиотека
+    переключается на gevent (сокеты tarantool, ожидания, потоки), curl-запросы выполняются кооперативно
+    """
+    patch_all()
+    init_cooperative_curl(gevent_select.select)
+
+
+def fetcher_loop(config, parent_proc, input_tube, output_tube, writer=None, network_up=None):
+    """
+    Цикл одного fetcher'а: берет задачи по одной из общих для процесса очередей (см. worker_loop_function)
+    """
+    while is_running(parent_proc):
+        if wait_for_network(network_up, sleep=gevent_sleep):
+            worker_loop_function(config, input_tube, output_tube, writer)
+
+
+def run_fetchers(config, parent_proc, input_tube, output_tube, writer=None, network_up=None):
+    """
+    Запускает FETCHERS_PER_WORKER fetcher'ов и ждет их завершения;
+    ошибка в любом из них завершает воркер, как и в обычном режиме
+    """
+    pool = Pool(config.FETCHERS_PER_WORKER)
+    for _ in xrange(config.FETCHERS_PER_WORKER):
+        pool.spawn(fetcher_loop, config, parent_proc, input_tube, output_tube, writer, network_up)
+    while len(pool):
+        pool.join(timeout=config.METRICS_LOG_INTERVAL or None, raise_error=True)
+        if config.METRICS_LOG_INTERVAL:
+            log_metrics()
+
+
+def worker(config, parent_pid, network_up=None, acked=None):
+    """
+    :param network_up: multiprocessing.Event, пока он сброшен (сети нет), новые задачи не берутся
+    :param acked: multiprocessing.Value, в котором считаются подтвержденные задачи (см. AutoScaler)
+    """
+    global acked_tasks
+    acked_tasks = acked
+    fetchers = config.FETCHERS_PER_WORKER > 1
+    if fetchers:
+        init_fetchers()
 
-def worker(config, parent_pid):
     input_tube = get_tube(
         host=config.INPUT_QUEUE_HOST,
         port=config.INPUT_QUEUE_PORT,
         space=config.INPUT_QUEUE_SPACE,
-        name=config.INPUT_QUEUE_TUBE
+        name=config.INPUT_QUEUE_TUBE,
+        thread_safe=bool(config.ASYNC_RESULT_WRITER) or fetchers
     )
     logger.info(u'Connected to input queue server on {host}:{port} space #{space}. name={name}'.format(
         host=input_tube.queue.host,
@@ -86,7 +515,8 @@ def worker(config, parent_pid):
         host=config.OUTPUT_QUEUE_HOST,
         port=config.OUTPUT_QUEUE_PORT,
         space=config.OUTPUT_QUEUE_SPACE,
-        name=config.OUTPUT_QUEUE_TUBE
+        name=config.OUTPUT_QUEUE_TUBE,
+        thread_safe=fetchers
     )
     logger.info(u'Connected to output queue server on {host}:{port} space #{space} name={name}.'.format(
         host=output_tube.queue.host,
@@ -95,10 +525,41 @@ def worker(config, parent_pid):
         name=output_tube.opt['tube']
     ))
 
+    init_worker_resources(config)
+    install_stop_handler()
+
     parent_proc = '/proc/{}'.format(parent_pid)
+    metrics_logged_at = time.time()
+    writer = None
+    if config.ASYNC_RESULT_WRITER:
+        writer = ResultWriter(config.RESULT_WRITER_QUEUE_SIZE)
+        logger.info(u'Async result writer: queue size={}'.format(config.RESULT_WRITER_QUEUE_SIZE))
+    pipeline = None
+    if fetchers:
+        logger.info(u'Fetchers mode: {} tasks at once'.format(config.FETCHERS_PER_WORKER))
+    elif config.WORKER_BATCH_SIZE > 1:
+        pipeline = writer or TaskPipeline(config.OUTPUT_FLUSH_SIZE, config.OUTPUT_FLUSH_INTERVAL)
+        logger.info(u'Batch mode: {} tasks per cycle'.format(config.WORKER_BATCH_SIZE))
+
+    # пока сети нет, готовые результаты не должны ждать ее в памяти
+    flush_results = (pipeline or writer).flush if pipeline or writer else None
 
     # run while parent is alive
-    while os.path.exists(parent_proc):
-        worker_loop_function(config, input_tube, output_tube)
-    else:
-        logger.info('Parent is dead. exiting')
+    if fetchers:
+        run_fetchers(config, parent_proc, input_tube, output_tube, writer, network_up)
+    while is_running(parent_proc):
+        if not wait_for_network(network_up, on_pause=flush_results):
+            continue
+        if pipeline:
+            worker_batch_loop_function(config, input_tube, output_tube, pipeline)
+        else:
+            worker_loop_function(config, input_tube, output_tube, writer)
+        if config.METRICS_LOG_INTERVAL and time.time() - metrics_logged_at >= config.METRICS_LOG_INTERVAL:
+            log_metrics()
+            metrics_logged_at = time.time()
+
+    logger.info('Stopped by SIGTERM. exiting' if stopping else 'Parent is dead. exiting')
+    if pipeline:
+        pipeline.flush()
+    if writer:
+        writer.close()
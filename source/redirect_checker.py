@@ -4,22 +4,132 @@ import logging
 import os
 import sys
 from logging.config import dictConfig
-from multiprocessing import active_children
+from multiprocessing import active_children, Value
 from time import sleep
 
+from tarantool.error import DatabaseError
+
+from lib.autoscaler import AutoScaler
+from lib.network_prober import NetworkProber
 from lib.utils import (check_network_status, create_pidfile, daemonize,
-                       load_config_from_pyfile, parse_cmd_args, spawn_workers, configuration)
+                       load_config_from_pyfile, parse_cmd_args, spawn_workers, configuration, get_tube)
 from lib.worker import worker
 
 logger = logging.getLogger('redirect_checker')
 
 keep_running = True
 
+# автомасштабирование пула (AUTOSCALE): AutoScaler, входная очередь, по которой он считает размер,
+# и счетчик задач, подтвержденных воркерами этого хоста
+scaler = None
+input_tube = None
+acked_tasks = None
+# pid воркеров, которым отправлен SIGTERM: они доделывают текущие задачи и завершаются
+retiring = set()
+# фоновая проверка сети (NETWORK_PROBE_URLS), None - сеть проверяется в основном цикле
+prober = None
+
+
+def init_network_prober(config):
+    global prober
+    prober = NetworkProber(
+        config.NETWORK_PROBE_URLS, config.HTTP_TIMEOUT,
+        interval=config.NETWORK_PROBE_INTERVAL,
+        window=config.NETWORK_PROBE_WINDOW,
+        down_ratio=config.NETWORK_DOWN_RATIO,
+        up_ratio=config.NETWORK_UP_RATIO
+    )
+    prober.start()
+    logger.info(u'Network prober: {}'.format(u', '.join(config.NETWORK_PROBE_URLS)))
+    return prober
+
+
+def init_autoscaler(config):
+    global scaler, input_tube, acked_tasks
+    scaler = AutoScaler(
+        config.AUTOSCALE_MIN_WORKERS, config.AUTOSCALE_MAX_WORKERS,
+        scale_up_backlog=config.AUTOSCALE_UP_BACKLOG,
+        scale_down_backlog=config.AUTOSCALE_DOWN_BACKLOG,
+        drain_time=config.AUTOSCALE_DRAIN_TIME,
+        max_step=config.AUTOSCALE_MAX_STEP,
+        idle_checks=config.AUTOSCALE_IDLE_CHECKS,
+        up_cooldown=config.AUTOSCALE_UP_COOLDOWN,
+        down_cooldown=config.AUTOSCALE_DOWN_COOLDOWN,
+        max_load=config.AUTOSCALE_MAX_LOAD,
+        min_free_memory=config.AUTOSCALE_MIN_FREE_MEMORY
+    )
+    input_tube = get_tube(
+        host=config.INPUT_QUEUE_HOST,
+        port=config.INPUT_QUEUE_PORT,
+        space=config.INPUT_QUEUE_SPACE,
+        name=config.INPUT_QUEUE_TUBE
+    )
+    acked_tasks = Value('L', 0)
+    return scaler
+
+
+def get_ready_tasks(tube):
+    """
+    :return: число готовых задач в очереди или None, если статистику получить не удалось
+    """
+    try:
+        return int(tube.statistics()['tasks']['ready'])
+    except (DatabaseError, KeyError, TypeError, ValueError) as e:
+        logger.error(u'Failed to get queue statistics: {}'.format(e))
+        return None
+
+
+def get_pool_size(config, workers_count):
+    """
+    :return: сколько воркеров должно работать (WORKER_POOL_SIZE или размер по AutoScaler)
+    """
+    if scaler is None:
+        return config.WORKER_POOL_SIZE
+    ready = get_ready_tasks(input_tube)
+    if ready is None:
+        return min(max(workers_count, scaler.min_workers), scaler.max_workers)
+    pool_size = scaler.get_pool_size(workers_count, ready, acked_tasks.value)
+    if pool_size != workers_count:
+        logger.info(u'Autoscale: ready tasks={} worker rate={} workers {} -> {}'.format(
+            ready, scaler.worker_rate, workers_count, pool_size
+        ))
+    return pool_size
+
+
+def get_worker_kwargs():
+    """Общие с воркерами объекты: флаг сети (NetworkProber) и счетчик ack для AutoScaler"""
+    kwargs = {}
+    if prober is not None:
+        kwargs['network_up'] = prober.network_up
+    if acked_tasks is not None:
+        kwargs['acked'] = acked_tasks
+    return kwargs or None
+
+
+def get_workers():
+    """Работающие воркеры, кроме завершающихся"""
+    children = active_children()
+    retiring.intersection_update(child.pid for child in children)
+    return [child for child in children if child.pid not in retiring]
+
+
+def retire_workers(workers, count):
+    """Завершает count последних воркеров: они доделывают текущие задачи (см. worker.stop_handler)"""
+    for child in sorted(workers, key=lambda child: child.pid)[-count:]:
+        retiring.add(child.pid)
+        child.terminate()
+
+
+def is_network_up(config):
+    if prober is not None:
+        return prober.is_up
+    return check_network_status(config.CHECK_URL, config.HTTP_TIMEOUT)
+
 
 def main_loop_function(config, parent_pid):
-    if check_network_status(config.CHECK_URL, config.HTTP_TIMEOUT):
-        required_workers_count = config.WORKER_POOL_SIZE - len(
-            active_children())
+    if is_network_up(config):
+        workers = get_workers()
+        required_workers_count = get_pool_size(config, len(workers)) - len(workers)
         if required_workers_count > 0:
             logger.info(
                 'Spawning {} workers'.format(required_workers_count))
@@ -27,8 +137,15 @@ def main_loop_function(config, parent_pid):
                 num=required_workers_count,
                 target=worker,
                 args=(config,),
-                parent_pid=parent_pid
+                parent_pid=parent_pid,
+                kwargs=get_worker_kwargs()
             )
+        elif required_workers_count < 0:
+            logger.info('Retiring {} workers'.format(-required_workers_count))
+            retire_workers(workers, -required_workers_count)
+    elif prober is not None:
+        # воркеры стоят на паузе (prober.network_up), пока сеть не вернется
+        logger.warning('Network is down. workers are paused')
     else:
         logger.critical('Network is down. stopping workers')
         for c in active_children():
@@ -55,6 +172,11 @@ def main(argv):
         u'Run main loop. Worker pool size={}. Sleep time is {}.'.format(
             config.WORKER_POOL_SIZE, config.SLEEP
         ))
+    if config.NETWORK_PROBE_URLS:
+        init_network_prober(config)
+    if config.AUTOSCALE:
+        init_autoscaler(config)
+        logger.info(u'Autoscale: {}..{} workers'.format(config.AUTOSCALE_MIN_WORKERS, config.AUTOSCALE_MAX_WORKERS))
     parent_pid = os.getpid()
     while keep_running:
         main_loop_function(config, parent_pid)
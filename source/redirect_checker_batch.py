@@ -0,0 +1,209 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+"""
+Проверка редиректов для урлов из файла, без очередей tarantool.
+
+На входе JSONL: по записи {"url": ..., "url_id": ..., ["suspicious": ...]} в строке,
+на выходе JSONL с результатами в том же виде, что кладет в очередь воркер
+({"url_id", "result", "check_type"}). Урлы проверяются пулом процессов
+окнами по window записей, поэтому память не зависит от размера входа.
+После каждого окна в checkpoint-файл пишутся смещения во входном и выходном
+файлах, при перезапуске с тем же checkpoint проверка продолжается с места остановки.
+"""
+import argparse
+import json
+import logging
+from logging.config import dictConfig
+from multiprocessing import Pool
+import os
+import sys
+
+from lib.utils import load_config_from_pyfile
+from lib.worker import get_check_options, get_redirect_history_from_task, init_worker_resources
+
+logger = logging.getLogger('redirect_checker')
+
+batch_config = None
+"""Конфиг процесса пула (задается в init_batch_worker)"""
+
+
+class BatchTask(object):
+    """Запись входного файла с интерфейсом задачи очереди, нужным get_redirect_history_from_task"""
+
+    def __init__(self, task_id, data):
+        self.task_id = task_id
+        self.data = data
+
+
+def init_batch_worker(config):
+    global batch_config
+    batch_config = config
+    init_worker_resources(config)
+
+
+def check_record(line):
+    """
+    Проверяет урл из строки входного файла (в процессе пула)
+    :return: строка для выходного файла или None, если запись не разобрана
+    """
+    try:
+        data = json.loads(line)
+        task = BatchTask(data['url_id'], data)
+        if not data.get('url'):
+            raise ValueError('no url')
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.error(u'Bad batch record {!r}: {}'.format(line[:200], e))
+        return None
+
+    config = batch_config
+    while True:
+        is_input, result = get_redirect_history_from_task(
+            task,
+            config.HTTP_TIMEOUT,
+            config.MAX_REDIRECTS,
+            config.USER_AGENT,
+            config.HOP_TIMINGS_IN_RESULT,
+            config.RESULT_ENCODING,
+            **get_check_options(config)
+        )
+        # в очереди задача с ошибкой перепроверяется с задержкой (см. worker.RecheckPolicy), здесь - один раз
+        # сразу; постоянные ошибки (битый урл, хоста нет в DNS по preflight) не перепроверяются
+        if not is_input:
+            return json.dumps(result) + '\n'
+
+
+def read_records(input_file, offset=0):
+    """
+    Читает непустые строки начиная со смещения offset
+    :return: итератор пар (смещение после строки, строка)
+    """
+    if offset:
+        try:
+            input_file.seek(offset)
+        except IOError:
+            # stdin: пропускаем уже обработанное
+            skipped = 0
+            while skipped < offset:
+                line = input_file.readline()
+                if not line:
+                    break
+                skipped += len(line)
+            offset = skipped
+
+    for line in iter(input_file.readline, ''):
+        offset += len(line)
+        if line.strip():
+            yield offset, line
+
+
+def read_windows(records, window):
+    """Разбивает итератор на списки не длиннее window"""
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= window:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_checkpoint(path):
+    """
+    :return: смещения во входном и выходном файлах
+    """
+    if not path or not os.path.exists(path):
+        return 0, None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    return checkpoint['input_offset'], checkpoint['output_offset']
+
+
+def save_checkpoint(path, input_offset, output_offset):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'input_offset': input_offset, 'output_offset': output_offset}, f)
+    os.rename(tmp_path, path)
+
+
+def run_batch(config, input_file, output_file, processes, window=1000, checkpoint_path=None):
+    """
+    Проверяет записи input_file и пишет результаты в output_file
+    :return: число проверенных записей
+    """
+    input_offset, output_offset = load_checkpoint(checkpoint_path)
+    if output_offset is not None:
+        # результаты незавершенного окна будут записаны заново
+        output_file.seek(output_offset)
+        output_file.truncate()
+    if input_offset:
+        logger.info(u'Resuming batch from input offset {}'.format(input_offset))
+
+    checked = 0
+    pool = Pool(processes, initializer=init_batch_worker, initargs=(config,))
+    try:
+        for chunk in read_windows(read_records(input_file, input_offset), window):
+            for result in pool.imap(check_record, [line for _, line in chunk]):
+                if result is not None:
+                    output_file.write(result)
+                    checked += 1
+            output_file.flush()
+            if checkpoint_path:
+                os.fsync(output_file.fileno())
+                save_checkpoint(checkpoint_path, chunk[-1][0], output_file.tell())
+            logger.info(u'Batch checked {} urls'.format(checked))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return checked
+
+
+def parse_batch_args(args):
+    parser = argparse.ArgumentParser(description='Check redirects of urls from a JSONL file.')
+    parser.add_argument('-c', '--config', dest='config', required=True, help='Path to configuration file.')
+    parser.add_argument('-i', '--input', dest='input', default='-', help='Input JSONL file, "-" for stdin.')
+    parser.add_argument('-o', '--output', dest='output', default='-', help='Output JSONL file, "-" for stdout.')
+    parser.add_argument('-C', '--checkpoint', dest='checkpoint',
+                        help='Checkpoint file to resume from (requires --output file).')
+    parser.add_argument('-j', '--processes', dest='processes', type=int,
+                        help='Number of checking processes (WORKER_POOL_SIZE by default).')
+    parser.add_argument('-w', '--window', dest='window', type=int, default=1000,
+                        help='Records read and checked at once.')
+    return parser.parse_args(args=args)
+
+
+def main(argv):
+    args = parse_batch_args(argv[1:])
+    if args.checkpoint and args.output == '-':
+        sys.stderr.write('--checkpoint requires --output file\n')
+        return 2
+
+    config = load_config_from_pyfile(os.path.realpath(os.path.expanduser(args.config)))
+    dictConfig(config.LOGGING)
+
+    input_file = sys.stdin if args.input == '-' else open(args.input)
+    if args.output == '-':
+        output_file = sys.stdout
+    else:
+        # при продолжении по checkpoint выходной файл дописывается
+        resume = args.checkpoint and os.path.exists(args.checkpoint)
+        output_file = open(args.output, 'r+' if resume else 'w')
+    try:
+        checked = run_batch(
+            config, input_file, output_file,
+            args.processes or config.WORKER_POOL_SIZE, args.window, args.checkpoint
+        )
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+    logger.info(u'Batch done, {} urls checked'.format(checked))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
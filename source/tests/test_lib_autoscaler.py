@@ -0,0 +1,70 @@
+# coding: utf-8
+import unittest
+import mock
+
+from source.lib.autoscaler import AutoScaler, get_free_memory, get_load_per_cpu
+
+
+class LibAutoScalerCase(unittest.TestCase):
+    def _scaler(self, **kwargs):
+        options = dict(scale_up_backlog=10, scale_down_backlog=1, drain_time=10, max_step=4, idle_checks=2,
+                       up_cooldown=30, down_cooldown=60)
+        options.update(kwargs)
+        return AutoScaler(2, 10, **options)
+
+    def test_restores_min_workers(self):
+        scaler = self._scaler()
+        self.assertEqual(scaler.get_pool_size(0, 0, 0, now=100), 2)
+        self.assertEqual(scaler.get_pool_size(12, 0, 0, now=100), 10)
+
+    def test_scale_up_by_throughput(self):
+        scaler = self._scaler()
+        scaler.get_pool_size(2, 0, 100, now=100)
+        # 2 воркера подтвердили 40 задач за 10 секунд: 2 задачи в секунду на воркер
+        self.assertEqual(scaler.get_pool_size(2, 100, 140, now=110), 5)
+        self.assertEqual(scaler.worker_rate, 2.0)
+
+    def test_scale_up_limited_by_step_and_max(self):
+        scaler = self._scaler()
+        self.assertEqual(scaler.get_pool_size(2, 1000, 0, now=100), 3)
+        self.assertEqual(scaler.get_pool_size(3, 100000, 10, now=130), 7)
+        self.assertEqual(scaler.get_pool_size(7, 100000, 20, now=160), 10)
+
+    def test_scale_up_cooldown(self):
+        scaler = self._scaler()
+        self.assertEqual(scaler.get_pool_size(2, 1000, 0, now=100), 3)
+        self.assertEqual(scaler.get_pool_size(3, 1000, 0, now=110), 3)
+        self.assertEqual(scaler.get_pool_size(3, 1000, 0, now=130), 4)
+
+    def test_scale_down_hysteresis(self):
+        scaler = self._scaler()
+        self.assertEqual(scaler.get_pool_size(5, 0, 0, now=100), 5)
+        # очередь не пуста, но и роста нет: счетчик простоя сбрасывается
+        self.assertEqual(scaler.get_pool_size(5, 20, 0, now=110), 5)
+        self.assertEqual(scaler.get_pool_size(5, 0, 0, now=120), 5)
+        self.assertEqual(scaler.get_pool_size(5, 0, 0, now=130), 4)
+        self.assertEqual(scaler.get_pool_size(4, 0, 0, now=140), 4)
+        self.assertEqual(scaler.get_pool_size(4, 0, 0, now=150), 4)
+        self.assertEqual(scaler.get_pool_size(4, 0, 0, now=190), 3)
+
+    def test_no_headroom(self):
+        scaler = self._scaler(max_load=1.0, min_free_memory=1024)
+        with mock.patch('source.lib.autoscaler.get_load_per_cpu', mock.Mock(return_value=1.5)):
+            self.assertEqual(scaler.get_pool_size(2, 1000, 0, now=100), 2)
+        with mock.patch('source.lib.autoscaler.get_load_per_cpu', mock.Mock(return_value=0.5)), \
+                mock.patch('source.lib.autoscaler.get_free_memory', mock.Mock(return_value=512)):
+            self.assertEqual(scaler.get_pool_size(2, 1000, 0, now=100), 2)
+
+    def test_get_free_memory(self):
+        meminfo = mock.MagicMock()
+        meminfo.__enter__.return_value = iter(['MemTotal: 2048 kB\n', 'MemAvailable: 1024 kB\n'])
+        with mock.patch('__builtin__.open', mock.Mock(return_value=meminfo)):
+            self.assertEqual(get_free_memory(), 1024 * 1024)
+
+    def test_get_free_memory_unavailable(self):
+        self.assertIsNone(get_free_memory('/nonexistent/meminfo'))
+
+    @mock.patch('source.lib.autoscaler.cpu_count', mock.Mock(return_value=4))
+    @mock.patch('os.getloadavg', mock.Mock(return_value=(2.0, 1.0, 1.0)))
+    def test_get_load_per_cpu(self):
+        self.assertEqual(get_load_per_cpu(), 0.5)
@@ -0,0 +1,46 @@
+import unittest
+
+from source.lib.buffer_pool import BufferPool, ReceiveBuffer
+
+
+class LibBufferPoolCase(unittest.TestCase):
+    def test_receive_buffer_write(self):
+        buff = ReceiveBuffer(4)
+        buff.write('ab')
+        buff.write('cdef')
+        self.assertEqual(buff.getvalue(), 'abcdef')
+        self.assertEqual(buff.tell(), 6)
+        self.assertEqual(buff.view().tobytes(), 'abcdef')
+
+    def test_receive_buffer_reset_keeps_memory(self):
+        buff = ReceiveBuffer(8)
+        buff.write('abcdef')
+        buff.reset()
+        buff.write('xy')
+        self.assertEqual(buff.getvalue(), 'xy')
+        self.assertEqual(buff.capacity, 8)
+
+    def test_pool_reuse(self):
+        pool = BufferPool(max_buffers=1, buffer_size=16)
+        buff = pool.acquire()
+        buff.write('data')
+        pool.release(buff)
+        reused = pool.acquire()
+        self.assertIs(reused, buff)
+        self.assertEqual(reused.getvalue(), '')
+        self.assertEqual((pool.allocated, pool.reused), (1, 1))
+
+    def test_pool_drops_grown(self):
+        pool = BufferPool(buffer_size=4, max_buffer_size=8)
+        buff = pool.acquire()
+        buff.write('x' * 9)
+        pool.release(buff)
+        self.assertEqual(pool.free, [])
+        self.assertEqual(pool.dropped, 1)
+
+    def test_pool_max_buffers(self):
+        pool = BufferPool(max_buffers=1, buffer_size=4)
+        first, second = pool.acquire(), pool.acquire()
+        pool.release(first)
+        pool.release(second)
+        self.assertEqual(pool.free, [first])
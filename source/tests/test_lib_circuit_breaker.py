@@ -0,0 +1,64 @@
+import unittest
+import mock
+
+from source.lib.circuit_breaker import CircuitBreaker
+
+
+class LibCircuitBreakerCase(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, max_hosts=2)
+
+    def fail_host(self, host, times, now=0):
+        with mock.patch('time.time', mock.Mock(return_value=now)):
+            for _ in xrange(times):
+                self.breaker.failure(host)
+
+    def allow(self, host, now):
+        with mock.patch('time.time', mock.Mock(return_value=now)):
+            return self.breaker.allow(host)
+
+    def test_closed(self):
+        self.fail_host('host', 1)
+        self.assertTrue(self.allow('host', 1))
+
+    def test_open(self):
+        self.fail_host('host', 2)
+        self.assertFalse(self.allow('host', 1))
+        self.assertEqual(self.breaker.short_circuited, 1)
+
+    def test_half_open_single_probe(self):
+        self.fail_host('host', 2)
+        self.assertTrue(self.allow('host', 10))
+        self.assertFalse(self.allow('host', 11))
+
+    def test_probe_success(self):
+        self.fail_host('host', 2)
+        self.allow('host', 10)
+        self.breaker.success('host')
+        self.assertTrue(self.allow('host', 11))
+        self.assertTrue(self.allow('host', 11))
+
+    def test_probe_failure(self):
+        self.fail_host('host', 2)
+        self.allow('host', 10)
+        self.fail_host('host', 1, now=11)
+        self.assertFalse(self.allow('host', 12))
+        self.assertTrue(self.allow('host', 21))
+
+    def test_stuck_probe(self):
+        self.fail_host('host', 2)
+        self.allow('host', 10)
+        self.assertTrue(self.allow('host', 20))
+
+    def test_success_resets_failures(self):
+        self.fail_host('host', 1)
+        self.breaker.success('host')
+        self.fail_host('host', 1)
+        self.assertTrue(self.allow('host', 1))
+
+    def test_max_hosts(self):
+        self.fail_host('host1', 2)
+        self.fail_host('host2', 1)
+        self.fail_host('host3', 1)
+        self.assertEqual(self.breaker.hosts.keys(), ['host2', 'host3'])
+        self.assertTrue(self.allow('host1', 1))
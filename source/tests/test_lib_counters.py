@@ -0,0 +1,77 @@
+# coding: utf-8
+import random
+import re
+import unittest
+
+import rstr
+
+from source.lib import COUNTER_TYPES, BodyScanner, get_counters
+
+
+def legacy_get_counters(content):
+    counters = []
+    for counter_name, regexp in COUNTER_TYPES:
+        if re.match(regexp, content):
+            counters.append(counter_name)
+    return counters
+
+
+SIGNATURES = [
+    'http://www.google-analytics.com/ga.js',
+    '//mc.yandex.ru/metrika/watch.js',
+    'http://top-fwz1.mail.ru/counter?id=1',
+    'http://top.mail.ru/jump?from=1',
+    '//googleads.g.doubleclick.net/pagead/viewthroughconversion/1/',
+    '//a1.vdna-assets.com/analytics.js',
+    '//counter.yadro.ru/hit?t1',
+    'http://counter.rambler.ru/top100.jcn?1',
+]
+
+CORPUS = [
+    '',
+    '<html></html>',
+    '\n'.join(SIGNATURES),
+    ''.join(SIGNATURES),
+    ''.join(reversed(SIGNATURES)),
+    '<SCRIPT SRC="HTTP://MC.YANDEX.RU/METRIKA/WATCH.JS"></SCRIPT>',
+    'mc.yandex.ru/metrika/watch.j',
+    'google-analytics.com/ga\njs',
+    'top.mail.ru/jump?from top-fwz1.mail.ru/counter',
+    '//counter.yadro.ru/hit//counter.rambler.ru/top100',
+    'counter.yadro.ru/hit',
+    '/counter.rambler.ru/top100',
+    '//googleads.g.doubleclick.net/pagead/viewthroughconversion' * 3,
+    '<html>' + 'x' * 100000 + SIGNATURES[6] + 'y' * 100000 + '</html>',
+    u'<html>счетчик {}</html>'.format(SIGNATURES[0]).encode('utf8'),
+    u'<html>счетчик {}</html>'.format(SIGNATURES[1].upper()),
+    u'//googleads.g.doubleclic\u212a.net/pagead/viewthroughconversion',
+]
+
+
+class LibCountersCase(unittest.TestCase):
+    def assert_legacy(self, page):
+        self.assertEqual(get_counters(page), legacy_get_counters(page), repr(page[:200]))
+
+    def test_corpus(self):
+        for page in CORPUS:
+            self.assert_legacy(page)
+
+    def test_random_pages(self):
+        rnd = random.Random(42)
+        for _ in xrange(200):
+            parts = [rnd.choice(SIGNATURES) for _ in xrange(rnd.randint(0, 4))]
+            parts += [rstr.xeger(rnd.choice(COUNTER_TYPES)[1]) for _ in xrange(rnd.randint(0, 2))]
+            parts += [rstr.rstr('<>/ .abcdefghijklmnopqrstuvwxyz', rnd.randint(0, 50)) for _ in xrange(3)]
+            rnd.shuffle(parts)
+            self.assert_legacy(''.join(parts))
+
+    def test_duplicate_counter_types(self):
+        self.assertEqual(get_counters(SIGNATURES[2] + SIGNATURES[3]), ['TOP_MAIL_RU', 'TOP_MAIL_RU'])
+
+    def test_body_scanner_chunks(self):
+        for page in CORPUS:
+            for size in (1, 7, 4096) if len(page) < 1000 else (4096,):
+                scanner = BodyScanner('http://url/')
+                for pos in xrange(0, len(page), size):
+                    scanner.write(page[pos:pos + size])
+                self.assertEqual(scanner.counters, legacy_get_counters(page), repr(page[:200]))
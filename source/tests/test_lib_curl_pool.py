@@ -0,0 +1,42 @@
+import unittest
+import mock
+
+from source.lib.curl_pool import CurlPool
+
+
+class LibCurlPoolCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = CurlPool(max_size=1, idle_timeout=60)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_acquire_new(self):
+        m_curl = mock.MagicMock()
+        with mock.patch('pycurl.Curl', mock.Mock(return_value=m_curl)):
+            curl = self.pool.acquire()
+        self.assertIs(curl, m_curl)
+        m_curl.setopt.assert_called_once_with(mock.ANY, self.pool.share)
+
+    def test_acquire_released(self):
+        m_curl = mock.MagicMock()
+        self.pool.release(m_curl)
+        self.assertIs(self.pool.acquire(), m_curl)
+        m_curl.reset.assert_called_once_with()
+        self.assertFalse(m_curl.close.called)
+
+    def test_release_full_pool(self):
+        m_curls = [mock.MagicMock(), mock.MagicMock()]
+        for m_curl in m_curls:
+            self.pool.release(m_curl)
+        self.assertFalse(m_curls[0].close.called)
+        m_curls[1].close.assert_called_once_with()
+
+    def test_evict_idle(self):
+        m_curl = mock.MagicMock()
+        with mock.patch('time.time', mock.Mock(return_value=0)):
+            self.pool.release(m_curl)
+        with mock.patch('time.time', mock.Mock(return_value=61)):
+            self.pool.evict_idle()
+        m_curl.close.assert_called_once_with()
+        self.assertEqual(self.pool.idle, [])
@@ -0,0 +1,66 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import mock
+
+from source.lib.hop_cache import HopCache
+
+
+class LibHopCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = HopCache(os.path.join(self.dir, 'hops.sqlite'), ttl=10, max_size=2, flush_every=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get_miss(self):
+        self.assertIsNone(self.cache.get('http://url1'))
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_set_get(self):
+        self.cache.set('http://url1', 'http://url2', 'http_status')
+        self.assertEqual(self.cache.get('http://url1'), ('http://url2', 'http_status'))
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_ttl(self):
+        with mock.patch('time.time', mock.Mock(return_value=0)):
+            self.cache.set('http://url1', 'http://url2', 'http_status')
+        with mock.patch('time.time', mock.Mock(return_value=11)):
+            self.assertIsNone(self.cache.get('http://url1'))
+
+    def test_lru_eviction(self):
+        for now, url in enumerate(['http://url1', 'http://url2']):
+            with mock.patch('time.time', mock.Mock(return_value=now)):
+                self.cache.set(url, 'http://next', 'http_status')
+        with mock.patch('time.time', mock.Mock(return_value=2)):
+            self.cache.get('http://url1')
+            self.cache.set('http://url3', 'http://next', 'http_status')
+            self.cache.set('http://url4', 'http://next', 'http_status')
+            self.assertIsNotNone(self.cache.get('http://url4'))
+            self.assertIsNone(self.cache.get('http://url2'))
+
+    def test_shared_between_instances(self):
+        self.cache.set('http://url1', 'http://url2', 'meta_tag')
+        other = HopCache(self.cache.path)
+        self.assertEqual(other.get('http://url1'), ('http://url2', 'meta_tag'))
+
+    def test_stats(self):
+        self.cache.get('http://url1')
+        self.cache.get('http://url1')
+        self.cache.get('http://url1')
+        other = HopCache(self.cache.path)
+        self.assertEqual(other.stats(), {'hits': 0, 'misses': 2})
+        self.assertEqual(self.cache.stats(), {'hits': 0, 'misses': 3})
+
+    def test_reconnect_after_fork(self):
+        connection = self.cache.connection
+        with mock.patch('os.getpid', mock.Mock(return_value=-1)):
+            self.assertIsNot(self.cache.connection, connection)
+
+    def test_database_error(self):
+        with mock.patch.object(HopCache, 'connection', mock.PropertyMock(side_effect=sqlite3.OperationalError)):
+            self.assertIsNone(self.cache.get('http://url1'))
+            self.cache.set('http://url1', 'http://url2', 'http_status')
@@ -1,11 +1,72 @@
+import json
 import unittest
+from HTMLParser import HTMLParseError
 import mock
+import pycurl
 import rstr
 
 from source.lib import check_for_meta, \
     make_pycurl_request, \
     fix_market_url, \
-    get_url, REDIRECT_HTTP, COUNTER_TYPES, get_counters, get_redirect_history, prepare_url, REDIRECT_META, prepare_url
+    get_url, REDIRECT_HTTP, COUNTER_TYPES, get_counters, get_redirect_history, prepare_url, REDIRECT_META, prepare_url, \
+    get_redirect_histories, RedirectHistory, BodyScanner, check_for_meta_in_head, find_meta_redirect, \
+    META_PARSER_HEAD, get_coalesced_redirect_history, BodyBuffer, handle_response, encode_history_result, \
+    decode_history_result, RESULT_ENCODING_COMPACT, classify_error, ERROR_PERMANENT, ERROR_CONNECT, ERROR_TRANSIENT, \
+    perform_curl, init_cooperative_curl, META_PARSER_BS4, get_hop_cache_report, compile_counter_signatures, \
+    get_host, get_preflight_report, init_redirect_rules, init_curl_pool, init_buffer_pool, init_hop_cache, \
+    init_circuit_breaker, init_singleflight, init_preflight, get_curl_multi
+from source.lib.singleflight import SingleFlight
+from source.lib.buffer_pool import BufferPool
+from source.lib.preflight import Preflight
+from source.lib.redirect_rules import RedirectRules
+
+
+class FakeCurlMulti(object):
+    def __init__(self, errors=(), idle=0, timeout=0):
+        self.handles = []
+        self.errors = errors
+        self.idle = idle
+        self.select_timeout = timeout
+        self.selects = []
+        self.removed = []
+
+    def add_handle(self, curl):
+        self.handles.append(curl)
+
+    def remove_handle(self, curl):
+        self.removed.append(curl)
+
+    def perform(self):
+        return 0, len(self.handles)
+
+    def info_read(self):
+        if self.idle:
+            self.idle -= 1
+            return 0, [], []
+        ok_list = [c for c in self.handles if c.url not in self.errors]
+        err_list = [(c, 7, 'error') for c in self.handles if c.url in self.errors]
+        self.handles = []
+        return 0, ok_list, err_list
+
+    def timeout(self):
+        return self.select_timeout
+
+    def select(self, timeout):
+        self.selects.append(timeout)
+
+    def close(self):
+        pass
+
+
+def fake_curl(redirects):
+    curl = mock.MagicMock()
+
+    def setopt(option, value):
+        if option == curl.URL:
+            curl.url = value
+    curl.setopt.side_effect = setopt
+    curl.getinfo.side_effect = lambda option: redirects.get(curl.url) if option == curl.REDIRECT_URL else 0
+    return curl
 
 
 class LibInitCase(unittest.TestCase):
@@ -24,7 +85,7 @@ class LibInitCase(unittest.TestCase):
 
         m_curl.getinfo = mock.Mock(return_value='url')
 
-        with mock.patch('source.lib.StringIO', mock.Mock(return_value=m_buffer)):
+        with mock.patch('source.lib.acquire_buffer', mock.Mock(return_value=m_buffer)):
             with mock.patch('pycurl.Curl', mock.Mock(return_value=m_curl)):
                 content, redirect_url = make_pycurl_request('url', 11, useragent)
 
@@ -47,7 +108,7 @@ class LibInitCase(unittest.TestCase):
 
         m_curl.getinfo = mock.Mock(return_value=None)
 
-        with mock.patch('source.lib.StringIO', mock.Mock(return_value=m_buffer)):
+        with mock.patch('source.lib.acquire_buffer', mock.Mock(return_value=m_buffer)):
             with mock.patch('pycurl.Curl', mock.Mock(return_value=m_curl)):
                 content, redirect_url = make_pycurl_request('url', 11, '')
 
@@ -55,6 +116,30 @@ class LibInitCase(unittest.TestCase):
         self.assertEqual(None, redirect_url)
 
 
+    def test_make_pycurl_request_buffer_pool(self):
+        m_curl = mock.MagicMock()
+        m_curl.getinfo = mock.Mock(return_value=None)
+        m_curl.perform.side_effect = lambda: buffers[0].write('<html></html>')
+        pool = BufferPool()
+        buffers = []
+        acquire = pool.acquire
+        pool.acquire = lambda: buffers.append(acquire()) or buffers[-1]
+        with mock.patch('source.lib.buffer_pool', pool), mock.patch('pycurl.Curl', mock.Mock(return_value=m_curl)):
+            content, redirect_url = make_pycurl_request('url', 11)
+            BodyBuffer('url', 10).close()
+        self.assertEqual(content, '<html></html>')
+        self.assertEqual(pool.free, buffers[:1])
+        self.assertEqual(pool.reused, 1)
+
+    def test_make_pycurl_request_curl_pool(self):
+        m_pool = mock.MagicMock()
+        m_curl = m_pool.acquire.return_value
+        m_curl.getinfo = mock.Mock(return_value=None)
+        with mock.patch('source.lib.curl_pool', m_pool):
+            make_pycurl_request('url', 11)
+        m_pool.release.assert_called_once_with(m_curl)
+        self.assertFalse(m_curl.close.called)
+
     def test_fix_market_url(self):
         result = fix_market_url('market://test/app')
         self.assertEqual('http://play.google.com/store/apps/test/app', result)
@@ -103,6 +188,19 @@ class LibInitCase(unittest.TestCase):
 
             self.assertEquals(redirect_type, 'ERROR')
 
+    def test_get_url_error_class(self):
+        hop_info = {'url': 'http://host/path'}
+        with mock.patch('source.lib.make_pycurl_request', mock.Mock(side_effect=pycurl.error(28, 'timeout'))):
+            self.assertEqual(get_url('http://host/path', 11, hop_info=hop_info)[1], 'ERROR')
+        self.assertEqual(hop_info['error'], ERROR_TRANSIENT)
+
+    def test_classify_error(self):
+        self.assertEqual(classify_error(pycurl.error(pycurl.E_COULDNT_RESOLVE_HOST, 'servfail')), ERROR_TRANSIENT)
+        self.assertEqual(classify_error(pycurl.error(pycurl.E_URL_MALFORMAT, 'bad url')), ERROR_PERMANENT)
+        self.assertEqual(classify_error(ValueError('bad url')), ERROR_PERMANENT)
+        self.assertEqual(classify_error(pycurl.E_COULDNT_CONNECT), ERROR_CONNECT)
+        self.assertEqual(classify_error(pycurl.error(pycurl.E_OPERATION_TIMEDOUT, 'timeout')), ERROR_TRANSIENT)
+
     def test_prepare_none_url(self):
         self.assertEqual(None, prepare_url(None))
 
@@ -190,3 +288,893 @@ class LibInitCase(unittest.TestCase):
         ])):
             types, urls, counters = get_redirect_history(m_urls[0], timeout=11, max_redirects=1)
             self.assertEquals(len(urls), 2)
+
+    def test_redirect_history_loop(self):
+        history = RedirectHistory('http://url1')
+        self.assertTrue(history.add('http://url2', REDIRECT_HTTP, ''))
+        self.assertFalse(history.add('http://url1', REDIRECT_HTTP, ''))
+        self.assertTrue(history.finished)
+
+    def test_redirect_history_self_redirect(self):
+        history = RedirectHistory('http://url1')
+        self.assertFalse(history.add('http://url1', REDIRECT_HTTP, ''))
+        self.assertEqual(history.urls, ['http://url1', 'http://url1'])
+
+    def test_redirect_history_slots(self):
+        self.assertRaises(AttributeError, setattr, RedirectHistory('http://url1'), 'extra', 1)
+
+    def test_encode_history_result_compact(self):
+        result = (
+            [REDIRECT_HTTP, REDIRECT_META, 'ERROR'],
+            [u'http://example.com/a', u'http://example.com/b?x=1', u'https://other/', u'https://other/'],
+            ['YA_METRICA']
+        )
+        encoded = encode_history_result(result, RESULT_ENCODING_COMPACT)
+        self.assertEqual(encoded, {
+            't': 'hme',
+            'u': [u'http://example.com/a', [19, u'b?x=1'], u'https://other/', [14, u'']],
+            'c': ['YA_METRICA'],
+        })
+        self.assertEqual(decode_history_result(json.loads(json.dumps(encoded))), list(result))
+
+    def test_encode_history_result_plain(self):
+        result = ([REDIRECT_HTTP], [u'http://url1', u'http://url2'], [])
+        encoded = encode_history_result(result)
+        self.assertEqual(encoded, [[REDIRECT_HTTP], [u'http://url1', u'http://url2'], []])
+        self.assertEqual(decode_history_result(encoded), encoded)
+
+    def test_encode_history_result_unknown(self):
+        self.assertRaises(ValueError, encode_history_result, ([], [u'http://url1'], []), 'xml')
+
+    def test_redirect_history_result(self):
+        history = RedirectHistory('http://url1')
+        self.assertFalse(history.add(None, None, '<script src="http://mc.yandex.ru/metrika/watch.js">'))
+        self.assertEqual(history.result(), ([], ['http://url1'], ['YA_METRICA']))
+
+    def _get_redirect_histories(self, urls, redirects, failing=(), **kwargs):
+        with mock.patch('source.lib.curl_multi', FakeCurlMulti(failing)):
+            with mock.patch('pycurl.Curl', mock.Mock(side_effect=lambda: fake_curl(redirects))):
+                return get_redirect_histories(urls, 11, **kwargs)
+
+    def test_get_redirect_histories(self):
+        redirects = {
+            'http://url1': 'http://url2',
+            'http://url2': 'http://url3',
+        }
+        result = self._get_redirect_histories(['http://url1', 'http://url3'], redirects, concurrency=1)
+        self.assertEqual(result, [
+            ([REDIRECT_HTTP, REDIRECT_HTTP], ['http://url1', 'http://url2', 'http://url3'], []),
+            ([], ['http://url3'], []),
+        ])
+
+    def test_get_redirect_histories_error(self):
+        errors = []
+        result = self._get_redirect_histories(
+            ['http://url1', 'http://url3'], {'http://url1': 'http://url2'}, failing=['http://url2'], errors=errors
+        )
+        self.assertEqual(result, [
+            (['http_status', 'ERROR'], ['http://url1', 'http://url2', 'http://url2'], []),
+            ([], ['http://url3'], []),
+        ])
+        self.assertEqual(errors, [ERROR_CONNECT, None])
+
+    def test_get_redirect_histories_ignored_url(self):
+        result = self._get_redirect_histories(['http://odnoklassniki.ru/'], {})
+        self.assertEqual(result, [([], ['http://odnoklassniki.ru/'], [])])
+
+    def test_body_scanner_meta_abort(self):
+        scanner = BodyScanner('http://url/')
+        self.assertIsNone(scanner.write('<html><head><me'))
+        self.assertEqual(scanner.write('ta http-equiv="refresh" content="0;url=/next"></head>'), 0)
+        self.assertTrue(scanner.aborted)
+        self.assertEqual(scanner.meta_url, 'http://url/next')
+
+    def test_body_scanner_first_meta_only(self):
+        scanner = BodyScanner('http://url/')
+        scanner.write('<html><head><meta charset="utf-8">')
+        self.assertIsNone(scanner.write('<meta http-equiv="refresh" content="0;url=/next"></head>'))
+        self.assertIsNone(scanner.meta_url)
+
+    def test_body_scanner_counters_across_chunks(self):
+        scanner = BodyScanner('http://url/')
+        scanner.write('<script src="//counter.rambler.ru/to')
+        scanner.write('p100.js"></script><script src="http://mc.yandex.ru/metrika/watch.js">')
+        self.assertEqual(scanner.counters, ['YA_METRICA', 'RAMBLER_TOP100'])
+
+    def test_body_scanner_http_redirect_abort(self):
+        scanner = BodyScanner('http://url/path')
+        scanner.header('HTTP/1.1 302 Found\r\n')
+        scanner.header('Location: /next\r\n')
+        self.assertIsNone(scanner.write('<html><head>'))
+        self.assertEqual(scanner.write('</head><body>'), 0)
+        self.assertEqual(scanner.redirect_url(mock.Mock()), 'http://url/next')
+
+    def test_body_scanner_location_without_redirect(self):
+        scanner = BodyScanner('http://url/')
+        scanner.header('HTTP/1.1 200 OK\r\n')
+        scanner.header('Location: /next\r\n')
+        self.assertIsNone(scanner.write('<html><head></head><body>'))
+        self.assertIsNone(scanner.location)
+
+    def test_body_scanner_keep_bytes(self):
+        scanner = BodyScanner('http://url/', keep_bytes=3)
+        scanner.meta_checked = True
+        scanner.write('ab')
+        scanner.write('cd')
+        self.assertEqual(scanner.content, 'abc')
+        self.assertEqual(scanner.size, 4)
+
+    def test_body_scanner_keeps_body_until_meta_checked(self):
+        scanner = BodyScanner('http://url/', keep_bytes=3, meta_parser=META_PARSER_HEAD)
+        scanner.write('<html><head>')
+        scanner.write('</head><body>')
+        scanner.write('text')
+        self.assertEqual(scanner.content, '<html><head>')
+        self.assertEqual(scanner.size, 29)
+
+    def test_body_scanner_parse_error_fallback_past_keep_bytes(self):
+        page = '<html><head>' + 'x' * 100 + '<meta http-equiv="refresh" content="0;url=/next"></head>'
+        scanner = BodyScanner('http://url/', keep_bytes=10)
+        with mock.patch('source.lib.HeadMetaParser.feed', mock.Mock(side_effect=HTMLParseError('error'))):
+            for start in xrange(0, len(page), 16):
+                scanner.write(page[start:start + 16])
+        self.assertEqual(scanner.content, page)
+        self.assertEqual(handle_response('http://url/', scanner.content, None, scanner=scanner),
+                         ('http://url/next', REDIRECT_META, page))
+
+    def test_make_pycurl_request_scanner_aborted(self):
+        m_curl = mock.MagicMock()
+        m_curl.perform.side_effect = pycurl.error(23, 'write error')
+        m_curl.getinfo = mock.Mock(return_value=None)
+        scanner = BodyScanner('http://url/')
+        scanner.write('<meta http-equiv="refresh" content="0;url=/next">')
+        with mock.patch('pycurl.Curl', mock.Mock(return_value=m_curl)):
+            content, redirect_url = make_pycurl_request('http://url/', 11, scanner=scanner)
+        m_curl.setopt.assert_any_call(m_curl.WRITEDATA, scanner)
+        self.assertIsNone(redirect_url)
+
+    def test_make_pycurl_request_scanner_error(self):
+        m_curl = mock.MagicMock()
+        m_curl.perform.side_effect = pycurl.error(7, 'connect error')
+        with mock.patch('pycurl.Curl', mock.Mock(return_value=m_curl)):
+            self.assertRaises(pycurl.error, make_pycurl_request, 'http://url/', 11, scanner=BodyScanner('http://url/'))
+
+    def test_get_redirect_history_stream(self):
+        def m_get_url(url, timeout, user_agent, scanner, **kwargs):
+            scanner.write('<script src="http://mc.yandex.ru/metrika/watch.js">')
+            return None, None, scanner.content
+
+        with mock.patch('source.lib.get_url', mock.Mock(side_effect=m_get_url)):
+            types, urls, counters = get_redirect_history('http://url/', timeout=11, stream=True)
+        self.assertEqual(counters, ['YA_METRICA'])
+
+    def test_check_for_meta_in_head_all_metas(self):
+        page = '<html><head><meta charset="utf-8"><meta http-equiv="Refresh" content="0;url=/next"></head></html>'
+        self.assertIsNone(check_for_meta(page, 'http://url/'))
+        self.assertEqual(check_for_meta_in_head(page, 'http://url/'), 'http://url/next')
+
+    def test_check_for_meta_in_head_body_ignored(self):
+        page = '<html><head></head><body><meta http-equiv="refresh" content="0;url=/next"></body></html>'
+        self.assertIsNone(check_for_meta_in_head(page, 'http://url/'))
+
+    def test_check_for_meta_in_head_max_bytes(self):
+        page = '<html><head><title>' + 'x' * 100 + '</title><meta http-equiv="refresh" content="0;url=/next">'
+        self.assertIsNone(check_for_meta_in_head(page, 'http://url/', max_bytes=100))
+
+    def test_check_for_meta_in_head_bad_meta(self):
+        page = '<html><head><meta http-equiv="refresh" content="0;URL=http://url/; sdfsdfsdf" /></head></html>'
+        self.assertIsNone(check_for_meta_in_head(page, ''))
+
+    def test_check_for_meta_in_head_malformed(self):
+        with mock.patch('source.lib.HeadMetaParser.feed', mock.Mock(side_effect=HTMLParseError('error'))), \
+                mock.patch('source.lib.check_for_meta', mock.Mock(return_value='http://url/next')) as m_check_for_meta:
+            self.assertEqual(check_for_meta_in_head('<html>', 'http://url/'), 'http://url/next')
+        m_check_for_meta.assert_called_once_with('<html>', 'http://url/')
+
+    def test_find_meta_redirect_head(self):
+        with mock.patch('source.lib.check_for_meta_in_head') as m_check_for_meta_in_head:
+            find_meta_redirect('<html>', 'http://url/', META_PARSER_HEAD)
+        m_check_for_meta_in_head.assert_called_once_with('<html>', 'http://url/')
+
+    def test_body_scanner_head_parser(self):
+        scanner = BodyScanner('http://url/', meta_parser=META_PARSER_HEAD)
+        scanner.write('<html><head><meta charset="utf-8">')
+        self.assertEqual(scanner.write('<meta http-equiv="refresh" content="0;url=/next"></head>'), 0)
+        self.assertEqual(scanner.meta_url, 'http://url/next')
+
+    def test_body_scanner_head_parser_stops_at_head_end(self):
+        scanner = BodyScanner('http://url/', meta_parser=META_PARSER_HEAD)
+        scanner.write('<html><head></head><body><meta http-equiv="refresh" content="0;url=/next">')
+        self.assertIsNone(scanner.meta_url)
+        self.assertTrue(scanner.meta_checked)
+
+    def _scan_in_chunks(self, page, meta_parser, chunk_size=7):
+        scanner = BodyScanner('http://url/', meta_parser=meta_parser)
+        for pos in xrange(0, len(page), chunk_size):
+            if scanner.write(page[pos:pos + chunk_size]) == 0:
+                break
+        return scanner.meta_url
+
+    def test_body_scanner_matches_find_meta_redirect(self):
+        pages = [
+            '<html><head><script>var s="<meta http-equiv=refresh content=\'0;url=http://evil/\'>"</script>'
+            '</head><body></body></html>',
+            '<html><head><!-- <meta charset="utf-8"> --><meta http-equiv="refresh" content="0;url=/next">'
+            '</head></html>',
+            '<html><head><meta http-equiv="refresh" content="0;url=http://b/?a>b"></head></html>',
+            '<html><head><style>a {} <meta http-equiv="refresh" content="0;url=/style"></style>'
+            '<meta charset="utf-8"><meta http-equiv="refresh" content="0;url=/next"></head></html>',
+        ]
+        for meta_parser in (META_PARSER_BS4, META_PARSER_HEAD):
+            for page in pages:
+                self.assertEqual(self._scan_in_chunks(page, meta_parser),
+                                 find_meta_redirect(page, 'http://url/', meta_parser), (meta_parser, page))
+
+    def test_body_scanner_comment_and_gt_in_content(self):
+        page = '<!-- <meta http-equiv="refresh" content="0;url=/comment"> -->' \
+               '<meta http-equiv="refresh" content="0;url=http://b/?a>b">'
+        self.assertEqual(self._scan_in_chunks(page, META_PARSER_BS4), 'http://b/?a>b')
+        self.assertEqual(self._scan_in_chunks(page, META_PARSER_HEAD), 'http://b/?a>b')
+
+    def test_body_scanner_ignores_script(self):
+        page = '<script>var s="<meta http-equiv=refresh content=\'0;url=http://evil/\'>"</script>'
+        self.assertIsNone(self._scan_in_chunks(page, META_PARSER_BS4))
+        self.assertIsNone(self._scan_in_chunks(page, META_PARSER_HEAD))
+
+    def test_body_scanner_parse_error(self):
+        scanner = BodyScanner('http://url/')
+        with mock.patch('source.lib.HeadMetaParser.feed', mock.Mock(side_effect=HTMLParseError('error'))):
+            self.assertIsNone(scanner.write('<meta http-equiv="refresh" content="0;url=/next">'))
+        self.assertTrue(scanner.meta_failed)
+        self.assertTrue(scanner.meta_checked)
+        with mock.patch('source.lib.find_meta_redirect', mock.Mock(return_value='http://url/next')) as m_find:
+            self.assertEqual(handle_response('http://url/', '<html>', None, scanner=scanner),
+                             ('http://url/next', REDIRECT_META, '<html>'))
+        m_find.assert_called_once_with('<html>', 'http://url/', META_PARSER_BS4)
+
+    def test_get_url_cached(self):
+        m_cache = mock.Mock()
+        m_cache.get.return_value = ('http://url2', REDIRECT_HTTP)
+        with mock.patch('source.lib.hop_cache', m_cache), \
+                mock.patch('source.lib.make_pycurl_request') as m_make_pycurl_request:
+            self.assertEqual(get_url('http://url1', 11), ('http://url2', REDIRECT_HTTP, None))
+        self.assertFalse(m_make_pycurl_request.called)
+
+    def test_get_url_cache_redirect(self):
+        m_cache = mock.Mock()
+        m_cache.get.return_value = None
+        with mock.patch('source.lib.hop_cache', m_cache), \
+                mock.patch('source.lib.make_pycurl_request', mock.Mock(return_value=('', 'http://url2'))):
+            get_url('http://url1', 11)
+        m_cache.set.assert_called_once_with('http://url1', 'http://url2', REDIRECT_HTTP)
+
+    def test_get_url_cache_final_page(self):
+        m_cache = mock.Mock()
+        m_cache.get.return_value = None
+        with mock.patch('source.lib.hop_cache', m_cache), \
+                mock.patch('source.lib.make_pycurl_request', mock.Mock(return_value=('<html></html>', None))):
+            get_url('http://url1', 11)
+        self.assertFalse(m_cache.set.called)
+
+    def test_get_redirect_histories_cached(self):
+        m_cache = mock.Mock()
+        m_cache.get.side_effect = lambda url: ('http://url2', REDIRECT_HTTP) if url == 'http://url1' else None
+        with mock.patch('source.lib.hop_cache', m_cache):
+            result = self._get_redirect_histories(['http://url1'], {})
+        self.assertEqual(result, [([REDIRECT_HTTP], ['http://url1', 'http://url2'], [])])
+
+    def test_get_hop_cache_report(self):
+        m_cache = mock.Mock()
+        m_cache.stats.return_value = {'hits': 3, 'misses': 1}
+        with mock.patch('source.lib.hop_cache', m_cache):
+            self.assertEqual(get_hop_cache_report(), u'hits=3 misses=1')
+        with mock.patch('source.lib.hop_cache', None):
+            self.assertIsNone(get_hop_cache_report())
+
+    def test_get_url_host_unavailable(self):
+        m_breaker = mock.Mock()
+        m_breaker.allow.return_value = False
+        with mock.patch('source.lib.circuit_breaker', m_breaker), \
+                mock.patch('source.lib.make_pycurl_request') as m_make_pycurl_request:
+            self.assertEqual(get_url('http://host/path', 11), ('http://host/path', 'ERROR', None))
+        m_breaker.allow.assert_called_once_with('host')
+        self.assertFalse(m_make_pycurl_request.called)
+
+    def test_get_url_host_failure(self):
+        m_breaker = mock.Mock()
+        m_breaker.allow.return_value = True
+        with mock.patch('source.lib.circuit_breaker', m_breaker), \
+                mock.patch('source.lib.make_pycurl_request', mock.Mock(side_effect=pycurl.error(7, 'error'))):
+            get_url('http://host/path', 11)
+        m_breaker.failure.assert_called_once_with('host')
+
+    def test_get_url_bad_url_not_host_failure(self):
+        m_breaker = mock.Mock()
+        m_breaker.allow.return_value = True
+        with mock.patch('source.lib.circuit_breaker', m_breaker), \
+                mock.patch('source.lib.make_pycurl_request', mock.Mock(side_effect=ValueError)):
+            get_url('http://host/path', 11)
+        self.assertFalse(m_breaker.failure.called)
+        self.assertFalse(m_breaker.success.called)
+
+    def test_get_url_host_success(self):
+        m_breaker = mock.Mock()
+        m_breaker.allow.return_value = True
+        with mock.patch('source.lib.circuit_breaker', m_breaker), \
+                mock.patch('source.lib.make_pycurl_request', mock.Mock(return_value=('', None))):
+            get_url('http://host/path', 11)
+        m_breaker.success.assert_called_once_with('host')
+
+    def test_get_redirect_histories_host_unavailable(self):
+        m_breaker = mock.Mock()
+        m_breaker.allow.return_value = False
+        with mock.patch('source.lib.circuit_breaker', m_breaker):
+            result = self._get_redirect_histories(['http://url1'], {})
+        self.assertEqual(result, [(['ERROR'], ['http://url1', 'http://url1'], [])])
+
+    def test_get_url_redirect_rule(self):
+        rules = RedirectRules([('click', r'http://click/\?u=(.+)', r'\1', REDIRECT_HTTP)])
+        with mock.patch('source.lib.redirect_rules', rules), \
+                mock.patch('source.lib.make_pycurl_request') as m_make_pycurl_request:
+            self.assertEqual(get_url('http://click/?u=http%3A%2F%2Furl2%2Fa%20b', 11),
+                             (u'http://url2/a%20b', REDIRECT_HTTP, None))
+        self.assertFalse(m_make_pycurl_request.called)
+        self.assertEqual(rules.hits['click'], 1)
+
+    def test_get_redirect_histories_redirect_rule(self):
+        rules = RedirectRules([('click', r'http://click/\?u=(.+)', r'\1', REDIRECT_META)])
+        with mock.patch('source.lib.redirect_rules', rules):
+            result = self._get_redirect_histories(['http://url1'], {'http://url1': 'http://click/?u=http://url2'})
+        self.assertEqual(result, [(
+            [REDIRECT_HTTP, REDIRECT_META], ['http://url1', 'http://click/?u=http://url2', 'http://url2'], []
+        )])
+
+    def test_handle_response_market_rule(self):
+        self.assertEqual(handle_response('http://url1', None, 'market://details?id=app'),
+                         ('http://play.google.com/store/apps/details?id=app', REDIRECT_HTTP, None))
+
+    def test_handle_response_market_rule_without_slashes(self):
+        self.assertEqual(handle_response('http://url1', None, 'market:details?id=app'),
+                         (prepare_url(fix_market_url('market:details?id=app')), REDIRECT_HTTP, None))
+        self.assertNotEqual(handle_response('http://url1', None, 'market:details?id=app')[0],
+                            'market:details?id=app')
+
+    def test_get_url_preflight_rejected(self):
+        with mock.patch('source.lib.preflight', Preflight(dns_ttl=0)), \
+                mock.patch('source.lib.make_pycurl_request') as m_make_pycurl_request:
+            self.assertEqual(get_url('http://127.0.0.1/path', 11), ('http://127.0.0.1/path', 'ERROR', None))
+        self.assertFalse(m_make_pycurl_request.called)
+
+    def test_get_redirect_histories_preflight_rejected(self):
+        preflight = Preflight(dns_ttl=0)
+        with mock.patch('source.lib.preflight', preflight):
+            errors = []
+            result = self._get_redirect_histories(['http://url1'], {'http://url1': 'ftp://url2'}, errors=errors)
+        self.assertEqual(result, [([REDIRECT_HTTP, 'ERROR'], ['http://url1', 'ftp://url2', 'ftp://url2'], [])])
+        self.assertEqual(errors, [ERROR_PERMANENT])
+        self.assertEqual(preflight.saved, 1)
+
+    def test_make_pycurl_request_timeouts(self):
+        m_curl = mock.MagicMock()
+        m_curl.getinfo = mock.Mock(return_value=None)
+        with mock.patch('pycurl.Curl', mock.Mock(return_value=m_curl)):
+            make_pycurl_request('url', 2.5, connect_timeout=0.5)
+        m_curl.setopt.assert_any_call(m_curl.TIMEOUT_MS, 2500)
+        m_curl.setopt.assert_any_call(m_curl.CONNECTTIMEOUT_MS, 500)
+
+    def test_redirect_history_hop_timeout(self):
+        history = RedirectHistory('http://url1', deadline=10)
+        with mock.patch('time.time', mock.Mock(return_value=100)):
+            self.assertEqual(history.hop_timeout(3), 3)
+        with mock.patch('time.time', mock.Mock(return_value=108)):
+            self.assertEqual(history.hop_timeout(3), 2)
+
+    def test_redirect_history_no_deadline(self):
+        self.assertEqual(RedirectHistory('http://url1').hop_timeout(3), 3)
+
+    def test_get_redirect_history_deadline(self):
+        with mock.patch('source.lib.get_url', mock.Mock(side_effect=[
+            ('http://url2', REDIRECT_HTTP, ''),
+            ('http://url3', REDIRECT_HTTP, ''),
+        ])) as m_get_url, mock.patch('time.time', mock.Mock(side_effect=[0, 0, 5, 11])), \
+                mock.patch('source.lib.logger', mock.Mock()):
+            types, urls, counters = get_redirect_history('http://url1', 3, deadline=10)
+        self.assertEqual(types, [REDIRECT_HTTP, REDIRECT_HTTP, 'ERROR'])
+        self.assertEqual(urls, ['http://url1', 'http://url2', 'http://url3', 'http://url3'])
+        self.assertEqual(m_get_url.call_args_list[1][1]['timeout'], 3)
+
+    def test_get_redirect_history_errors(self):
+        def get_url(url, hop_info, **kwargs):
+            hop_info['error'] = ERROR_PERMANENT
+            return url, 'ERROR', None
+
+        errors, timings = [], []
+        with mock.patch('source.lib.get_url', mock.Mock(side_effect=get_url)):
+            get_redirect_history('http://url1', 3, errors=errors, timings=timings)
+        self.assertEqual(errors, [ERROR_PERMANENT])
+        self.assertEqual(timings, [])
+
+    def test_get_redirect_histories_deadline(self):
+        with mock.patch('source.lib.logger', mock.Mock()):
+            result = self._get_redirect_histories(['http://url1'], {'http://url1': 'http://url2'}, deadline=0)
+        self.assertEqual(result, [(['ERROR'], ['http://url1', 'http://url1'], [])])
+
+    def test_get_redirect_histories_duplicates(self):
+        m_curl = mock.Mock(side_effect=lambda: fake_curl({'http://url1': 'http://url2'}))
+        with mock.patch('source.lib.curl_multi', FakeCurlMulti()), \
+                mock.patch('pycurl.Curl', m_curl):
+            result = get_redirect_histories(['http://url1', 'http://url1'], 11)
+        self.assertEqual(result[0], result[1])
+        self.assertIsNot(result[0][1], result[1][1])
+        self.assertEqual(m_curl.call_count, 1)
+
+    def test_get_coalesced_redirect_history(self):
+        with mock.patch('source.lib.singleflight', SingleFlight()), \
+                mock.patch('source.lib.get_redirect_history', mock.Mock(return_value=([], ['url'], []))) as m_history:
+            result = get_coalesced_redirect_history('url', 1, user_agent='agent', stream=True)
+        m_history.assert_called_once_with('url', 1, 30, 'agent', stream=True)
+        self.assertEqual(result, ([], ['url'], []))
+
+    def test_get_coalesced_redirect_history_disabled(self):
+        with mock.patch('source.lib.get_redirect_history', mock.Mock(return_value='result')):
+            self.assertEqual(get_coalesced_redirect_history('url', 1), 'result')
+
+    def test_make_pycurl_request_hop_info(self):
+        m_curl = mock.MagicMock()
+        m_curl.getinfo = mock.Mock(side_effect=lambda option: 0.5 if option == pycurl.TOTAL_TIME else None)
+        hop_info = {}
+        with mock.patch('pycurl.Curl', mock.Mock(return_value=m_curl)):
+            make_pycurl_request('url', 1, hop_info=hop_info)
+        self.assertEqual(hop_info['total_time'], 0.5)
+
+    def test_make_pycurl_request_encoding(self):
+        m_curl = mock.MagicMock()
+        m_curl.getinfo = mock.Mock(return_value=None)
+        hop_info = {}
+        with mock.patch('pycurl.Curl', mock.Mock(return_value=m_curl)):
+            make_pycurl_request('url', 1, hop_info=hop_info, encoding='gzip, deflate')
+        m_curl.setopt.assert_any_call(m_curl.ENCODING, 'gzip, deflate')
+        self.assertEqual(hop_info['body_size'], 0)
+
+    def test_make_pycurl_request_no_encoding(self):
+        m_curl = mock.MagicMock()
+        m_curl.getinfo = mock.Mock(return_value=None)
+        with mock.patch('pycurl.Curl', mock.Mock(return_value=m_curl)):
+            make_pycurl_request('url', 1)
+        self.assertNotIn(m_curl.ENCODING, [args[0] for args, _ in m_curl.setopt.call_args_list])
+
+    def test_make_pycurl_request_hop_info_on_error(self):
+        m_curl = mock.MagicMock()
+        m_curl.perform.side_effect = pycurl.error
+        m_curl.getinfo = mock.Mock(return_value=0)
+        hop_info = {}
+        with mock.patch('pycurl.Curl', mock.Mock(return_value=m_curl)):
+            self.assertRaises(pycurl.error, make_pycurl_request, 'url', 1, hop_info=hop_info)
+        self.assertEqual(hop_info['connect_time'], 0)
+
+    def test_get_redirect_history_timings(self):
+        def get_url(url, hop_info, **kwargs):
+            hop_info['total_time'] = 0.1
+            return ('http://url2', REDIRECT_HTTP, '') if url == 'http://url1' else (None, None, '')
+
+        timings = []
+        with mock.patch('source.lib.get_url', mock.Mock(side_effect=get_url)):
+            get_redirect_history('http://url1', 1, timings=timings)
+        self.assertEqual(timings, [
+            {'url': 'http://url1', 'total_time': 0.1},
+            {'url': 'http://url2', 'total_time': 0.1},
+        ])
+
+    def test_get_redirect_histories_timings(self):
+        timings = []
+        self._get_redirect_histories(['http://url1', 'http://url3'], {'http://url1': 'http://url2'}, timings=timings)
+        self.assertEqual([[hop['url'] for hop in hops] for hops in timings], [
+            ['http://url1', 'http://url2'],
+            ['http://url3'],
+        ])
+        self.assertEqual(timings[0][0]['total_time'], 0)
+
+    def test_body_buffer(self):
+        buff = BodyBuffer('http://url/', max_body=5)
+        buff.header('HTTP/1.1 302 Found\r\n')
+        buff.header('Location: /next\r\n')
+        self.assertIsNone(buff.write('abc'))
+        self.assertEqual(buff.write('defg'), 0)
+        self.assertTrue(buff.aborted)
+        self.assertTrue(buff.truncated)
+        self.assertEqual(buff.getvalue(), 'abcde')
+
+    def test_body_buffer_no_location_not_limited(self):
+        buff = BodyBuffer('http://url/', max_body=5)
+        buff.header('HTTP/1.1 200 OK\r\n')
+        self.assertIsNone(buff.write('a' * 100))
+        self.assertFalse(buff.aborted)
+        self.assertFalse(buff.truncated)
+        self.assertEqual(buff.content, 'a' * 100)
+
+    def test_body_buffer_unlimited(self):
+        buff = BodyBuffer('http://url/')
+        self.assertIsNone(buff.write('a' * 100))
+        self.assertFalse(buff.aborted)
+        self.assertEqual(buff.content, 'a' * 100)
+
+    def test_body_buffer_redirect_url(self):
+        buff = BodyBuffer('http://url/a/', max_body=1)
+        buff.header('HTTP/1.1 302 Found\r\n')
+        buff.header('Location: ../b\r\n')
+        buff.write('body')
+        self.assertEqual(buff.redirect_url(mock.Mock()), 'http://url/b')
+
+    def test_body_scanner_max_body(self):
+        scanner = BodyScanner('http://url/', max_body=10)
+        scanner.header('HTTP/1.1 302 Found\r\n')
+        scanner.header('Location: /next\r\n')
+        self.assertIsNone(scanner.write('<html>'))
+        self.assertEqual(scanner.write('<head>' + 'x' * 10), 0)
+        self.assertTrue(scanner.truncated)
+
+    def _make_pycurl_request_aborted(self, **kwargs):
+        m_curl = mock.MagicMock()
+        options = {}
+        m_curl.setopt.side_effect = lambda option, value: options.__setitem__(option, value)
+
+        def perform():
+            options[m_curl.HEADERFUNCTION]('HTTP/1.1 302 Found\r\n')
+            options[m_curl.HEADERFUNCTION]('Location: /next\r\n')
+            options[m_curl.WRITEDATA].write('x' * 10)
+            raise pycurl.error(23, 'write error')
+        m_curl.perform.side_effect = perform
+        m_curl.getinfo = mock.Mock(return_value=None)
+        with mock.patch('pycurl.Curl', mock.Mock(return_value=m_curl)):
+            return make_pycurl_request('http://url/', 1, **kwargs), options, m_curl
+
+    def test_make_pycurl_request_max_body(self):
+        (content, redirect_url), options, m_curl = self._make_pycurl_request_aborted(max_body=4)
+        self.assertEqual(content, 'xxxx')
+        self.assertIn(m_curl.HEADERFUNCTION, options)
+
+    def test_make_pycurl_request_head(self):
+        m_curl = mock.MagicMock()
+        m_curl.getinfo = mock.Mock(return_value=None)
+        with mock.patch('pycurl.Curl', mock.Mock(return_value=m_curl)):
+            make_pycurl_request('http://url/', 1, max_body=4, head=True)
+        m_curl.setopt.assert_any_call(m_curl.NOBODY, True)
+
+    def test_get_url_head_first_redirect(self):
+        with mock.patch('source.lib.make_pycurl_request',
+                        mock.Mock(return_value=('', 'http://url2'))) as m_request:
+            self.assertEqual(get_url('http://url1', 1, head_first=True), ('http://url2', REDIRECT_HTTP, None))
+        self.assertEqual(m_request.call_count, 1)
+        self.assertTrue(m_request.call_args[1]['head'])
+
+    def test_get_url_head_first_no_redirect(self):
+        with mock.patch('source.lib.make_pycurl_request',
+                        mock.Mock(side_effect=[('', None), ('<html></html>', None)])) as m_request:
+            self.assertEqual(get_url('http://url1', 1, head_first=True, max_body=10), (None, None, '<html></html>'))
+        self.assertEqual(m_request.call_count, 2)
+        self.assertEqual(m_request.call_args[1]['max_body'], 10)
+        self.assertNotIn('head', m_request.call_args[1])
+
+    def test_get_url_head_first_error(self):
+        with mock.patch('source.lib.make_pycurl_request',
+                        mock.Mock(side_effect=[pycurl.error(52, 'empty reply'), ('<html></html>', None)])) as m_request:
+            self.assertEqual(get_url('http://url1', 1, head_first=True), (None, None, '<html></html>'))
+        self.assertEqual(m_request.call_count, 2)
+
+    def test_get_url_head_first_timeout(self):
+        hop_info = {}
+        m_breaker = mock.Mock()
+        with mock.patch('source.lib.make_pycurl_request',
+                        mock.Mock(side_effect=pycurl.error(28, 'timeout'))) as m_request, \
+                mock.patch('source.lib.circuit_breaker', m_breaker):
+            self.assertEqual(get_url('http://url1', 1, head_first=True, hop_info=hop_info),
+                             ('http://url1', 'ERROR', None))
+        self.assertEqual(m_request.call_count, 1)
+        self.assertEqual(hop_info['error'], ERROR_TRANSIENT)
+        m_breaker.failure.assert_called_once_with('url1')
+
+    def test_get_url_head_first_remaining_timeout(self):
+        with mock.patch('source.lib.make_pycurl_request',
+                        mock.Mock(side_effect=[('', None), ('<html></html>', None)])) as m_request, \
+                mock.patch('time.time', mock.Mock(side_effect=[100, 103])):
+            get_url('http://url1', 10, head_first=True)
+        self.assertEqual(m_request.call_args_list[0][0][1], 10)
+        self.assertEqual(m_request.call_args_list[1][0][1], 7)
+
+    def test_get_url_head_first_no_time_left(self):
+        with mock.patch('source.lib.make_pycurl_request', mock.Mock(return_value=('', None))) as m_request, \
+                mock.patch('time.time', mock.Mock(side_effect=[100, 111])), \
+                mock.patch('source.lib.logger', mock.Mock()):
+            self.assertEqual(get_url('http://url1', 10, head_first=True), ('http://url1', 'ERROR', None))
+        self.assertEqual(m_request.call_count, 1)
+
+    def test_get_redirect_histories_head_first_error(self):
+        errors = []
+        result = self._get_redirect_histories(['http://url1'], {}, failing=['http://url1'],
+                                              head_first=True, errors=errors)
+        self.assertEqual(result, [(['ERROR'], ['http://url1', 'http://url1'], [])])
+        self.assertEqual(errors, [ERROR_CONNECT])
+
+    def test_get_redirect_histories_head_first_remaining_timeout(self):
+        with mock.patch('time.time', mock.Mock(side_effect=[100, 103])), \
+                mock.patch('source.lib.setup_curl') as m_setup_curl:
+            self._get_redirect_histories(['http://url1'], {}, head_first=True)
+        self.assertEqual([c[0][2] for c in m_setup_curl.call_args_list], [11, 8])
+
+    def test_get_redirect_histories_head_first_no_time_left(self):
+        errors = []
+        with mock.patch('time.time', mock.Mock(side_effect=[100, 112])), \
+                mock.patch('source.lib.logger', mock.Mock()):
+            result = self._get_redirect_histories(['http://url1'], {}, head_first=True, errors=errors)
+        self.assertEqual(result, [(['ERROR'], ['http://url1', 'http://url1'], [])])
+        self.assertEqual(errors, [ERROR_TRANSIENT])
+
+    def test_get_url_head_first_ok_login(self):
+        with mock.patch('source.lib.make_pycurl_request',
+                        mock.Mock(return_value=('', 'http://odnoklassniki.ru/st.redirect'))) as m_request:
+            get_url('http://url1', 1, head_first=True)
+        self.assertEqual(m_request.call_count, 2)
+
+    def test_get_redirect_histories_head_first(self):
+        timings = []
+        result = self._get_redirect_histories(['http://url1'], {'http://url1': 'http://url2'},
+                                              head_first=True, timings=timings)
+        self.assertEqual(result, [([REDIRECT_HTTP], ['http://url1', 'http://url2'], [])])
+        self.assertEqual([hop['url'] for hop in timings[0]], ['http://url1', 'http://url2', 'http://url2'])
+
+    def test_get_redirect_histories_max_body(self):
+        result = self._get_redirect_histories(['http://url1'], {'http://url1': 'http://url2'}, max_body=10)
+        self.assertEqual(result, [([REDIRECT_HTTP], ['http://url1', 'http://url2'], [])])
+
+    def _perform_cooperative(self, results, curl=None):
+        multi = mock.Mock()
+        multi.perform.return_value = (0, 1)
+        multi.info_read.side_effect = results
+        multi.timeout.return_value = 200
+        multi.fdset.return_value = ([3], [], [])
+        m_select = mock.Mock()
+        curl = curl or mock.Mock()
+        with mock.patch('source.lib.curl_multi', multi), mock.patch('source.lib.curl_results', {}) as results, \
+                mock.patch('source.lib.curl_select', m_select):
+            try:
+                perform_curl(curl)
+            finally:
+                multi.remove_handle.assert_called_once_with(curl)
+                self.assertFalse(multi.close.called)
+                self.assertNotIn(curl, results)
+        self.assertFalse(curl.perform.called)
+        return m_select, results
+
+    def test_perform_curl_cooperative(self):
+        curl = mock.Mock()
+        m_select, _ = self._perform_cooperative([(0, [], []), (0, [curl], [])], curl)
+        m_select.assert_called_once_with([3], [], [], 0.2)
+
+    def test_perform_curl_cooperative_error(self):
+        curl = mock.Mock()
+        with self.assertRaises(pycurl.error) as ctx:
+            self._perform_cooperative([(0, [], [(curl, 7, 'connect error')])], curl)
+        self.assertEqual(ctx.exception.args, (7, 'connect error'))
+
+    def test_perform_curl_cooperative_other_handles(self):
+        curl, other_ok, other_error = mock.Mock(), mock.Mock(), mock.Mock()
+        m_select, results = self._perform_cooperative(
+            [(1, [other_ok], []), (0, [], [(other_error, 7, 'connect error')]), (0, [curl], [])], curl)
+        self.assertEqual(results, {other_ok: None, other_error: (7, 'connect error')})
+        m_select.assert_called_once_with([3], [], [], 0.2)
+
+    def test_perform_curl_cooperative_done_by_other(self):
+        curl = mock.Mock()
+        multi = mock.Mock()
+        multi.perform.return_value = (0, 0)
+        multi.info_read.return_value = (0, [], [])
+        with mock.patch('source.lib.curl_multi', multi), mock.patch('source.lib.curl_results', {curl: None}), \
+                mock.patch('source.lib.curl_select', mock.Mock()) as m_select:
+            perform_curl(curl)
+        self.assertFalse(m_select.called)
+
+    def test_get_curl_multi(self):
+        from source import lib
+        with mock.patch('source.lib.curl_multi', None), mock.patch('pycurl.CurlMulti') as m_multi_class:
+            multi = get_curl_multi()
+            self.assertIs(get_curl_multi(), multi)
+            self.assertIs(lib.curl_multi, m_multi_class.return_value)
+        m_multi_class.assert_called_once_with()
+
+    def test_perform_curl_blocking(self):
+        curl = mock.Mock()
+        with mock.patch('source.lib.curl_select', None):
+            perform_curl(curl)
+        curl.perform.assert_called_once_with()
+
+    def test_init_cooperative_curl(self):
+        select = mock.Mock()
+        with mock.patch('source.lib.curl_select', None):
+            init_cooperative_curl(select)
+            from source import lib
+            self.assertIs(lib.curl_select, select)
+
+    def test_compile_counter_signatures_bad_pattern(self):
+        import re
+        with self.assertRaises(ValueError):
+            compile_counter_signatures([('BAD', re.compile(r'.*counter\.(js|php).*'))])
+
+    def test_get_host_bad_url(self):
+        self.assertIsNone(get_host('http://[::1'))
+
+    def test_get_preflight_report(self):
+        with mock.patch('source.lib.preflight', None):
+            self.assertIsNone(get_preflight_report())
+        with mock.patch('source.lib.preflight', Preflight()):
+            self.assertEqual(get_preflight_report(), u'saved=0')
+
+    def test_init_functions(self):
+        from source import lib
+        m_curl_pool = mock.Mock()
+        with mock.patch('source.lib.redirect_rules', lib.redirect_rules), \
+                mock.patch('source.lib.curl_pool', m_curl_pool), \
+                mock.patch('source.lib.buffer_pool', lib.buffer_pool), \
+                mock.patch('source.lib.hop_cache', lib.hop_cache), \
+                mock.patch('source.lib.circuit_breaker', lib.circuit_breaker), \
+                mock.patch('source.lib.singleflight', lib.singleflight), \
+                mock.patch('source.lib.preflight', lib.preflight), \
+                mock.patch('source.lib.CurlPool') as m_curl_pool_class, \
+                mock.patch('source.lib.HopCache') as m_hop_cache_class:
+            self.assertIs(init_redirect_rules(), lib.redirect_rules)
+            self.assertIs(init_curl_pool(2, 10), lib.curl_pool)
+            m_curl_pool.close.assert_called_once_with()
+            m_curl_pool_class.assert_called_once_with(2, 10)
+            self.assertIs(init_buffer_pool(2, 16, 64), lib.buffer_pool)
+            self.assertIs(init_hop_cache('/path', 60, 100), lib.hop_cache)
+            m_hop_cache_class.assert_called_once_with('/path', 60, 100)
+            self.assertIs(init_circuit_breaker(3, 60), lib.circuit_breaker)
+            self.assertIs(init_singleflight(), lib.singleflight)
+            self.assertIs(init_preflight(), lib.preflight)
+
+    def test_perform_curl_cooperative_call_multi_perform(self):
+        multi = mock.Mock()
+        multi.perform.side_effect = [(pycurl.E_CALL_MULTI_PERFORM, 1), (0, 1)]
+        curl = mock.Mock()
+        multi.info_read.return_value = (0, [curl], [])
+        with mock.patch('source.lib.curl_multi', multi), \
+                mock.patch('source.lib.curl_select', mock.Mock()):
+            perform_curl(curl)
+        self.assertEqual(multi.perform.call_count, 2)
+
+    def test_get_redirect_histories_cached_loop(self):
+        m_cache = mock.Mock()
+        m_cache.get.return_value = ('http://url1', REDIRECT_HTTP)
+        with mock.patch('source.lib.hop_cache', m_cache):
+            result = self._get_redirect_histories(['http://url1'], {})
+        self.assertEqual(result, [([REDIRECT_HTTP], ['http://url1', 'http://url1'], [])])
+        m_cache.get.assert_called_once_with('http://url1')
+
+    def test_get_redirect_histories_rule_hop(self):
+        rules = RedirectRules([('short', r'http://short/(.*)', r'http://url\1', REDIRECT_HTTP)])
+        with mock.patch('source.lib.redirect_rules', rules):
+            result = self._get_redirect_histories(['http://short/1'], {})
+        self.assertEqual(result, [([REDIRECT_HTTP], ['http://short/1', 'http://url1'], [])])
+
+    def test_get_redirect_histories_stream(self):
+        curls = []
+
+        def make_curl():
+            curl = fake_curl({})
+            curl.setopt.side_effect = lambda option, value: curls.append((curl, option, value))
+            return curl
+
+        def perform():
+            for curl, option, value in curls:
+                if option == curl.WRITEDATA:
+                    value.write('<meta http-equiv="refresh" content="0;url=http://url2/">')
+
+        multi = FakeCurlMulti()
+        multi.perform = mock.Mock(side_effect=lambda: (perform(), (0, 0))[1])
+        with mock.patch('source.lib.curl_multi', multi), \
+                mock.patch('pycurl.Curl', mock.Mock(side_effect=make_curl)), \
+                mock.patch('source.lib.setup_curl', mock.Mock(
+                    side_effect=lambda curl, url, timeout, ua, buff, *args: curls.append((curl, curl.WRITEDATA, buff))
+                )):
+            result = get_redirect_histories(['http://url1'], 11, max_redirects=1, stream=True)
+        self.assertEqual(result[0][0], [REDIRECT_META])
+        self.assertEqual(result[0][1], ['http://url1', 'http://url2/'])
+
+    def test_get_redirect_histories_setup_error(self):
+        errors = []
+        with mock.patch('source.lib.setup_curl', mock.Mock(side_effect=pycurl.error(3, 'malformed'))), \
+                mock.patch('source.lib.logger', mock.Mock()):
+            result = self._get_redirect_histories(['http://url1'], {}, errors=errors)
+        self.assertEqual(result, [(['ERROR'], ['http://url1', 'http://url1'], [])])
+        self.assertEqual(errors, [ERROR_PERMANENT])
+
+    def test_get_redirect_histories_call_multi_perform(self):
+        multi = FakeCurlMulti()
+        multi.perform = mock.Mock(side_effect=[(pycurl.E_CALL_MULTI_PERFORM, 1), (0, 1)])
+        with mock.patch('source.lib.curl_multi', multi), \
+                mock.patch('pycurl.Curl', mock.Mock(side_effect=lambda: fake_curl({}))):
+            result = get_redirect_histories(['http://url1'], 11)
+        self.assertEqual(result, [([], ['http://url1'], [])])
+        self.assertEqual(multi.perform.call_count, 2)
+
+    def test_get_redirect_histories_select(self):
+        for select_timeout, expected in ((200, 0.2), (-1, 1.0)):
+            multi = FakeCurlMulti(idle=1, timeout=select_timeout)
+            with mock.patch('source.lib.curl_multi', multi), \
+                    mock.patch('pycurl.Curl', mock.Mock(side_effect=lambda: fake_curl({}))):
+                result = get_redirect_histories(['http://url1'], 11)
+            self.assertEqual(result, [([], ['http://url1'], [])])
+            self.assertEqual(multi.selects, [expected])
+
+    def test_get_redirect_histories_cleanup_active(self):
+        multi = FakeCurlMulti()
+        multi.perform = mock.Mock(side_effect=KeyboardInterrupt)
+        curl = fake_curl({})
+        with mock.patch('source.lib.curl_multi', multi), \
+                mock.patch('pycurl.Curl', mock.Mock(return_value=curl)), \
+                mock.patch('source.lib.release_body') as m_release_body:
+            with self.assertRaises(KeyboardInterrupt):
+                get_redirect_histories(['http://url1'], 11)
+        self.assertEqual(multi.removed, [curl])
+        self.assertEqual(m_release_body.call_count, 1)
+
+    def test_check_for_meta_not_refresh(self):
+        self.assertIsNone(check_for_meta('<meta name="robots" content="noindex">', 'http://url/'))
+
+    def test_body_buffer_close_twice(self):
+        body = BodyBuffer('http://url/')
+        body.close()
+        body.close()
+        self.assertEqual(body.content, '')
+
+    def test_init_curl_pool_first_time(self):
+        from source import lib
+        with mock.patch('source.lib.curl_pool', None), mock.patch('source.lib.CurlPool') as m_curl_pool_class:
+            self.assertIs(init_curl_pool(2, 10), m_curl_pool_class.return_value)
+            self.assertIs(lib.curl_pool, m_curl_pool_class.return_value)
+
+    def test_get_redirect_histories_head_first_loop(self):
+        result = self._get_redirect_histories(['http://url1'], {'http://url1': 'http://url1'}, head_first=True)
+        self.assertEqual(result, [([REDIRECT_HTTP], ['http://url1', 'http://url1'], [])])
+
+    def test_get_redirect_histories_queued_messages(self):
+        multi = FakeCurlMulti()
+        info_read = multi.info_read
+        reads = [(1, [], [])]
+        multi.info_read = mock.Mock(side_effect=lambda: reads.pop() if reads else info_read())
+        with mock.patch('source.lib.curl_multi', multi), \
+                mock.patch('pycurl.Curl', mock.Mock(side_effect=lambda: fake_curl({}))):
+            result = get_redirect_histories(['http://url1'], 11)
+        self.assertEqual(result, [([], ['http://url1'], [])])
+        self.assertEqual(multi.info_read.call_count, 2)
+
+    def test_get_redirect_history_stream_releases_scanner(self):
+        pool = BufferPool(max_buffers=2)
+        rules = RedirectRules([('short', r'http://short/(\d+)', r'http://short/\1/next', REDIRECT_HTTP)])
+        with mock.patch('source.lib.buffer_pool', pool), mock.patch('source.lib.redirect_rules', rules):
+            for _ in xrange(20):
+                get_redirect_history('http://short/1', 11, max_redirects=1, stream=True)
+        self.assertEqual(pool.allocated, 1)
+        self.assertEqual(len(pool.free), 1)
+
+    def test_max_body_final_page_counters(self):
+        page = '<html><body>' + 'x' * 100 + '<script src="http://mc.yandex.ru/metrika/watch.js"></script></body></html>'
+        m_curl = mock.MagicMock()
+        options = {}
+        m_curl.setopt.side_effect = lambda option, value: options.__setitem__(option, value)
+
+        def perform():
+            options[m_curl.HEADERFUNCTION]('HTTP/1.1 200 OK\r\n')
+            for pos in xrange(0, len(page), 16):
+                self.assertIsNone(options[m_curl.WRITEDATA].write(page[pos:pos + 16]))
+        m_curl.perform.side_effect = perform
+        m_curl.getinfo = mock.Mock(return_value=None)
+        with mock.patch('pycurl.Curl', mock.Mock(return_value=m_curl)):
+            content, redirect_url = make_pycurl_request('http://url/', 1, max_body=10)
+        self.assertEqual(content, page)
+        self.assertEqual(get_counters(content), ['YA_METRICA'])
+
+        scanner = BodyScanner('http://url/', max_body=10)
+        scanner.header('HTTP/1.1 200 OK\r\n')
+        for pos in xrange(0, len(page), 16):
+            self.assertIsNone(scanner.write(page[pos:pos + 16]))
+        self.assertEqual(scanner.counters, ['YA_METRICA'])
@@ -0,0 +1,47 @@
+import unittest
+import mock
+
+from source.lib.metrics import Histogram, HopMetrics, get_hop_info, HOP_INFO
+
+
+class LibMetricsCase(unittest.TestCase):
+    def test_get_hop_info(self):
+        curl = mock.Mock()
+        curl.getinfo.side_effect = lambda option: option
+        self.assertEqual(get_hop_info(curl), dict(HOP_INFO))
+
+    def test_histogram_percentile(self):
+        histogram = Histogram(buckets=(0.1, 1))
+        for value in (0.05, 0.05, 0.5, 5):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.percentile(50), 0.1)
+        self.assertEqual(histogram.percentile(75), 1)
+        self.assertIsNone(histogram.percentile(99))
+
+    def test_histogram_empty(self):
+        self.assertIsNone(Histogram().percentile(50))
+
+    def test_hop_metrics_observe(self):
+        metrics = HopMetrics()
+        metrics.observe({'total_time': 0.2, 'connect_time': 0.01, 'size_download': 100.0})
+        metrics.observe({'total_time': 'bad'})
+        self.assertEqual(metrics.requests, 2)
+        self.assertEqual(metrics.size_download, 100)
+        self.assertEqual(metrics.summary()['total_time'], (1, 0.2, 0.25, 0.25, 0.25))
+        self.assertEqual(metrics.summary()['namelookup_time'], (0, None, None, None, None))
+
+    def test_hop_metrics_bytes(self):
+        metrics = HopMetrics()
+        metrics.observe({'size_download': 300.0, 'header_size': 200, 'body_size': 12000})
+        self.assertEqual(metrics.wire_bytes, 500)
+        self.assertEqual(metrics.body_bytes, 12000)
+        self.assertIn(u'wire_bytes=500 body_bytes=12000', metrics.report())
+
+    def test_hop_metrics_report(self):
+        metrics = HopMetrics()
+        metrics.observe({'total_time': 0.2})
+        report = metrics.report()
+        self.assertIn(u'requests=1', report)
+        self.assertIn(u'total_time: mean=0.200 p50<=0.25', report)
+        self.assertNotIn(u'connect_time', report)
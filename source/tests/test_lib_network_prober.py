@@ -0,0 +1,46 @@
+import unittest
+import mock
+
+from source.lib.network_prober import NetworkProber
+
+
+@mock.patch('source.lib.network_prober.logger', mock.Mock())
+class LibNetworkProberCase(unittest.TestCase):
+    def test_single_failure_keeps_network_up(self):
+        prober = NetworkProber(['http://url'], 1, window=4, down_ratio=0.5, up_ratio=0.75)
+        self.assertTrue(prober.record(False))
+        self.assertTrue(prober.record(True))
+        self.assertTrue(prober.record(False))
+        self.assertTrue(prober.network_up.is_set())
+
+    def test_hysteresis(self):
+        prober = NetworkProber(['http://url'], 1, window=4, down_ratio=0.5, up_ratio=0.75)
+        results = [prober.record(success) for success in (False, False, False, True, True, True, True)]
+        self.assertEqual(results, [True, True, False, False, False, True, True])
+        self.assertTrue(prober.network_up.is_set())
+
+    def test_network_up_cleared(self):
+        prober = NetworkProber(['http://url'], 1, window=2, down_ratio=1, up_ratio=1)
+        prober.record(False)
+        self.assertFalse(prober.network_up.is_set())
+        self.assertFalse(prober.is_up)
+
+    def test_probe_any_url(self):
+        prober = NetworkProber(['http://url1', 'http://url2'], 3)
+        with mock.patch('source.lib.network_prober.check_network_status',
+                        mock.Mock(side_effect=[False, True])) as m_check:
+            self.assertTrue(prober.probe())
+        self.assertEqual(m_check.call_args_list, [mock.call('http://url1', 3), mock.call('http://url2', 3)])
+
+    def test_probe_all_failed(self):
+        prober = NetworkProber(['http://url1', 'http://url2'], 3)
+        with mock.patch('source.lib.network_prober.check_network_status', mock.Mock(return_value=False)):
+            self.assertFalse(prober.probe())
+
+    @mock.patch('source.lib.network_prober.threading.Thread')
+    def test_start(self, m_thread):
+        prober = NetworkProber(['http://url'], 1)
+        prober.start()
+        m_thread.assert_called_once_with(target=prober.run, name='NetworkProber')
+        self.assertTrue(m_thread.return_value.daemon)
+        m_thread.return_value.start.assert_called_once_with()
@@ -0,0 +1,99 @@
+# coding: utf-8
+import unittest
+from urllib import quote, quote_plus
+from urlparse import urlparse, urlunparse
+
+import mock
+import rstr
+
+from source import lib
+from source.lib import prepare_url, to_unicode, to_str
+
+
+def legacy_prepare_url(url):
+    if url is None:
+        return url
+    scheme, netloc, path, qs, anchor, fragments = urlparse(
+        to_unicode(url),
+        allow_fragments=False
+    )
+    try:
+        netloc = netloc.encode('idna')
+    except UnicodeError:
+        pass
+    path = quote(to_str(path, 'ignore'), safe='/%+$!*\'(),')
+    qs = quote_plus(to_str(qs, 'ignore'), safe=':&%=+$!*\'(),')
+    return urlunparse((scheme, netloc, path, qs, anchor, fragments))
+
+
+CORPUS = [
+    'http://example.com',
+    'http://example.com/',
+    'http://example.com/path/index.html?utm_source=vk&utm_medium=cpc',
+    'https://example.com:8080/a,b(c)*!$+%20?q=a:b&x=1+2',
+    'HTTP://Example.com/',
+    'http://example.com/?',
+    'http://example.com/path#anchor',
+    'http://example.com/path;params?q=1',
+    'http://example.com/~user/',
+    'http://example.com/path with spaces?a=b c',
+    'http://example.com/?ref=http://other.com/',
+    'http://user@example.com/',
+    'http://[::1]/',
+    'http://a..b/',
+    'market://details?id=com.example.app',
+    'www.example.com/path',
+    u'http://пример.рф/каталог?q=поиск',
+    u'http://пример.рф/каталог?q=поиск'.encode('utf8'),
+    'http://example.com/%D0%BF',
+    'http://example.com/\xff',
+    '',
+]
+
+
+class LibPrepareUrlCase(unittest.TestCase):
+    def setUp(self):
+        lib.prepared_urls.clear()
+
+    def assertSameUrl(self, url):
+        try:
+            expected = legacy_prepare_url(url)
+        except ValueError as e:
+            self.assertRaises(type(e), prepare_url, url)
+            return
+        prepared = prepare_url(url)
+        self.assertEqual((prepared, type(prepared)), (expected, type(expected)), repr(url))
+
+    def test_corpus(self):
+        for url in CORPUS:
+            self.assertSameUrl(url)
+            # повторно - из кеша
+            self.assertSameUrl(url)
+
+    def test_random_urls(self):
+        for _ in xrange(500):
+            url = rstr.xeger(r"(https?|HTTP|market)://[a-zA-Z0-9.:\-@\[\]]{1,15}(/[a-zA-Z0-9_.\-/%+$!*'(),:;~# ]{0,20})?"
+                             r"(\?[a-zA-Z0-9_.\-/%+$!*'(),:&=;~# ?]{0,20})?")
+            self.assertSameUrl(url)
+            self.assertSameUrl(unicode(url))
+
+    def test_fast_path(self):
+        with mock.patch('source.lib.normalize_url') as m_normalize_url:
+            self.assertEqual(prepare_url('http://example.com/a?b=c'), u'http://example.com/a?b=c')
+        self.assertFalse(m_normalize_url.called)
+
+    def test_cache(self):
+        with mock.patch('source.lib.normalize_url', mock.Mock(return_value=u'prepared')) as m_normalize_url:
+            prepare_url('http://example.com/a b')
+            self.assertEqual(prepare_url('http://example.com/a b'), u'prepared')
+        self.assertEqual(m_normalize_url.call_count, 1)
+
+    def test_cache_size(self):
+        with mock.patch('source.lib.PREPARED_URLS_CACHE_SIZE', 2):
+            for index in xrange(3):
+                prepare_url('http://example.com/{}'.format(index))
+        self.assertEqual(lib.prepared_urls, {'http://example.com/2': u'http://example.com/2'})
+
+    def test_error_not_cached(self):
+        self.assertRaises(UnicodeDecodeError, prepare_url, 'http://example.com/\xff')
+        self.assertEqual(lib.prepared_urls, {})
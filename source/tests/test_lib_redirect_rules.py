@@ -0,0 +1,54 @@
+# coding: utf-8
+import unittest
+
+from source.lib.redirect_rules import RedirectRule, RedirectRules
+
+CLICK_RULE = ('click', r'https?://click\.example\.com/r\?(?:.*&)?url=([^&]+)', r'\1', 'http_status')
+
+
+class LibRedirectRulesCase(unittest.TestCase):
+    def test_rule_unquotes_groups(self):
+        rule = RedirectRule(*CLICK_RULE)
+        self.assertEqual(
+            rule.apply(u'http://click.example.com/r?id=1&url=http%3A%2F%2Fshop.ru%2F%3Fa%3D1%26b%3D2'),
+            u'http://shop.ru/?a=1&b=2'
+        )
+
+    def test_rule_named_groups(self):
+        rule = RedirectRule('short', r'http://sho\.rt/(?P<host>[a-z.]+)/(?P<id>\d+)', r'https://\g<host>/p/\g<2>')
+        self.assertEqual(rule.apply(u'http://sho.rt/example.com/42'), u'https://example.com/p/42')
+
+    def test_rule_unicode(self):
+        rule = RedirectRule(*CLICK_RULE)
+        self.assertEqual(rule.apply(u'http://click.example.com/r?url=http%3A%2F%2F%D0%BF.%D1%80%D1%84%2F'),
+                         u'http://п.рф/')
+
+    def test_rule_no_match(self):
+        rule = RedirectRule(*CLICK_RULE)
+        self.assertIsNone(rule.apply(u'http://click.example.com/r?id=1'))
+        self.assertIsNone(rule.apply(u'http://click.example.com/r?url='))
+
+    def test_rule_callable(self):
+        rule = RedirectRule('upper', r'x://(.*)', lambda match: u'http://' + match.group(1).upper())
+        self.assertEqual(rule.apply(u'x://abc'), u'http://ABC')
+
+    def test_rule_bad_reference(self):
+        self.assertRaises(ValueError, RedirectRule, 'bad', r'http://(a)', r'\2')
+        self.assertRaises(ValueError, RedirectRule, 'bad', r'http://(a)', r'\g<name>')
+
+    def test_resolve_counts_hits(self):
+        rules = RedirectRules([CLICK_RULE, ('other', r'http://other/(.*)', r'http://\1', 'meta_tag')])
+        self.assertEqual(rules.resolve(u'http://click.example.com/r?url=http://a/'), (u'http://a/', 'http_status'))
+        self.assertEqual(rules.resolve(u'http://click.example.com/r?url=http://b/'), (u'http://b/', 'http_status'))
+        self.assertEqual(rules.resolve(u'http://other/c'), (u'http://c', 'meta_tag'))
+        self.assertIsNone(rules.resolve(u'http://example.com/'))
+        self.assertEqual(rules.hits, {'click': 2, 'other': 1})
+        self.assertEqual(rules.report(), u'click=2 other=1')
+
+    def test_rewrite(self):
+        rules = RedirectRules([CLICK_RULE, ('app', r'app://(.*)', r'http://apps.example.com/\1')])
+        self.assertEqual(rules.rewrite(u'app://id=1'), u'http://apps.example.com/id=1')
+        self.assertEqual(rules.rewrite(u'http://example.com/'), u'http://example.com/')
+        self.assertIsNone(rules.resolve(u'app://id=1'))
+        self.assertEqual(rules.rewrite(u'http://click.example.com/r?url=http://a/'),
+                         u'http://click.example.com/r?url=http://a/')
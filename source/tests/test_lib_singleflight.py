@@ -0,0 +1,89 @@
+import os
+import shutil
+import sys
+import tempfile
+from threading import Event, Thread
+import unittest
+import mock
+
+from source.lib.singleflight import SingleFlight
+
+
+class LibSingleFlightCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'flights.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_do(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do('key', lambda x: x + 1, 1), 2)
+        self.assertEqual(flight.calls, {})
+
+    def test_do_concurrent(self):
+        flight = SingleFlight()
+        started, release = Event(), Event()
+        calls = []
+        results = []
+
+        def func():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+
+        leader = Thread(target=lambda: results.append(flight.do('key', func)))
+        leader.start()
+        started.wait()
+        follower = Thread(target=lambda: results.append(flight.do('key', func)))
+        follower.start()
+        while not flight.coalesced:
+            pass
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['result', 'result'])
+
+    def test_do_error(self):
+        flight = SingleFlight()
+        self.assertRaises(ValueError, flight.do, 'key', mock.Mock(side_effect=ValueError))
+        self.assertEqual(flight.calls, {})
+
+    def test_shared_finished(self):
+        SingleFlight(self.path).do('key', lambda: [['http_status'], ['url1', 'url2'], []])
+        func = mock.Mock()
+        result = SingleFlight(self.path).do('key', func)
+        self.assertEqual(result, [['http_status'], ['url1', 'url2'], []])
+        self.assertFalse(func.called)
+
+    def test_shared_wait(self):
+        leader, follower = SingleFlight(self.path), SingleFlight(self.path, poll_interval=0)
+        self.assertTrue(leader.begin('key'))
+        with mock.patch('time.sleep', mock.Mock(side_effect=lambda _: leader.finish('key', 'result'))):
+            self.assertEqual(follower.do('key', mock.Mock()), 'result')
+        self.assertEqual(follower.coalesced, 1)
+
+    def test_shared_leader_failed(self):
+        leader, follower = SingleFlight(self.path), SingleFlight(self.path, poll_interval=0)
+        self.assertTrue(leader.begin('key'))
+        with mock.patch('time.sleep', mock.Mock(side_effect=lambda _: leader.abandon('key'))):
+            self.assertEqual(follower.do('key', mock.Mock(return_value='own')), 'own')
+
+    def test_shared_wait_timeout(self):
+        self.assertTrue(SingleFlight(self.path).begin('key'))
+        follower = SingleFlight(self.path, wait_timeout=0)
+        self.assertEqual(follower.do('key', mock.Mock(return_value='own')), 'own')
+
+    def test_shared_stale_leader(self):
+        with mock.patch('time.time', mock.Mock(return_value=0)):
+            self.assertTrue(SingleFlight(self.path).begin('key'))
+        with mock.patch('time.time', mock.Mock(return_value=31)):
+            self.assertTrue(SingleFlight(self.path).begin('key'))
+
+    def test_shared_error(self):
+        flight = SingleFlight(os.path.join(self.dir, 'missing', 'flights.sqlite'))
+        with mock.patch.object(sys.modules[SingleFlight.__module__], 'logger', mock.Mock()):
+            self.assertEqual(flight.do('key', mock.Mock(return_value='own')), 'own')
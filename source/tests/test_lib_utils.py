@@ -12,7 +12,9 @@ from source.lib.utils import daemonize, \
     check_network_status, \
     Config, \
     load_config_from_pyfile, \
-    configuration
+    configuration, \
+    get_tube, \
+    LockedConnection
 
 
 class MockConfig:
@@ -104,6 +106,23 @@ class LibUtilsCase(unittest.TestCase):
             spawn_workers(num_of_workers, None, None, None)
         self.assertEqual(m_process.call_count, num_of_workers)
 
+    def test_get_tube(self):
+        tube = get_tube('localhost', 33013, 0, 'tube')
+        self.assertEqual(tube.opt['tube'], 'tube')
+        self.assertNotEqual(tube.queue.tarantool_connection, LockedConnection)
+
+    def test_get_tube_thread_safe(self):
+        tube = get_tube('localhost', 33013, 0, 'tube', thread_safe=True)
+        self.assertEqual(tube.queue.tarantool_connection, LockedConnection)
+
+    @mock.patch('source.lib.utils.tarantool.Connection.call', mock.Mock(return_value='result'))
+    @mock.patch('source.lib.utils.tarantool.Connection.connect', mock.Mock())
+    def test_locked_connection_call(self):
+        connection = LockedConnection('localhost', 33013)
+        connection.call_lock = mock.MagicMock()
+        self.assertEqual(connection.call('queue.take', 0, 'tube'), 'result')
+        connection.call_lock.__enter__.assert_called_once_with()
+
     @mock.patch('source.lib.utils.urllib2.urlopen', mock.Mock())
     def test_check_network_status_success(self):
         self.assertTrue(check_network_status(None, None))
@@ -162,11 +181,9 @@ class LibUtilsCase(unittest.TestCase):
         self.assertEqual(m_daemonize.called, False)
         self.assertEqual(m_create_pidfile.called, True)
 
-
-
-
-
-
-
-
-
+    def test_spawn_workers_kwargs(self):
+        with mock.patch('source.lib.utils.Process') as m_process:
+            spawn_workers(1, 'target', ('config',), 10, kwargs={'network_up': 'event'})
+        m_process.assert_called_once_with(
+            target='target', args=('config',), kwargs={'network_up': 'event', 'parent_pid': 10}
+        )
@@ -2,7 +2,11 @@ __author__ = 'alexander'
 
 import unittest
 import mock
-from source.lib.worker import worker, worker_loop_function, DatabaseError, get_redirect_history_from_task
+from gevent import select as gevent_select
+from source.lib.worker import worker, worker_loop_function, DatabaseError, get_redirect_history_from_task, \
+    get_check_options, init_worker_resources, worker_batch_loop_function, get_redirect_histories_from_tasks, \
+    TaskPipeline, take_tasks, ResultWriter, RecheckPolicy, get_recheck_policy, stop_handler, install_stop_handler, \
+    wait_for_network, fetcher_loop, run_fetchers, log_metrics, init_fetchers, ack_task
 
 
 class MockConfig:
@@ -18,22 +22,140 @@ class LibWorkerCase(unittest.TestCase):
         mock.MagicMock(name="input_tube"),
         mock.MagicMock(name='output_tube')
     ]))
+    @mock.patch('source.lib.worker.init_worker_resources', mock.Mock())
+    @mock.patch('source.lib.worker.install_stop_handler', mock.Mock())
     @mock.patch('source.lib.worker.worker_loop_function')
     def test_worker_parent_exists(self, m_worker_loop_function):
+        config = MockConfig()
+        config.WORKER_BATCH_SIZE = 1
+        config.FETCHERS_PER_WORKER = 1
+        config.ASYNC_RESULT_WRITER = False
         with mock.patch('os.path.exists', mock.Mock(side_effect=[True, False])):
-            worker(MockConfig(), 1)
+            worker(config, 1)
         self.assertEqual(m_worker_loop_function.call_count, 1)
 
     @mock.patch('source.lib.worker.get_tube', mock.Mock(side_effect=[
         mock.MagicMock(name="input_tube"),
         mock.MagicMock(name='output_tube')
     ]))
+    @mock.patch('source.lib.worker.init_worker_resources', mock.Mock())
+    @mock.patch('source.lib.worker.install_stop_handler', mock.Mock())
+    @mock.patch('source.lib.worker.worker_batch_loop_function')
+    def test_worker_batch_mode(self, m_worker_batch_loop_function):
+        config = MockConfig()
+        config.WORKER_BATCH_SIZE = 10
+        config.FETCHERS_PER_WORKER = 1
+        config.ASYNC_RESULT_WRITER = False
+        config.OUTPUT_FLUSH_SIZE = 10
+        config.OUTPUT_FLUSH_INTERVAL = 1
+        with mock.patch('os.path.exists', mock.Mock(side_effect=[True, False])), \
+                mock.patch('source.lib.worker.TaskPipeline.flush') as m_flush:
+            worker(config, 1)
+        self.assertEqual(m_worker_batch_loop_function.call_count, 1)
+        m_flush.assert_called_once_with()
+
+    @mock.patch('source.lib.worker.get_tube', mock.Mock(side_effect=[
+        mock.MagicMock(name="input_tube"),
+        mock.MagicMock(name='output_tube')
+    ]))
+    @mock.patch('source.lib.worker.init_worker_resources', mock.Mock())
+    @mock.patch('source.lib.worker.install_stop_handler', mock.Mock())
     @mock.patch('source.lib.worker.worker_loop_function')
     def test_worker_parent_not_exists(self, m_worker_loop_function):
+        config = MockConfig()
+        config.WORKER_BATCH_SIZE = 1
+        config.FETCHERS_PER_WORKER = 1
+        config.ASYNC_RESULT_WRITER = False
         with mock.patch('os.path.exists', mock.Mock(return_value=False)):
-            worker(MockConfig(), 1)
+            worker(config, 1)
         self.assertEqual(m_worker_loop_function.call_count, 0)
 
+    @mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=mock.MagicMock()))
+    @mock.patch('source.lib.worker.init_worker_resources', mock.Mock())
+    @mock.patch('source.lib.worker.install_stop_handler', mock.Mock())
+    @mock.patch('source.lib.worker.stopping', True)
+    @mock.patch('source.lib.worker.worker_loop_function')
+    def test_worker_stopping(self, m_worker_loop_function):
+        config = MockConfig()
+        config.WORKER_BATCH_SIZE = 1
+        config.FETCHERS_PER_WORKER = 1
+        config.ASYNC_RESULT_WRITER = False
+        with mock.patch('os.path.exists', mock.Mock(return_value=True)):
+            worker(config, 1)
+        self.assertFalse(m_worker_loop_function.called)
+
+    @mock.patch('source.lib.worker.stopping', False)
+    def test_stop_handler(self):
+        import source.lib.worker
+        stop_handler(15, None)
+        self.assertTrue(source.lib.worker.stopping)
+
+    @mock.patch('signal.signal')
+    @mock.patch('signal.siginterrupt')
+    def test_install_stop_handler(self, m_siginterrupt, m_signal):
+        import signal
+        install_stop_handler()
+        m_signal.assert_called_once_with(signal.SIGTERM, stop_handler)
+        m_siginterrupt.assert_called_once_with(signal.SIGTERM, False)
+
+    @mock.patch('source.lib.worker.init_redirect_rules')
+    @mock.patch('source.lib.worker.init_preflight')
+    @mock.patch('source.lib.worker.init_singleflight')
+    @mock.patch('source.lib.worker.init_circuit_breaker')
+    @mock.patch('source.lib.worker.init_hop_cache')
+    @mock.patch('source.lib.worker.init_curl_pool')
+    @mock.patch('source.lib.worker.init_buffer_pool')
+    def test_init_worker_resources(self, m_init_buffer_pool, m_init_curl_pool, m_init_hop_cache,
+                                   m_init_circuit_breaker, m_init_singleflight, m_init_preflight,
+                                   m_init_redirect_rules):
+        config = MockConfig()
+        config.REDIRECT_RULES = [('click', r'http://click/\?u=(.+)', r'\1', 'http_status')]
+        config.PREFLIGHT_ALLOW = []
+        config.PREFLIGHT_DENY = ['^http://ads\\.']
+        init_worker_resources(config)
+        m_init_redirect_rules.assert_called_once_with(config.REDIRECT_RULES)
+        m_init_preflight.assert_called_once_with(
+            config.PREFLIGHT_ALLOW, config.PREFLIGHT_DENY, config.PREFLIGHT_SCHEMES,
+            config.PREFLIGHT_BLOCK_PRIVATE, config.PREFLIGHT_DNS_TTL
+        )
+        m_init_singleflight.assert_called_once_with(config.SINGLEFLIGHT_PATH, config.SINGLEFLIGHT_WAIT_TIMEOUT)
+        m_init_curl_pool.assert_called_once_with(config.CURL_POOL_SIZE, config.CURL_POOL_IDLE_TIMEOUT)
+        m_init_buffer_pool.assert_called_once_with(
+            config.RECEIVE_BUFFER_POOL_SIZE, config.RECEIVE_BUFFER_SIZE, config.RECEIVE_BUFFER_MAX_SIZE
+        )
+        m_init_hop_cache.assert_called_once_with(config.HOP_CACHE_PATH, config.HOP_CACHE_TTL, config.HOP_CACHE_SIZE)
+        m_init_circuit_breaker.assert_called_once_with(
+            config.CIRCUIT_BREAKER_FAILURES, config.CIRCUIT_BREAKER_RESET_TIMEOUT
+        )
+
+    @mock.patch('source.lib.worker.init_redirect_rules')
+    @mock.patch('source.lib.worker.init_preflight')
+    @mock.patch('source.lib.worker.init_singleflight')
+    @mock.patch('source.lib.worker.init_circuit_breaker')
+    @mock.patch('source.lib.worker.init_hop_cache')
+    @mock.patch('source.lib.worker.init_curl_pool')
+    @mock.patch('source.lib.worker.init_buffer_pool')
+    def test_init_worker_resources_disabled(self, m_init_buffer_pool, m_init_curl_pool, m_init_hop_cache,
+                                            m_init_circuit_breaker, m_init_singleflight, m_init_preflight,
+                                            m_init_redirect_rules):
+        from source.lib.utils import Config
+        config = Config()
+        config.CURL_POOL_SIZE = 0
+        config.RECEIVE_BUFFER_POOL_SIZE = 0
+        config.HOP_CACHE_PATH = None
+        config.CIRCUIT_BREAKER_FAILURES = 0
+        config.SINGLEFLIGHT = False
+        config.PREFLIGHT = False
+        config.REDIRECT_RULES = []
+        init_worker_resources(config)
+        self.assertFalse(m_init_redirect_rules.called)
+        self.assertFalse(m_init_preflight.called)
+        self.assertFalse(m_init_singleflight.called)
+        self.assertFalse(m_init_curl_pool.called)
+        self.assertFalse(m_init_buffer_pool.called)
+        self.assertFalse(m_init_hop_cache.called)
+        self.assertFalse(m_init_circuit_breaker.called)
+
     def test_worker_loop_function_input_tube_timeout(self):
         input_tube = mock.MagicMock(name="input_tube")
         input_tube.take.return_value = None
@@ -59,7 +181,7 @@ class LibWorkerCase(unittest.TestCase):
         task.meta.return_value = task_meta_return_data
         output_tube = mock.MagicMock(name='output_tube')
         is_input = True
-        data = 'data'
+        data = {'url': 'url', 'recheck': 1, 'recheck_delay': 60}
         from source.lib.utils import Config
         config = Config()
         config.QUEUE_TAKE_TIMEOUT = 1
@@ -67,9 +189,21 @@ class LibWorkerCase(unittest.TestCase):
         config.MAX_REDIRECTS = 1
         config.USER_AGENT = "Chrome/31.0.1650.63 Safari/537.36"
         config.RECHECK_DELAY = 1
+        config.RECHECK_SHORT_DELAY = 1
+        config.RECHECK_MAX_DELAY = 1
+        config.RECHECK_MAX_ATTEMPTS = 1
+        config.STREAM_BODY_SCAN = False
+        config.META_PARSER = 'bs4'
+        config.CHAIN_TIMEOUT = None
+        config.HTTP_CONNECT_TIMEOUT = None
+        config.HOP_TIMINGS_IN_RESULT = False
+        config.RESULT_ENCODING = 'plain'
+        config.MAX_BODY_SIZE = 0
+        config.HEAD_FIRST = False
+        config.HTTP_ENCODING = None
         with mock.patch('source.lib.worker.get_redirect_history_from_task', mock.Mock(return_value=(is_input, data))):
             worker_loop_function(config, input_tube, output_tube)
-        input_tube.put.assert_called_once_with(data, delay=config.RECHECK_DELAY, pri=task_meta_return_data['pri'])
+        input_tube.put.assert_called_once_with(data, delay=60, pri=task_meta_return_data['pri'])
 
     @mock.patch('source.lib.worker.get_redirect_history_from_task', mock.Mock(return_value=None))
     def test_worker_loop_function_task_ack(self):
@@ -98,7 +232,7 @@ class LibWorkerCase(unittest.TestCase):
         history_types = 'ERROR'
         history_urls = ['urls']
         counters = 1
-        with mock.patch('source.lib.worker.get_redirect_history',
+        with mock.patch('source.lib.worker.get_coalesced_redirect_history',
                         mock.Mock(return_value=(history_types, history_urls, counters))):
             result = get_redirect_history_from_task(task, 0)
         self.assertTrue(result[0])
@@ -109,13 +243,106 @@ class LibWorkerCase(unittest.TestCase):
         history_types = 'OK'
         history_urls = ['urls']
         counters = 1
-        with mock.patch('source.lib.worker.get_redirect_history',
+        with mock.patch('source.lib.worker.get_coalesced_redirect_history',
                         mock.Mock(return_value=(history_types, history_urls, counters))):
             result = get_redirect_history_from_task(task, 0)
         self.assertFalse(result[0])
         self.assertNotEqual(result[1], task.data)
 
-    @mock.patch('source.lib.worker.get_redirect_history', mock.Mock(return_value=('OK', None, 0)))
+    def _error_history(self, error_class):
+        def get_history(*args, **kwargs):
+            kwargs['errors'].append(error_class)
+            return ['ERROR'], ['http://url', 'http://url'], []
+        return mock.patch('source.lib.worker.get_coalesced_redirect_history', mock.Mock(side_effect=get_history))
+
+    def test_get_redirect_history_from_task_permanent_error(self):
+        task = mock.MagicMock(name='task')
+        task.data = {'url': 'http://url', 'url_id': 1}
+        with self._error_history('permanent'):
+            is_input, data = get_redirect_history_from_task(task, 0, recheck_policy=RecheckPolicy(max_attempts=3))
+        self.assertFalse(is_input)
+        self.assertEqual(data['result'], [['ERROR'], ['http://url', 'http://url'], []])
+
+    def test_get_redirect_history_from_task_backoff(self):
+        task = mock.MagicMock(name='task')
+        task.data = {'url': 'http://url', 'url_id': 1, 'recheck': 2}
+        with self._error_history('connect'):
+            is_input, data = get_redirect_history_from_task(task, 0, recheck_policy=RecheckPolicy(max_attempts=3))
+        self.assertTrue(is_input)
+        self.assertEqual(data['recheck'], 3)
+        self.assertEqual(data['error_class'], 'connect')
+        self.assertEqual(data['recheck_delay'], 1200)
+
+    def test_get_redirect_history_from_task_rechecks_exhausted(self):
+        task = mock.MagicMock(name='task')
+        task.data = {'url': 'http://url', 'url_id': 1, 'recheck': True}
+        with self._error_history('transient'):
+            is_input, data = get_redirect_history_from_task(task, 0)
+        self.assertFalse(is_input)
+
+    def test_recheck_policy(self):
+        policy = RecheckPolicy(delay=300, short_delay=60, max_delay=1000, max_attempts=4)
+        self.assertIsNone(policy.get_delay('permanent', 1))
+        self.assertEqual(policy.get_delay('transient', 2), 60)
+        self.assertEqual([policy.get_delay('connect', attempt) for attempt in (1, 2, 3)], [300, 600, 1000])
+        self.assertEqual(policy.get_delay(None, 1), 300)
+        self.assertIsNone(policy.get_delay('transient', 5))
+
+    def test_get_recheck_policy(self):
+        config = MockConfig()
+        policy = get_recheck_policy(config)
+        self.assertEqual(policy.max_attempts, config.RECHECK_MAX_ATTEMPTS)
+        self.assertEqual(policy.short_delay, config.RECHECK_SHORT_DELAY)
+
+    def test_get_check_options(self):
+        config = MockConfig()
+        self.assertEqual(get_check_options(config), {
+            'stream': config.STREAM_BODY_SCAN,
+            'meta_parser': config.META_PARSER,
+            'deadline': config.CHAIN_TIMEOUT,
+            'connect_timeout': config.HTTP_CONNECT_TIMEOUT,
+            'max_body': config.MAX_BODY_SIZE,
+            'head_first': config.HEAD_FIRST,
+            'encoding': config.HTTP_ENCODING,
+        })
+
+    def test_get_redirect_history_from_task_timings(self):
+        task = mock.MagicMock(name='task')
+        task.data = {'url': 'url', 'url_id': 1}
+
+        def get_history(*args, **kwargs):
+            kwargs['timings'].append({'url': 'url', 'total_time': 0.1})
+            return [], ['url'], []
+
+        with mock.patch('source.lib.worker.get_coalesced_redirect_history', mock.Mock(side_effect=get_history)):
+            is_input, data = get_redirect_history_from_task(task, 0, with_timings=True)
+        self.assertEqual(data['timings'], [{'url': 'url', 'total_time': 0.1}])
+
+    def test_get_redirect_history_from_task_no_timings(self):
+        task = mock.MagicMock(name='task')
+        task.data = {'url': 'url', 'url_id': 1}
+        with mock.patch('source.lib.worker.get_coalesced_redirect_history',
+                        mock.Mock(return_value=([], ['url'], []))) as m_get_redirect_history:
+            is_input, data = get_redirect_history_from_task(task, 0)
+        self.assertNotIn('timings', data)
+        self.assertIsNone(m_get_redirect_history.call_args[1]['timings'])
+
+    def test_get_redirect_history_from_task_compact(self):
+        task = mock.MagicMock(name='task')
+        task.data = {'url': 'url', 'url_id': 1}
+        with mock.patch('source.lib.worker.get_coalesced_redirect_history',
+                        mock.Mock(return_value=(['http_status'], [u'http://url/a', u'http://url/b'], []))):
+            is_input, data = get_redirect_history_from_task(task, 0, result_encoding='compact')
+        self.assertEqual(data['result'], {'t': 'h', 'u': [u'http://url/a', [11, u'b']], 'c': []})
+
+    def test_get_redirect_history_from_task_stream(self):
+        task = mock.MagicMock(name='task')
+        with mock.patch('source.lib.worker.get_coalesced_redirect_history',
+                        mock.Mock(return_value=([], ['url'], []))) as m_get_redirect_history:
+            get_redirect_history_from_task(task, 0, stream=True)
+        self.assertTrue(m_get_redirect_history.call_args[1]['stream'])
+
+    @mock.patch('source.lib.worker.get_coalesced_redirect_history', mock.Mock(return_value=('OK', None, 0)))
     def test_get_redirect_history_from_task_history_with_suspicious_in_data(self):
         task = mock.MagicMock(name='task')
         task.data = {
@@ -127,7 +354,7 @@ class LibWorkerCase(unittest.TestCase):
         result = get_redirect_history_from_task(task, 0)
         self.assertEqual(result[1]['suspicious'], task.data['suspicious'])
 
-    @mock.patch('source.lib.worker.get_redirect_history', mock.Mock(return_value=('OK', None, 0)))
+    @mock.patch('source.lib.worker.get_coalesced_redirect_history', mock.Mock(return_value=('OK', None, 0)))
     def test_get_redirect_history_from_task_history_with_out_suspicious_in_data(self):
         task = mock.MagicMock(name='task')
         task.data = {
@@ -138,8 +365,342 @@ class LibWorkerCase(unittest.TestCase):
         result = get_redirect_history_from_task(task, 0)
         self.assertFalse('suspicious' in result[1])
 
+    def _batch_config(self):
+        from source.lib.utils import Config
+        config = Config()
+        config.WORKER_BATCH_SIZE = 3
+        config.QUEUE_TAKE_TIMEOUT = 1
+        config.HTTP_TIMEOUT = 1
+        config.MAX_REDIRECTS = 10
+        config.USER_AGENT = None
+        config.HOP_TIMINGS_IN_RESULT = False
+        config.RESULT_ENCODING = 'plain'
+        config.RECHECK_DELAY = 300
+        config.RECHECK_SHORT_DELAY = 60
+        config.RECHECK_MAX_DELAY = 3600
+        config.RECHECK_MAX_ATTEMPTS = 3
+        return config
+
+    def test_take_tasks(self):
+        tube = mock.Mock()
+        tube.take.side_effect = ['task1', 'task2', 'task3', 'task4']
+        self.assertEqual(take_tasks(tube, 3, 5), ['task1', 'task2', 'task3'])
+        self.assertEqual(tube.take.call_args_list, [mock.call(5), mock.call(0.001), mock.call(0.001)])
+
+    def test_take_tasks_queue_drained(self):
+        tube = mock.Mock()
+        tube.take.side_effect = ['task1', None]
+        self.assertEqual(take_tasks(tube, 3, 5), ['task1'])
+
+    def test_get_redirect_histories_from_tasks(self):
+        tasks = [mock.Mock(task_id=1, data={'url': 'http://url1', 'url_id': 1}),
+                 mock.Mock(task_id=2, data={'url': 'http://url2', 'url_id': 2, 'suspicious': 'x'})]
+
+        def get_histories(urls, *args, **kwargs):
+            kwargs['timings'].extend([[{'url': 'http://url1'}], []])
+            kwargs['errors'].extend(['connect', None])
+            return [(['ERROR'], ['http://url1', 'http://url1'], []), ([], ['http://url2'], [])]
+
+        with mock.patch('source.lib.worker.get_redirect_histories', mock.Mock(side_effect=get_histories)) as m_get:
+            results = get_redirect_histories_from_tasks(tasks, 1, 10, with_timings=True, stream=True)
+        self.assertEqual(m_get.call_args[0][0], [u'http://url1', u'http://url2'])
+        self.assertEqual(m_get.call_args[1]['concurrency'], 2)
+        self.assertTrue(m_get.call_args[1]['stream'])
+        self.assertEqual(results[0], (True, {
+            'url': 'http://url1', 'url_id': 1, 'recheck': 1, 'error_class': 'connect', 'recheck_delay': 300
+        }))
+        self.assertEqual(results[1], (False, {
+            'url_id': 2, 'result': [[], ['http://url2'], []], 'check_type': 'normal', 'suspicious': 'x',
+            'timings': [],
+        }))
+
+    def test_worker_batch_loop_function(self):
+        config = self._batch_config()
+        tasks = [mock.Mock(task_id=1), mock.Mock(task_id=2)]
+        tasks[0].meta.return_value = {'pri': 7}
+        input_tube, output_tube = mock.Mock(), mock.Mock()
+        input_tube.take.side_effect = tasks + [None]
+        pipeline = TaskPipeline(flush_size=2)
+        results = [(True, {'recheck_delay': 300}), (False, 'result')]
+        with mock.patch('source.lib.worker.get_redirect_histories_from_tasks', mock.Mock(return_value=results)), \
+                mock.patch('source.lib.worker.get_check_options', mock.Mock(return_value={})):
+            worker_batch_loop_function(config, input_tube, output_tube, pipeline)
+        input_tube.put.assert_called_once_with({'recheck_delay': 300, 'pri': 7}, delay=300, pri=7)
+        output_tube.put.assert_called_once_with('result')
+        tasks[0].ack.assert_called_once_with()
+        tasks[1].ack.assert_called_once_with()
+        self.assertEqual(pipeline.pending, [])
+
+    def test_task_pipeline_waits(self):
+        pipeline = TaskPipeline(flush_size=2, flush_interval=10)
+        task, tube = mock.Mock(), mock.Mock()
+        with mock.patch('time.time', mock.Mock(side_effect=[100, 105, 111])):
+            pipeline.add(task, tube, 'data')
+            self.assertFalse(pipeline.is_due())
+            self.assertTrue(pipeline.is_due())
+        self.assertFalse(tube.put.called)
+        self.assertEqual(pipeline.flush(), 1)
+        tube.put.assert_called_once_with('data')
+        task.ack.assert_called_once_with()
+
+    def test_task_pipeline_ack_after_put(self):
+        pipeline = TaskPipeline()
+        task, tube = mock.Mock(), mock.Mock()
+        tube.put.side_effect = DatabaseError
+        pipeline.add(task, tube, 'data')
+        self.assertRaises(DatabaseError, pipeline.flush)
+        self.assertFalse(task.ack.called)
+        self.assertEqual(len(pipeline.pending), 1)
 
+    def test_ack_task_counts_acked(self):
+        from multiprocessing import Value
+        acked = Value('L', 0)
+        task = mock.Mock()
+        task.ack.side_effect = [None, DatabaseError]
+        with mock.patch('source.lib.worker.acked_tasks', acked), mock.patch('source.lib.worker.logger', mock.Mock()):
+            ack_task(task)
+            ack_task(task)
+        self.assertEqual(acked.value, 1)
+
+    def test_result_writer_put_then_ack(self):
+        writer = ResultWriter(max_pending=2)
+        calls = mock.Mock()
+        task, tube = calls.task, calls.tube
+        writer.add(task, tube, 'data', delay=5)
+        writer.flush()
+        writer.close()
+        self.assertEqual(calls.mock_calls, [mock.call.tube.put('data', delay=5), mock.call.task.ack()])
+        self.assertFalse(writer.thread.is_alive())
+
+    @mock.patch('source.lib.worker.logger', mock.Mock())
+    def test_result_writer_put_error(self):
+        writer = ResultWriter()
+        first, second, tube = mock.Mock(), mock.Mock(), mock.Mock()
+        tube.put.side_effect = [DatabaseError, None]
+        writer.add(first, tube, 'first')
+        writer.add(second, tube, 'second')
+        self.assertRaises(DatabaseError, writer.flush)
+        self.assertRaises(DatabaseError, writer.add, mock.Mock(), tube, 'third')
+        writer.close()
+        tube.put.assert_called_once_with('first')
+        self.assertFalse(first.ack.called)
+        self.assertFalse(second.ack.called)
+
+    def test_worker_loop_function_with_writer(self):
+        input_tube, output_tube, writer = mock.Mock(), mock.Mock(), mock.Mock()
+        task = input_tube.take.return_value
+        with mock.patch('source.lib.worker.get_redirect_history_from_task', mock.Mock(return_value=(False, 'data'))):
+            worker_loop_function(MockConfig(), input_tube, output_tube, writer)
+        writer.add.assert_called_once_with(task, output_tube, 'data')
+        self.assertFalse(output_tube.put.called)
+        self.assertFalse(task.ack.called)
+
+    def test_worker_loop_function_recheck_with_writer(self):
+        input_tube, output_tube, writer = mock.Mock(), mock.Mock(), mock.Mock()
+        task = input_tube.take.return_value
+        data = {'recheck_delay': 60}
+        with mock.patch('source.lib.worker.get_redirect_history_from_task', mock.Mock(return_value=(True, data))):
+            worker_loop_function(MockConfig(), input_tube, output_tube, writer)
+        writer.add.assert_called_once_with(task, input_tube, data, delay=60, pri=None)
+        self.assertFalse(task.meta.called)
+
+    def test_result_writer_recheck_pri(self):
+        writer = ResultWriter()
+        task, tube = mock.Mock(), mock.Mock()
+        task.meta.return_value = {'pri': 7}
+        data = {'recheck_delay': 60}
+        writer.add(task, tube, data, delay=60, pri=None)
+        writer.close()
+        tube.put.assert_called_once_with({'recheck_delay': 60, 'pri': 7}, delay=60, pri=7)
+        task.ack.assert_called_once_with()
+
+    def test_worker_loop_function_recheck_carried_pri(self):
+        input_tube, output_tube = mock.Mock(), mock.Mock()
+        task = input_tube.take.return_value
+        data = {'recheck_delay': 60, 'pri': 3}
+        with mock.patch('source.lib.worker.get_redirect_history_from_task', mock.Mock(return_value=(True, data))):
+            worker_loop_function(MockConfig(), input_tube, output_tube)
+        input_tube.put.assert_called_once_with(data, delay=60, pri=3)
+        self.assertFalse(task.meta.called)
+        task.ack.assert_called_once_with()
+
+    @mock.patch('source.lib.worker.init_worker_resources', mock.Mock())
+    @mock.patch('source.lib.worker.install_stop_handler', mock.Mock())
+    @mock.patch('source.lib.worker.worker_loop_function')
+    @mock.patch('source.lib.worker.ResultWriter')
+    @mock.patch('source.lib.worker.get_tube')
+    def test_worker_async_result_writer(self, m_get_tube, m_result_writer, m_worker_loop_function):
+        config = MockConfig()
+        config.WORKER_BATCH_SIZE = 1
+        config.FETCHERS_PER_WORKER = 1
+        config.ASYNC_RESULT_WRITER = True
+        config.RESULT_WRITER_QUEUE_SIZE = 10
+        with mock.patch('os.path.exists', mock.Mock(side_effect=[True, False])):
+            worker(config, 1)
+        self.assertTrue(m_get_tube.call_args_list[0][1]['thread_safe'])
+        m_result_writer.assert_called_once_with(10)
+        writer = m_result_writer.return_value
+        m_worker_loop_function.assert_called_once_with(
+            config, m_get_tube.return_value, m_get_tube.return_value, writer
+        )
+        writer.close.assert_called_once_with()
+
+    def test_wait_for_network(self):
+        self.assertTrue(wait_for_network(None))
+        network_up = mock.Mock()
+        network_up.is_set.return_value = True
+        self.assertTrue(wait_for_network(network_up))
+        network_up.is_set.return_value = False
+        self.assertFalse(wait_for_network(network_up, 2))
+        network_up.wait.assert_called_once_with(2)
+        on_pause = mock.Mock()
+        self.assertFalse(wait_for_network(network_up, on_pause=on_pause))
+        on_pause.assert_called_once_with()
+
+    @mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=mock.MagicMock()))
+    @mock.patch('source.lib.worker.init_worker_resources', mock.Mock())
+    @mock.patch('source.lib.worker.install_stop_handler', mock.Mock())
+    @mock.patch('source.lib.worker.worker_loop_function')
+    def test_worker_paused(self, m_worker_loop_function):
+        config = MockConfig()
+        config.WORKER_BATCH_SIZE = 1
+        config.FETCHERS_PER_WORKER = 1
+        config.ASYNC_RESULT_WRITER = False
+        network_up = mock.Mock()
+        network_up.is_set.side_effect = [False, True]
+        with mock.patch('os.path.exists', mock.Mock(side_effect=[True, True, False])):
+            worker(config, 1, network_up)
+        self.assertEqual(m_worker_loop_function.call_count, 1)
+        self.assertEqual(network_up.wait.call_count, 1)
+
+    @mock.patch('source.lib.worker.init_worker_resources', mock.Mock())
+    @mock.patch('source.lib.worker.install_stop_handler', mock.Mock())
+    @mock.patch('source.lib.worker.run_fetchers')
+    @mock.patch('source.lib.worker.init_fetchers')
+    @mock.patch('source.lib.worker.get_tube')
+    def test_worker_fetchers_mode(self, m_get_tube, m_init_fetchers, m_run_fetchers):
+        config = MockConfig()
+        config.WORKER_BATCH_SIZE = 10
+        config.FETCHERS_PER_WORKER = 4
+        config.ASYNC_RESULT_WRITER = False
+        network_up = mock.Mock()
+        with mock.patch('os.path.exists', mock.Mock(return_value=False)), \
+                mock.patch('source.lib.worker.worker_batch_loop_function') as m_batch_loop:
+            worker(config, 1, network_up)
+        m_init_fetchers.assert_called_once_with()
+        self.assertTrue(m_get_tube.call_args_list[0][1]['thread_safe'])
+        self.assertTrue(m_get_tube.call_args_list[1][1]['thread_safe'])
+        m_run_fetchers.assert_called_once_with(config, '/proc/1', m_get_tube.return_value,
+                                               m_get_tube.return_value, None, network_up)
+        self.assertFalse(m_batch_loop.called)
+
+    @mock.patch('source.lib.worker.gevent_sleep')
+    @mock.patch('source.lib.worker.worker_loop_function')
+    def test_fetcher_loop(self, m_worker_loop_function, m_gevent_sleep):
+        network_up = mock.Mock()
+        network_up.is_set.side_effect = [False, True]
+        with mock.patch('os.path.exists', mock.Mock(side_effect=[True, True, False])):
+            fetcher_loop('config', '/proc/1', 'input', 'output', 'writer', network_up)
+        m_worker_loop_function.assert_called_once_with('config', 'input', 'output', 'writer')
+        m_gevent_sleep.assert_called_once_with(1)
+        self.assertFalse(network_up.wait.called)
+
+    @mock.patch('source.lib.worker.log_metrics')
+    @mock.patch('source.lib.worker.Pool')
+    def test_run_fetchers(self, m_pool, m_log_metrics):
+        config = MockConfig()
+        config.FETCHERS_PER_WORKER = 3
+        config.METRICS_LOG_INTERVAL = 60
+        pool = m_pool.return_value
+        pool.__len__ = mock.Mock(side_effect=[3, 0])
+        run_fetchers(config, '/proc/1', 'input', 'output')
+        m_pool.assert_called_once_with(3)
+        self.assertEqual(pool.spawn.call_args_list,
+                         [mock.call(fetcher_loop, config, '/proc/1', 'input', 'output', None, None)] * 3)
+        pool.join.assert_called_once_with(timeout=60, raise_error=True)
+        m_log_metrics.assert_called_once_with()
+
+    @mock.patch('source.lib.worker.get_hop_cache_report', mock.Mock(return_value=u'hits=3 misses=1'))
+    @mock.patch('source.lib.worker.get_preflight_report', mock.Mock(return_value=u'saved=2'))
+    @mock.patch('source.lib.worker.get_rules_report', mock.Mock(return_value=u'market=1'))
+    @mock.patch('source.lib.worker.logger')
+    def test_log_metrics(self, m_logger):
+        log_metrics()
+        messages = [c[0][0] for c in m_logger.info.call_args_list]
+        self.assertIn(u'Redirect rule hits: market=1', messages)
+        self.assertIn(u'Preflight: saved=2', messages)
+        self.assertIn(u'Hop cache: hits=3 misses=1', messages)
+
+    @mock.patch('source.lib.worker.get_hop_cache_report', mock.Mock(return_value=None))
+    @mock.patch('source.lib.worker.get_preflight_report', mock.Mock(return_value=None))
+    @mock.patch('source.lib.worker.logger')
+    def test_log_metrics_optional_reports(self, m_logger):
+        log_metrics()
+        self.assertEqual(m_logger.info.call_count, 2)
+
+    @mock.patch('source.lib.worker.init_cooperative_curl')
+    @mock.patch('source.lib.worker.patch_all')
+    def test_init_fetchers(self, m_patch_all, m_init_cooperative_curl):
+        init_fetchers()
+        m_patch_all.assert_called_once_with()
+        m_init_cooperative_curl.assert_called_once_with(gevent_select.select)
+
+    def test_worker_batch_loop_function_no_tasks(self):
+        config = self._batch_config()
+        input_tube, pipeline = mock.Mock(), mock.Mock()
+        input_tube.take.return_value = None
+        pipeline.is_due.return_value = False
+        with mock.patch('source.lib.worker.get_redirect_histories_from_tasks') as m_get_histories:
+            worker_batch_loop_function(config, input_tube, mock.Mock(), pipeline)
+        self.assertFalse(m_get_histories.called)
+        self.assertFalse(pipeline.flush.called)
 
+    def test_result_writer_is_never_due(self):
+        writer = ResultWriter()
+        self.assertFalse(writer.is_due())
+        writer.close()
 
+    @mock.patch('source.lib.worker.log_metrics')
+    @mock.patch('source.lib.worker.Pool')
+    def test_run_fetchers_without_metrics(self, m_pool, m_log_metrics):
+        config = MockConfig()
+        config.FETCHERS_PER_WORKER = 2
+        config.METRICS_LOG_INTERVAL = 0
+        pool = m_pool.return_value
+        pool.__len__ = mock.Mock(side_effect=[2, 0])
+        run_fetchers(config, '/proc/1', 'input', 'output')
+        pool.join.assert_called_once_with(timeout=None, raise_error=True)
+        self.assertFalse(m_log_metrics.called)
 
+    @mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=mock.MagicMock()))
+    @mock.patch('source.lib.worker.init_worker_resources', mock.Mock())
+    @mock.patch('source.lib.worker.install_stop_handler', mock.Mock())
+    @mock.patch('source.lib.worker.worker_loop_function', mock.Mock())
+    @mock.patch('source.lib.worker.log_metrics')
+    def test_worker_logs_metrics(self, m_log_metrics):
+        config = MockConfig()
+        config.WORKER_BATCH_SIZE = 1
+        config.FETCHERS_PER_WORKER = 1
+        config.ASYNC_RESULT_WRITER = False
+        config.METRICS_LOG_INTERVAL = 60
+        with mock.patch('os.path.exists', mock.Mock(side_effect=[True, True, False])), \
+                mock.patch('source.lib.worker.time') as m_time:
+            m_time.time.side_effect = [0, 30, 61, 61]
+            worker(config, 1)
+        m_log_metrics.assert_called_once_with()
 
+    @mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=mock.MagicMock()))
+    @mock.patch('source.lib.worker.init_worker_resources', mock.Mock())
+    @mock.patch('source.lib.worker.install_stop_handler', mock.Mock())
+    @mock.patch('source.lib.worker.worker_batch_loop_function', mock.Mock())
+    @mock.patch('source.lib.worker.TaskPipeline')
+    def test_worker_paused_flushes_results(self, m_pipeline):
+        config = MockConfig()
+        config.WORKER_BATCH_SIZE = 10
+        config.FETCHERS_PER_WORKER = 1
+        config.ASYNC_RESULT_WRITER = False
+        network_up = mock.Mock()
+        network_up.is_set.side_effect = [True, False]
+        with mock.patch('os.path.exists', mock.Mock(side_effect=[True, True, False])):
+            worker(config, 1, network_up)
+        self.assertEqual(m_pipeline.return_value.flush.call_count, 2)
@@ -31,6 +31,8 @@ class RedirectCheckerTestCase(unittest.TestCase):
     @mock.patch('source.redirect_checker.parse_cmd_args', mock.Mock())
     @mock.patch('source.redirect_checker.configuration', mock.Mock())
     @mock.patch('source.redirect_checker.dictConfig', mock.Mock())
+    @mock.patch('source.redirect_checker.init_autoscaler', mock.Mock())
+    @mock.patch('source.redirect_checker.init_network_prober', mock.Mock())
     @mock.patch('source.redirect_checker.main_loop_function')
     def test_main_loop(self, m_main_loop_function):
         with mock.patch('source.redirect_checker.sleep', mock.Mock(side_effect=break_while)):
@@ -80,6 +82,98 @@ class RedirectCheckerTestCase(unittest.TestCase):
             redirect_checker.main_loop_function(config, 10)
         self.assertEqual(m_spawn_workers.called, False)
 
+    def test_get_pool_size_without_autoscale(self):
+        config = Config()
+        config.WORKER_POOL_SIZE = 5
+        self.assertEqual(redirect_checker.get_pool_size(config, 3), 5)
+
+    @mock.patch('source.redirect_checker.acked_tasks', mock.Mock(value=40))
+    @mock.patch('source.redirect_checker.input_tube')
+    @mock.patch('source.redirect_checker.scaler')
+    def test_get_pool_size_autoscale(self, m_scaler, m_input_tube):
+        m_input_tube.statistics.return_value = {'ack': '1000', 'tasks': {'ready': '100'}}
+        m_scaler.get_pool_size.return_value = 7
+        self.assertEqual(redirect_checker.get_pool_size(Config(), 3), 7)
+        m_scaler.get_pool_size.assert_called_once_with(3, 100, 40)
+
+    @mock.patch('source.redirect_checker.prober', None)
+    def test_get_worker_kwargs(self):
+        acked = mock.Mock()
+        with mock.patch('source.redirect_checker.acked_tasks', None):
+            self.assertIsNone(redirect_checker.get_worker_kwargs())
+        with mock.patch('source.redirect_checker.acked_tasks', acked):
+            self.assertEqual(redirect_checker.get_worker_kwargs(), {'acked': acked})
+
+    @mock.patch('source.redirect_checker.logger', mock.Mock())
+    @mock.patch('source.redirect_checker.input_tube')
+    @mock.patch('source.redirect_checker.scaler', mock.Mock(min_workers=2, max_workers=10))
+    def test_get_pool_size_no_stats(self, m_input_tube):
+        m_input_tube.statistics.side_effect = redirect_checker.DatabaseError
+        self.assertEqual(redirect_checker.get_pool_size(Config(), 0), 2)
+        self.assertEqual(redirect_checker.get_pool_size(Config(), 4), 4)
+
+    @mock.patch('source.redirect_checker.retiring', set([3]))
+    def test_retire_workers(self):
+        children = [mock.Mock(pid=pid) for pid in (1, 2, 3, 4)]
+        with mock.patch('source.redirect_checker.active_children', mock.Mock(return_value=children)):
+            workers = redirect_checker.get_workers()
+        self.assertEqual([child.pid for child in workers], [1, 2, 4])
+        redirect_checker.retire_workers(workers, 1)
+        self.assertTrue(children[3].terminate.called)
+        self.assertFalse(children[0].terminate.called)
+        self.assertEqual(redirect_checker.retiring, set([3, 4]))
+
+    @mock.patch('source.redirect_checker.check_network_status', mock.Mock(return_value=True))
+    @mock.patch('source.redirect_checker.get_pool_size', mock.Mock(return_value=3))
+    @mock.patch('source.redirect_checker.spawn_workers')
+    @mock.patch('source.redirect_checker.retire_workers')
+    def test_main_loop_function_retire(self, m_retire_workers, m_spawn_workers):
+        config = Config()
+        config.CHECK_URL = 'url'
+        config.HTTP_TIMEOUT = 1
+        children = [mock.Mock(pid=pid) for pid in (1, 2, 3, 4, 5)]
+        with mock.patch('source.redirect_checker.get_workers', mock.Mock(return_value=children)):
+            redirect_checker.main_loop_function(config, 10)
+        m_retire_workers.assert_called_once_with(children, 2)
+        self.assertFalse(m_spawn_workers.called)
 
+    @mock.patch('source.redirect_checker.check_network_status')
+    @mock.patch('source.redirect_checker.spawn_workers')
+    def test_main_loop_function_prober_down(self, m_spawn_workers, m_check_network_status):
+        config = Config()
+        children = [mock.Mock(), mock.Mock()]
+        with mock.patch('source.redirect_checker.prober', mock.Mock(is_up=False)), \
+                mock.patch('source.redirect_checker.active_children', mock.Mock(return_value=children)):
+            redirect_checker.main_loop_function(config, 10)
+        self.assertFalse(m_check_network_status.called)
+        self.assertFalse(m_spawn_workers.called)
+        self.assertFalse(any(child.terminate.called for child in children))
 
+    @mock.patch('source.redirect_checker.worker')
+    @mock.patch('source.redirect_checker.get_pool_size', mock.Mock(return_value=2))
+    @mock.patch('source.redirect_checker.get_workers', mock.Mock(return_value=[]))
+    @mock.patch('source.redirect_checker.spawn_workers')
+    def test_main_loop_function_prober_up(self, m_spawn_workers, m_worker):
+        config = Config()
+        m_prober = mock.Mock(is_up=True)
+        with mock.patch('source.redirect_checker.prober', m_prober):
+            redirect_checker.main_loop_function(config, 10)
+        m_spawn_workers.assert_called_once_with(
+            num=2, target=m_worker, args=(config,), parent_pid=10, kwargs={'network_up': m_prober.network_up}
+        )
 
+    @mock.patch('source.redirect_checker.NetworkProber')
+    def test_init_network_prober(self, m_network_prober):
+        config = Config()
+        config.NETWORK_PROBE_URLS = ['http://url1', 'http://url2']
+        config.HTTP_TIMEOUT = 3
+        config.NETWORK_PROBE_INTERVAL = 5
+        config.NETWORK_PROBE_WINDOW = 6
+        config.NETWORK_DOWN_RATIO = 0.5
+        config.NETWORK_UP_RATIO = 0.8
+        with mock.patch('source.redirect_checker.prober', None):
+            self.assertEqual(redirect_checker.init_network_prober(config), m_network_prober.return_value)
+        m_network_prober.assert_called_once_with(
+            ['http://url1', 'http://url2'], 3, interval=5, window=6, down_ratio=0.5, up_ratio=0.8
+        )
+        m_network_prober.return_value.start.assert_called_once_with()
@@ -0,0 +1,126 @@
+import json
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+import unittest
+import mock
+from source.lib.utils import Config
+from source import redirect_checker_batch
+from source.redirect_checker_batch import check_record, read_records, read_windows, load_checkpoint, \
+    save_checkpoint, run_batch, main
+
+
+class FakePool(object):
+    def __init__(self, processes, initializer, initargs):
+        initializer(*initargs)
+
+    def imap(self, func, iterable):
+        return map(func, iterable)
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+def get_config():
+    config = Config()
+    config.HTTP_TIMEOUT = 1
+    config.MAX_REDIRECTS = 10
+    config.USER_AGENT = None
+    config.HOP_TIMINGS_IN_RESULT = False
+    config.RESULT_ENCODING = 'plain'
+    config.LOGGING = {}
+    return config
+
+
+class RedirectCheckerBatchCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        redirect_checker_batch.batch_config = get_config()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    @mock.patch('source.redirect_checker_batch.get_check_options', mock.Mock(return_value={}))
+    def test_check_record(self):
+        with mock.patch('source.redirect_checker_batch.get_redirect_history_from_task',
+                        mock.Mock(return_value=(False, {'url_id': 1}))) as m_get:
+            self.assertEqual(check_record('{"url": "http://url", "url_id": 1}'), '{"url_id": 1}\n')
+        self.assertEqual(m_get.call_args[0][0].data, {'url': 'http://url', 'url_id': 1})
+
+    @mock.patch('source.redirect_checker_batch.get_check_options', mock.Mock(return_value={}))
+    def test_check_record_recheck(self):
+        results = [(True, {}), (False, {'url_id': 1})]
+        with mock.patch('source.redirect_checker_batch.get_redirect_history_from_task',
+                        mock.Mock(side_effect=results)) as m_get:
+            self.assertEqual(check_record('{"url": "http://url", "url_id": 1}'), '{"url_id": 1}\n')
+        self.assertEqual(m_get.call_count, 2)
+
+    @mock.patch('source.redirect_checker_batch.logger', mock.Mock())
+    def test_check_record_bad(self):
+        for line in ('not json', '{"url": "http://url"}', '{"url_id": 1}', '[]'):
+            self.assertIsNone(check_record(line))
+
+    def test_read_records(self):
+        input_file = StringIO('a\n\nbb\n')
+        self.assertEqual(list(read_records(input_file)), [(2, 'a\n'), (6, 'bb\n')])
+        input_file.seek(0)
+        self.assertEqual(list(read_records(input_file, 2)), [(6, 'bb\n')])
+
+    def test_read_records_not_seekable(self):
+        input_file = mock.Mock()
+        input_file.seek.side_effect = IOError
+        input_file.readline.side_effect = ['a\n', 'bb\n', '']
+        self.assertEqual(list(read_records(input_file, 2)), [(5, 'bb\n')])
+
+    def test_read_windows(self):
+        self.assertEqual(list(read_windows(iter(xrange(5)), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_checkpoint(self):
+        path = os.path.join(self.dir, 'checkpoint')
+        self.assertEqual(load_checkpoint(path), (0, None))
+        save_checkpoint(path, 10, 20)
+        self.assertEqual(load_checkpoint(path), (10, 20))
+
+    @mock.patch('source.redirect_checker_batch.Pool', FakePool)
+    @mock.patch('source.redirect_checker_batch.init_worker_resources', mock.Mock())
+    @mock.patch('source.redirect_checker_batch.logger', mock.Mock())
+    def test_run_batch_resume(self):
+        checkpoint = os.path.join(self.dir, 'checkpoint')
+        output_path = os.path.join(self.dir, 'output')
+        lines = ''.join(json.dumps({'url': 'http://url', 'url_id': i}) + '\n' for i in xrange(5))
+        save_checkpoint(checkpoint, len(lines.splitlines(True)[0]), len('done\n'))
+        with open(output_path, 'w') as f:
+            f.write('done\npartial\n')
+
+        check = mock.Mock(side_effect=lambda line: str(json.loads(line)['url_id']) + '\n')
+        with mock.patch('source.redirect_checker_batch.check_record', check), open(output_path, 'r+') as output_file:
+            self.assertEqual(run_batch(get_config(), StringIO(lines), output_file, 2, 3, checkpoint), 4)
+        with open(output_path) as f:
+            self.assertEqual(f.read(), 'done\n1\n2\n3\n4\n')
+        self.assertEqual(load_checkpoint(checkpoint), (len(lines), len('done\n1\n2\n3\n4\n')))
+
+    @mock.patch('source.redirect_checker_batch.Pool', FakePool)
+    @mock.patch('source.redirect_checker_batch.init_worker_resources', mock.Mock())
+    @mock.patch('source.redirect_checker_batch.logger', mock.Mock())
+    @mock.patch('source.redirect_checker_batch.dictConfig', mock.Mock())
+    def test_main(self):
+        input_path = os.path.join(self.dir, 'input')
+        output_path = os.path.join(self.dir, 'output')
+        with open(input_path, 'w') as f:
+            f.write('{"url": "http://url", "url_id": 1}\n')
+        with mock.patch('source.redirect_checker_batch.load_config_from_pyfile', mock.Mock(return_value=get_config())), \
+                mock.patch('source.redirect_checker_batch.check_record', mock.Mock(return_value='result\n')):
+            self.assertEqual(main(['batch', '-c', 'config', '-i', input_path, '-o', output_path, '-j', '1']), 0)
+        with open(output_path) as f:
+            self.assertEqual(f.read(), 'result\n')
+
+    def test_main_checkpoint_requires_output(self):
+        with mock.patch('sys.stderr', mock.Mock()):
+            self.assertEqual(main(['batch', '-c', 'config', '-C', 'checkpoint']), 2)